@@ -1,4 +1,4 @@
-import axios, { AxiosInstance } from 'axios';
+import axios, { AxiosInstance, AxiosRequestConfig, AxiosResponse } from 'axios';
 import FormData from 'form-data';
 import fs from 'fs';
 import { env } from '../env';
@@ -38,6 +38,78 @@ export interface AIAnimateResponse {
   violations?: string[];
 }
 
+export interface RenderPackItem extends Partial<AIRenderResponse> {
+  index: number;
+  cached?: boolean;
+  error?: string;
+}
+
+export interface PreparedAssetItem {
+  index: number;
+  filename: string | null;
+  sha256: string;
+  output_path?: string;
+  status?: string;
+  validated?: boolean;
+  violations?: string[];
+  deduplicated?: boolean;
+  error?: string;
+}
+
+export interface PrepareAssetsResponse {
+  items: PreparedAssetItem[];
+  count: number;
+  prepared: number;
+  failed: number;
+}
+
+export interface JobStatus<T = unknown> {
+  job_id: string;
+  kind: string;
+  status: 'queued' | 'running' | 'done' | 'failed';
+  version: number;
+  stage?: string | null;
+  step?: number;
+  total?: number;
+  detail?: Record<string, unknown>;
+  result?: T;
+  error?: string;
+}
+
+/**
+ * Worker scheduling class (X-Priority). Single stickers a user is waiting on are
+ * interactive; pack generation and batch uploads are batch, so they queue behind them.
+ */
+export type WorkerPriority = 'interactive' | 'batch';
+
+function priorityHeaders(priority?: WorkerPriority): Record<string, string> {
+  return priority ? { 'X-Priority': priority } : {};
+}
+
+// Each long-poll request holds the connection at most this long
+const JOB_POLL_WAIT_SEC = 30;
+// Resubmits of a request the worker turned away with 429 (queue full), and the longest wait between them
+const BUSY_RETRIES = 5;
+const BUSY_RETRY_MAX_SEC = 60;
+
+/**
+ * Seconds to wait before retrying a request the worker rejected as busy (429),
+ * from its Retry-After, else exponential backoff. Null for any other error.
+ */
+function busyRetryDelaySec(error: unknown, attempt: number): number | null {
+  if (!axios.isAxiosError(error) || error.response?.status !== 429) {
+    return null;
+  }
+  const retryAfter = Number(error.response.headers['retry-after'] ?? error.response.data?.retry_after);
+  const base = Number.isFinite(retryAfter) && retryAfter > 0 ? retryAfter : 2 ** attempt;
+  // Jitter so requests turned away together don't come back together
+  return Math.min(base + Math.random(), BUSY_RETRY_MAX_SEC);
+}
+
+function sleep(ms: number): Promise<void> {
+  return new Promise((resolve) => setTimeout(resolve, ms));
+}
+
 class WorkerClient {
   private client: AxiosInstance;
 
@@ -51,7 +123,8 @@ class WorkerClient {
   async convert(
     filePath: string,
     preferSeconds: number = 2.8,
-    padMode: string = 'transparent'
+    padMode: string = 'transparent',
+    priority?: WorkerPriority
   ): Promise<ConvertResponse> {
     const formData = new FormData();
     formData.append('file', fs.createReadStream(filePath));
@@ -62,7 +135,7 @@ class WorkerClient {
       '/convert',
       formData,
       {
-        headers: formData.getHeaders(),
+        headers: { ...formData.getHeaders(), ...priorityHeaders(priority) },
       }
     );
 
@@ -88,24 +161,59 @@ class WorkerClient {
 
   async aiRender(
     baseImagePath: string,
-    blueprintJson: string
+    blueprintJson: string,
+    onProgress?: (job: JobStatus) => void,
+    priority?: WorkerPriority
   ): Promise<AIRenderResponse> {
-    const formData = new FormData();
-    formData.append('base_image', fs.createReadStream(baseImagePath));
-    formData.append('blueprint_json', blueprintJson);
+    const job = await this.submitJob(() => {
+      const formData = new FormData();
+      formData.append('kind', 'render');
+      formData.append('base_image', fs.createReadStream(baseImagePath));
+      formData.append('blueprint_json', blueprintJson);
+      return formData;
+    }, priority);
+    return this.waitForJob<AIRenderResponse>(job.job_id, onProgress);
+  }
 
-    const response = await this.client.post<AIRenderResponse>(
-      '/ai/render',
-      formData,
-      {
-        headers: formData.getHeaders(),
-      }
-    );
+  /**
+   * Render several blueprints against one base image in a single request.
+   * The worker streams one NDJSON line per sticker as it finishes (any order);
+   * onItem sees each as it arrives, and all items are returned by index.
+   */
+  async renderPack(
+    baseImagePath: string,
+    blueprints: unknown[],
+    onItem?: (item: RenderPackItem) => void
+  ): Promise<RenderPackItem[]> {
+    const response = await this.postWithBusyRetry('/ai/render_pack', () => {
+      const formData = new FormData();
+      formData.append('base_image', fs.createReadStream(baseImagePath));
+      formData.append('blueprints_json', JSON.stringify(blueprints));
+      return formData;
+    }, 'batch', { responseType: 'stream' });
 
-    return response.data;
+    const items: RenderPackItem[] = [];
+    let buffered = '';
+    for await (const chunk of response.data) {
+      buffered += chunk.toString();
+      let newline: number;
+      while ((newline = buffered.indexOf('\n')) >= 0) {
+        const line = buffered.slice(0, newline).trim();
+        buffered = buffered.slice(newline + 1);
+        if (!line) continue;
+        const item = JSON.parse(line);
+        if (item.done) continue;
+        items[item.index] = item;
+        onItem?.(item);
+      }
+    }
+    return items;
   }
 
-  async prepareAsset(baseImagePath: string): Promise<{ output_path: string; status: string }> {
+  async prepareAsset(
+    baseImagePath: string,
+    priority?: WorkerPriority
+  ): Promise<{ output_path: string; status: string }> {
     // Check cache first
     const cacheKey = stickerCache.generateKey(baseImagePath, {});
     const cached = stickerCache.get(cacheKey);
@@ -122,7 +230,7 @@ class WorkerClient {
       '/sticker/prepare-asset',
       formData,
       {
-        headers: formData.getHeaders(),
+        headers: { ...formData.getHeaders(), ...priorityHeaders(priority) },
       }
     );
 
@@ -134,31 +242,107 @@ class WorkerClient {
     return response.data;
   }
 
+  async prepareAssets(baseImagePaths: string[]): Promise<PrepareAssetsResponse> {
+    // One request for a whole pack; identical images are prepared once by the worker
+    const response = await this.postWithBusyRetry<PrepareAssetsResponse>('/sticker/prepare-assets', () => {
+      const formData = new FormData();
+      for (const baseImagePath of baseImagePaths) {
+        formData.append('base_images', fs.createReadStream(baseImagePath));
+      }
+      return formData;
+    }, 'batch');
+
+    return response.data;
+  }
+
   async aiAnimate(
     preparedAssetPath: string,
     rawVideoPath: string,
     templateId: string,
     durationSec: number = 2.6,
-    fps: number = 24
+    fps: number = 24,
+    priority?: WorkerPriority
   ): Promise<AIAnimateResponse> {
-    const formData = new FormData();
-    formData.append('prepared_asset', fs.createReadStream(preparedAssetPath));
-    formData.append('raw_video', fs.createReadStream(rawVideoPath));
-    formData.append('template_id', templateId);
-    formData.append('duration_sec', durationSec.toString());
-    formData.append('fps', fps.toString());
-
-    const response = await this.client.post<AIAnimateResponse>(
-      '/ai/animate',
-      formData,
-      {
-        headers: formData.getHeaders(),
-        timeout: 300000, // 5 minutes for video processing
+    const job = await this.submitJob(() => {
+      const formData = new FormData();
+      formData.append('kind', 'animate');
+      formData.append('prepared_asset', fs.createReadStream(preparedAssetPath));
+      formData.append('raw_video', fs.createReadStream(rawVideoPath));
+      formData.append('template_id', templateId);
+      formData.append('duration_sec', durationSec.toString());
+      formData.append('fps', fps.toString());
+      return formData;
+    }, priority);
+    return this.waitForJob<AIAnimateResponse>(job.job_id);
+  }
+
+  /**
+   * Queue a worker job (form must include `kind`), returns as soon as it is queued
+   */
+  async submitJob(buildForm: () => FormData, priority?: WorkerPriority): Promise<JobStatus> {
+    const response = await this.postWithBusyRetry<JobStatus>('/jobs', buildForm, priority);
+    return response.data;
+  }
+
+  /**
+   * POST a form, resubmitting it after the worker's Retry-After while the worker
+   * is busy (429). buildForm is called once per attempt (file streams can't be re-sent).
+   */
+  private async postWithBusyRetry<T = any>(
+    path: string,
+    buildForm: () => FormData,
+    priority?: WorkerPriority,
+    config: AxiosRequestConfig = {}
+  ): Promise<AxiosResponse<T>> {
+    for (let attempt = 0; ; attempt++) {
+      const formData = buildForm();
+      try {
+        return await this.client.post<T>(path, formData, {
+          ...config,
+          headers: { ...formData.getHeaders(), ...priorityHeaders(priority) },
+        });
+      } catch (error) {
+        const delaySec = busyRetryDelaySec(error, attempt);
+        if (delaySec === null || attempt >= BUSY_RETRIES) {
+          throw error;
+        }
+        console.warn(`[Worker Client] Worker busy, resubmitting ${path} in ${delaySec.toFixed(1)}s (attempt ${attempt + 1}/${BUSY_RETRIES})`);
+        await sleep(delaySec * 1000);
       }
-    );
+    }
+  }
 
+  /**
+   * Job status; with waitSec the worker long-polls until the job changes past `since`
+   */
+  async getJob<T = unknown>(jobId: string, waitSec: number = 0, since: number = -1): Promise<JobStatus<T>> {
+    const response = await this.client.get<JobStatus<T>>(`/jobs/${jobId}`, {
+      params: { wait: waitSec, since },
+      timeout: (waitSec + 30) * 1000,
+    });
     return response.data;
   }
+
+  /**
+   * Long-poll a job until it finishes, resolving with its result
+   */
+  async waitForJob<T>(jobId: string, onProgress?: (job: JobStatus) => void): Promise<T> {
+    let since = -1;
+    for (;;) {
+      const job = await this.getJob<T>(jobId, JOB_POLL_WAIT_SEC, since);
+      if (job.version !== since && onProgress) {
+        onProgress(job);
+      }
+      since = job.version;
+
+      if (job.status === 'done') {
+        return job.result as T;
+      }
+      if (job.status === 'failed') {
+        throw new Error(`Worker job ${jobId} failed: ${job.error || 'unknown error'}`);
+      }
+    }
+  }
 }
 
 export const workerClient = new WorkerClient();
@@ -5,8 +5,8 @@ import { getSession, setSession, resetSession } from './sessions';
 import { env } from '../env';
 import { isValidImageFile } from '../util/validate';
 import { getTempFilePath, cleanupFile } from '../util/file';
-import { workerClient } from '../services/workerClient';
-import { memeputerClient } from '../services/memeputerClient';
+import { workerClient, WorkerPriority } from '../services/workerClient';
+import { memeputerClient, Blueprint } from '../services/memeputerClient';
 import { getTemplate } from '../ai/templates/stickers';
 import { generateVideo } from '../ai/videoProviders';
 import { buildPromptSpec } from '../services/promptBuilder';
@@ -187,6 +187,9 @@ export async function handleTemplate(ctx: Context, templateInput: string) {
         };
       }> = [];
 
+      // Several templates make a pack: let single stickers for other users go first
+      const priority: WorkerPriority = templates.length > 1 ? 'batch' : 'interactive';
+
       // Generate sticker for each template
       for (let i = 0; i < templates.length; i++) {
         const template = templates[i];
@@ -224,7 +227,8 @@ export async function handleTemplate(ctx: Context, templateInput: string) {
             videoResult.outputPath, // Raw video from i2v
             template,
             promptSpec.duration_s,
-            promptSpec.fps
+            promptSpec.fps,
+            priority
           );
           
           console.log(`[${new Date().toISOString()}] [AI Video] ✅ i2v generation successful for ${template}`);
@@ -247,7 +251,7 @@ export async function handleTemplate(ctx: Context, templateInput: string) {
           }
 
           const blueprintJson = JSON.stringify(blueprint);
-          result = await workerClient.aiRender(baseImage.filePath, blueprintJson);
+          result = await workerClient.aiRender(baseImage.filePath, blueprintJson, undefined, priority);
         }
 
         generatedStickers.push({
@@ -329,6 +333,39 @@ export async function handleTemplate(ctx: Context, templateInput: string) {
   });
 }
 
+/**
+ * Render all of a pack's blueprints in one worker request (the base image is
+ * loaded once there), reporting each sticker as it finishes.
+ * Returns the sticker paths in blueprint order, leaving out failed ones.
+ */
+async function renderPackStickers(ctx: Context, baseImagePath: string, blueprints: Blueprint[]): Promise<string[]> {
+  // Ensure text is uppercase
+  for (const blueprint of blueprints) {
+    if (blueprint.text?.value) {
+      blueprint.text!.value = blueprint.text.value.toUpperCase();
+    }
+  }
+
+  await ctx.reply(`Generating ${blueprints.length} stickers...`);
+  let finished = 0;
+  const items = await workerClient.renderPack(baseImagePath, blueprints, (item) => {
+    finished++;
+    if (item.error) {
+      console.error(`[AI Pack] Sticker ${item.index + 1} failed: ${item.error}`);
+    }
+    ctx.reply(`${item.error ? '⚠️' : '✅'} Sticker ${finished}/${blueprints.length} ${item.error ? 'failed' : 'ready'}`)
+      .catch(err => console.error('Failed to send pack progress:', err));
+  });
+
+  const stickerPaths = items
+    .filter((item) => item && !item.error && item.output_path)
+    .map((item) => item.output_path as string);
+  if (stickerPaths.length === 0) {
+    throw new Error('No stickers in the pack could be rendered');
+  }
+  return stickerPaths;
+}
+
 async function handleAIGeneratePack(ctx: Context) {
   const session = getSession(ctx.from!.id);
   if (session.mode !== 'pack' || !session.packSize || !session.theme) return;
@@ -378,7 +415,7 @@ async function handleAIGeneratePack(ctx: Context) {
       // Prepare asset using worker (asset-first pipeline)
       await ctx.reply('🎨 Preparing sticker asset (removing background, adding outline)...');
       try {
-        const assetResult = await workerClient.prepareAsset(baseImagePath);
+        const assetResult = await workerClient.prepareAsset(baseImagePath, 'batch');
         const preparedBaseImagePath = assetResult.output_path;
         
         // Cleanup original file
@@ -391,21 +428,7 @@ async function handleAIGeneratePack(ctx: Context) {
           theme
         );
 
-        const stickerPaths: string[] = [];
-
-        for (let i = 0; i < blueprints.length; i++) {
-          await ctx.reply(`Generating sticker ${i + 1}/${blueprints.length}...`);
-
-          // Ensure text is uppercase
-          const blueprint = blueprints[i];
-          if (blueprint.text?.value) {
-            blueprint.text!.value = blueprint.text.value.toUpperCase();
-          }
-
-          const blueprintJson = JSON.stringify(blueprints[i]);
-          const result = await workerClient.aiRender(preparedBaseImagePath, blueprintJson);
-          stickerPaths.push(result.output_path);
-        }
+        const stickerPaths = await renderPackStickers(ctx, preparedBaseImagePath, blueprints);
 
         // Ask for pack title
         await ctx.reply('What should the pack title be?', FORCE_REPLY);
@@ -430,21 +453,7 @@ async function handleAIGeneratePack(ctx: Context) {
           theme
         );
 
-        const stickerPaths: string[] = [];
-
-        for (let i = 0; i < blueprints.length; i++) {
-          await ctx.reply(`Generating sticker ${i + 1}/${blueprints.length}...`);
-
-          // Ensure text is uppercase
-          const blueprint = blueprints[i];
-          if (blueprint.text?.value) {
-            blueprint.text!.value = blueprint.text.value.toUpperCase();
-          }
-
-          const blueprintJson = JSON.stringify(blueprints[i]);
-          const result = await workerClient.aiRender(baseImagePath, blueprintJson);
-          stickerPaths.push(result.output_path);
-        }
+        const stickerPaths = await renderPackStickers(ctx, baseImagePath, blueprints);
 
         await ctx.reply('What should the pack title be?', FORCE_REPLY);
         const currentSession = getSession(ctx.from!.id);
@@ -31,6 +31,71 @@ type BatchState = {
 
 const batchStates = new Map<number, BatchState>();
 
+// Images arriving together (an album comes as one message per photo) are
+// prepared in one worker request, which also prepares identical images once
+const ASSET_BATCH_WINDOW_MS = 700;
+const ASSET_BATCH_MAX_WAIT_MS = 3000;
+
+type PendingAsset = {
+  filePath: string;
+  resolve: (result: { output_path: string; status: string }) => void;
+  reject: (error: unknown) => void;
+};
+
+type PendingAssetBatch = {
+  items: PendingAsset[];
+  startedAt: number;
+  timer?: NodeJS.Timeout;
+};
+
+const pendingAssets = new Map<number, PendingAssetBatch>();
+
+function prepareAssetBatched(userId: number, filePath: string): Promise<{ output_path: string; status: string }> {
+  return new Promise((resolve, reject) => {
+    let batch = pendingAssets.get(userId);
+    if (!batch) {
+      batch = { items: [], startedAt: Date.now() };
+      pendingAssets.set(userId, batch);
+    }
+    batch.items.push({ filePath, resolve, reject });
+    if (batch.timer) clearTimeout(batch.timer);
+
+    const waited = Date.now() - batch.startedAt;
+    if (batch.items.length >= MAX_BATCH_SIZE || waited >= ASSET_BATCH_MAX_WAIT_MS) {
+      void flushAssetBatch(userId);
+    } else {
+      batch.timer = setTimeout(() => void flushAssetBatch(userId), Math.min(ASSET_BATCH_WINDOW_MS, ASSET_BATCH_MAX_WAIT_MS - waited));
+    }
+  });
+}
+
+async function flushAssetBatch(userId: number) {
+  const batch = pendingAssets.get(userId);
+  if (!batch) return;
+  pendingAssets.delete(userId);
+  if (batch.timer) clearTimeout(batch.timer);
+  const { items } = batch;
+
+  try {
+    if (items.length === 1) {
+      items[0].resolve(await workerClient.prepareAsset(items[0].filePath, 'batch'));
+      return;
+    }
+    console.log(`[${new Date().toISOString()}] [Batch] Preparing ${items.length} images in one worker request`);
+    const response = await workerClient.prepareAssets(items.map((item) => item.filePath));
+    items.forEach((pending, index) => {
+      const item = response.items[index];
+      if (!item || item.error || !item.output_path) {
+        pending.reject(new Error(item?.error || 'Asset preparation failed'));
+      } else {
+        pending.resolve({ output_path: item.output_path, status: item.status || 'success' });
+      }
+    });
+  } catch (error) {
+    items.forEach((pending) => pending.reject(error));
+  }
+}
+
 function getBatchState(userId: number): BatchState {
   const existing = batchStates.get(userId);
   if (existing) return existing;
@@ -198,7 +263,7 @@ async function handleFileUpload(ctx: Context) {
       
       if (fileIsImage) {
         console.log(`[${processTimestamp}] [Batch] Step 3: Processing as image sticker...`);
-        const assetResult = await workerClient.prepareAsset(filePath);
+        const assetResult = await prepareAssetBatched(ctx.from!.id, filePath);
         console.log(`[${processTimestamp}] [Batch] Image preparation complete:`, {
           output_path: assetResult.output_path,
           status: assetResult.status
@@ -219,7 +284,7 @@ async function handleFileUpload(ctx: Context) {
         console.log(`[${processTimestamp}] [Batch] Cleaned up temp input file: ${filePath}`);
       } else {
         console.log(`[${processTimestamp}] [Batch] Step 3: Sending to worker for video conversion...`);
-        const convertResult = await workerClient.convert(filePath);
+        const convertResult = await workerClient.convert(filePath, undefined, undefined, 'batch');
         console.log(`[${processTimestamp}] [Batch] Conversion complete:`, {
           output_path: convertResult.output_path,
           duration: convertResult.duration,
@@ -7,14 +7,15 @@ import secrets
 import time
 import logging
 import json
-import subprocess
 from typing import Dict, Any, Optional
 from PIL import Image
 from .sticker_asset import prepareStickerAsset
-from .video_matte import matte_video
-from .sizefit import fit_to_limits
+from .video_matte import matte_video_to_raw
+from .sizefit import fit_raw_to_limits, seed_output_args, MAX_FPS, MAX_SECONDS, TARGET_SIDE
 from .quality_gates import validate_video_sticker
 from .ffmpeg_utils import probe_media, get_file_size_kb
+from .artifacts import artifacts
+from .progress import report
 
 logger = logging.getLogger(__name__)
 
@@ -60,29 +61,43 @@ def animate_from_asset(
     timestamp = int(time.time() * 1000)
     unique_id = secrets.token_hex(8)
     
-    # Step 1: Apply video matting (remove background, add alpha)
-    matted_video = os.path.join(temp_dir, f'matted_{timestamp}_{unique_id}.webm')
+    # Step 1: Matte (remove background, add alpha) straight into raw 512x512 frames.
+    # The first size-fit attempt is encoded while the frames are matted, every other
+    # attempt replays the lossless frames: one generation of lossy encoding.
+    fps = max(1, min(int(fps), MAX_FPS))
+    source_duration, _, _, _, _, _ = probe_media(raw_video_path)
+    duration = min(duration_sec, source_duration, MAX_SECONDS)
+    seed_video = os.path.join(temp_dir, f'matted_{timestamp}_{unique_id}.webm')
+    artifacts.register(seed_video, 'intermediate')
     logger.info("Applying video matting...")
+    report('matte')
     
-    matting_success = matte_video(
+    frames, seeded = matte_video_to_raw(
         raw_video_path,
-        matted_video,
+        TARGET_SIDE,
+        fps,
+        duration,
+        seed_output_args(fps, duration, seed_video),
         reference_image_path=prepared_asset_path
     )
-    
-    if not matting_success:
-        logger.warning("Video matting failed, using raw video with chroma key fallback")
-        # Fallback: try chroma key removal
-        matted_video = apply_chroma_key(raw_video_path, temp_dir, timestamp, unique_id)
-        if not matted_video:
-            raise ValueError("Failed to apply background removal to video")
+    if not seeded:
+        artifacts.discard(seed_video)
     
     # Step 2: Fit to limits (512x512, duration, size)
     logger.info("Fitting video to Telegram limits...")
-    final_path, metadata = fit_to_limits(matted_video, duration_sec, 'transparent')
+    # Without a segmentation model the matte pass keys the backdrop itself, so a
+    # failure here means the video could not be decoded
+    if frames is None:
+        raise ValueError("Failed to apply background removal to video")
+    artifacts.register(frames.path, 'intermediate')
+    try:
+        final_path, metadata = fit_raw_to_limits(frames, duration, seed_path=seed_video if seeded else None)
+    finally:
+        artifacts.discard(frames.path)
     
     # Step 3: Quality gates
     logger.info("Validating video sticker...")
+    report('validate')
     is_valid, violations = validate_video_sticker(final_path, metadata)
     
     if not is_valid:
@@ -111,36 +126,3 @@ def animate_from_asset(
     
     logger.info(f"✅ Animation complete: {output_path}, metadata: {metadata}")
     return metadata
-
-
-def apply_chroma_key(
-    input_video: str,
-    temp_dir: str,
-    timestamp: int,
-    unique_id: str
-) -> Optional[str]:
-    """
-    Fallback: Apply chroma key removal (green/blue screen).
-    """
-    try:
-        output_path = os.path.join(temp_dir, f'chroma_{timestamp}_{unique_id}.webm')
-        
-        # Use ffmpeg chroma key filter
-        cmd = [
-            'ffmpeg',
-            '-i', input_video,
-            '-vf', 'chromakey=0x00ff00:0.3:0.2',  # Remove green background
-            '-c:v', 'libvpx-vp9',
-            '-pix_fmt', 'yuva420p',
-            '-auto-alt-ref', '0',
-            '-an',
-            '-y',
-            output_path
-        ]
-        
-        subprocess.run(cmd, check=True, capture_output=True)
-        return output_path
-    except Exception as e:
-        logger.error(f"Chroma key failed: {e}")
-        return None
-
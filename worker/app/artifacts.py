@@ -0,0 +1,257 @@
+"""
+Artifact Lifecycle Manager
+Tracks the files the worker writes into the shared /tmp/packputer volume,
+deletes them once their TTL expires, and evicts the oldest finished
+artifacts when the volume passes its high-water mark.
+"""
+import os
+import re
+import time
+import shutil
+import asyncio
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_DIR = '/tmp/packputer'
+ARTIFACT_SWEEP_SEC = float(os.getenv('ARTIFACT_SWEEP_SEC', '60'))
+# Total bytes of artifacts in the volume (top level and result cache) before eviction starts
+ARTIFACT_QUOTA_MB = float(os.getenv('ARTIFACT_QUOTA_MB', '2048'))
+ARTIFACT_HIGH_WATER = float(os.getenv('ARTIFACT_HIGH_WATER', '0.90'))
+ARTIFACT_LOW_WATER = float(os.getenv('ARTIFACT_LOW_WATER', '0.75'))
+# Unregistered worker files younger than this may still be written, never evict them
+ARTIFACT_MIN_AGE_SEC = float(os.getenv('ARTIFACT_MIN_AGE_SEC', '120'))
+
+# TTL per kind, counted from the last modification
+ARTIFACT_TTLS = {
+    # Uploads and intermediates, normally deleted as soon as their job ends
+    'input': float(os.getenv('ARTIFACT_INPUT_TTL_SEC', '1800')),
+    'intermediate': float(os.getenv('ARTIFACT_INTERMEDIATE_TTL_SEC', '1800')),
+    # Results handed to the bot, which deletes them after upload
+    'output': float(os.getenv('ARTIFACT_OUTPUT_TTL_SEC', '3600')),
+}
+
+# Unregistered files named by the worker (left by a previous process) get the
+# TTL of their kind. Worker names are <prefix>_<ms>_<16 hex>; the bot writes to
+# the same volume with the same scheme but other prefixes (e.g. sticker_processed_),
+# so a name only counts when the prefix is followed by the timestamp and id.
+# Anything else belongs to the bot and is never expired or evicted here.
+PREFIX_KINDS = [
+    ('input_', 'input'),
+    ('ai_input_', 'input'),
+    ('asset_input_', 'input'),
+    ('raw_video_', 'input'),
+    ('raw_', 'intermediate'),
+    ('frames_', 'intermediate'),
+    ('matted_', 'intermediate'),
+    ('chroma_', 'intermediate'),
+    ('retry_alpha_', 'intermediate'),
+    ('sticker_', 'output'),
+    ('ai_output_', 'output'),
+    ('animated_', 'output'),
+    ('asset_', 'output'),
+]
+WORKER_NAME = re.compile(r'^(%s)_\d+_[0-9a-f]{16}' % '|'.join(re.escape(p.rstrip('_')) for p, _ in PREFIX_KINDS))
+_PREFIX_KIND = {p.rstrip('_'): kind for p, kind in PREFIX_KINDS}
+
+# Subdirectories have their own lifecycle (bot cache, result cache LRU) and are
+# never swept, the result cache still counts towards the quota
+RESULT_CACHE_SUBDIR = 'results'
+
+
+class Artifact:
+    """A registered file: its kind, and whether a job is still using it."""
+    def __init__(self, kind: str, active: bool):
+        self.kind = kind
+        self.active = active
+
+
+class ArtifactRegistry:
+    def __init__(self, root: str = ARTIFACT_DIR):
+        self.root = root
+        self._artifacts: Dict[str, Artifact] = {}
+        self._lock = threading.Lock()
+        self.expired = 0
+        self.evicted = 0
+        self.evicted_bytes = 0
+        self.last_sweep: Optional[float] = None
+        self.last_usage: Dict[str, Any] = {}
+
+    def register(self, path: str, kind: str, active: bool = True):
+        """Track a file. Active files belong to a running job and are never swept."""
+        with self._lock:
+            self._artifacts[os.path.abspath(path)] = Artifact(kind, active)
+
+    def hand_off(self, path: str):
+        """A result was returned to the caller: finished, swept once its output TTL expires."""
+        self.register(path, 'output', active=False)
+
+    def discard(self, path: Optional[str]):
+        """Delete a file the worker no longer needs and stop tracking it."""
+        if not path:
+            return
+        with self._lock:
+            self._artifacts.pop(os.path.abspath(path), None)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not delete {path}: {e}")
+
+    def _kind_of(self, path: str, registered: Dict[str, Artifact]) -> Artifact:
+        artifact = registered.get(path)
+        if artifact is not None:
+            return artifact
+        match = WORKER_NAME.match(os.path.basename(path))
+        if match:
+            return Artifact(_PREFIX_KIND[match.group(1)], active=False)
+        return Artifact('untracked', active=False)
+
+    def _claim(self, path: str, seen: Optional[Artifact]) -> bool:
+        """
+        Take a file away from the registry for deletion, unless a job registered
+        it (or marked it active) since the sweep's snapshot.
+        """
+        with self._lock:
+            current = self._artifacts.get(path)
+            if current is not seen or (current is not None and current.active):
+                return False
+            self._artifacts.pop(path, None)
+        return True
+
+    def _unlink(self, path: str, seen: Optional[Artifact]) -> bool:
+        if not self._claim(path, seen):
+            return False
+        try:
+            os.unlink(path)
+        except OSError:
+            return False
+        return True
+
+    def sweep(self) -> Dict[str, Any]:
+        """
+        Delete expired artifacts, then evict finished ones past the high-water mark.
+        The volume is scanned against a snapshot of the registry; the lock is only
+        taken to confirm each file is still unclaimed, so request handlers that
+        register or discard files are never held up by the scan.
+        """
+        now = time.time()
+        candidates = []  # (mtime, size, path, kind, registered artifact) of files that may be evicted
+        usage_by_kind: Dict[str, int] = {}
+        total = 0
+
+        with self._lock:
+            registered = dict(self._artifacts)
+
+        try:
+            entries = list(os.scandir(self.root))
+        except FileNotFoundError:
+            entries = []
+
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name == RESULT_CACHE_SUBDIR:
+                    size = _dir_size(entry.path)
+                    usage_by_kind['result_cache'] = usage_by_kind.get('result_cache', 0) + size
+                    total += size
+                continue
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            path = os.path.abspath(entry.path)
+            seen = registered.get(path)
+            artifact = self._kind_of(path, registered)
+            age = now - st.st_mtime
+
+            if artifact.kind == 'untracked':
+                # The bot's file: reported, but not part of our quota and never deleted
+                usage_by_kind['untracked'] = usage_by_kind.get('untracked', 0) + st.st_size
+                continue
+
+            if not artifact.active and age > ARTIFACT_TTLS[artifact.kind]:
+                if self._unlink(path, seen):
+                    self.expired += 1
+                    continue
+
+            usage_by_kind[artifact.kind] = usage_by_kind.get(artifact.kind, 0) + st.st_size
+            total += st.st_size
+            if not artifact.active and (seen is not None or age > ARTIFACT_MIN_AGE_SEC):
+                candidates.append((st.st_mtime, st.st_size, path, artifact.kind, seen))
+
+        # Registered files that disappeared (deleted by the bot) are forgotten
+        missing = [(p, a) for p, a in registered.items() if not os.path.exists(p)]
+        if missing:
+            with self._lock:
+                for path, artifact in missing:
+                    if self._artifacts.get(path) is artifact:
+                        del self._artifacts[path]
+
+        quota = ARTIFACT_QUOTA_MB * 1024 * 1024
+        disk = shutil.disk_usage(self.root) if os.path.isdir(self.root) else None
+        disk_fraction = disk.used / disk.total if disk and disk.total else 0.0
+        if total > quota * ARTIFACT_HIGH_WATER or disk_fraction > ARTIFACT_HIGH_WATER:
+            target = quota * ARTIFACT_LOW_WATER
+            freed = 0
+            # Oldest finished artifacts first
+            for mtime, size, path, kind, seen in sorted(candidates, key=lambda c: c[:3]):
+                if total <= target and (disk is None or (disk.used - freed) / disk.total <= ARTIFACT_LOW_WATER):
+                    break
+                if self._unlink(path, seen):
+                    total -= size
+                    freed += size
+                    usage_by_kind[kind] -= size
+                    self.evicted += 1
+                    self.evicted_bytes += size
+            logger.warning(f"Artifact volume over high-water mark, evicted down to {total / 1024 / 1024:.1f}MB")
+
+        usage = {
+            'bytes': total,
+            'bytes_by_kind': usage_by_kind,
+            'disk_total': disk.total if disk else None,
+            'disk_used': disk.used if disk else None,
+        }
+        with self._lock:
+            self.last_sweep = now
+            self.last_usage = usage
+        return usage
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'tracked': len(self._artifacts),
+                'active': sum(1 for a in self._artifacts.values() if a.active),
+                'quota_bytes': int(ARTIFACT_QUOTA_MB * 1024 * 1024),
+                'expired': self.expired,
+                'evicted': self.evicted,
+                'evicted_bytes': self.evicted_bytes,
+                'last_sweep': self.last_sweep,
+                **self.last_usage,
+            }
+
+
+def _dir_size(path: str) -> int:
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                size += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return size
+
+
+artifacts = ArtifactRegistry()
+
+
+async def run_sweeper():
+    """Background task: sweep the volume every ARTIFACT_SWEEP_SEC."""
+    while True:
+        try:
+            await asyncio.to_thread(artifacts.sweep)
+        except Exception as e:
+            logger.error(f"Artifact sweep failed: {e}")
+        await asyncio.sleep(ARTIFACT_SWEEP_SEC)
@@ -1,25 +1,89 @@
 import os
-from typing import List
+import asyncio
+from typing import AsyncIterator, List, Optional
 from fastapi import UploadFile
-from .convert import convert_file
+from .convert import convert_path
+from .uploads import SavedUpload, save_upload
+from .artifacts import artifacts
 
-async def batch_convert_files(
+# How many files of one batch are converted at the same time
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '4'))
+
+async def _convert_item(
+    index: int,
+    filename: Optional[str],
+    upload: SavedUpload,
+    semaphore: asyncio.Semaphore
+) -> dict:
+    """Convert one batch item, returning its result or error as a dict."""
+    async with semaphore:
+        try:
+            output_path, metadata = await convert_path(upload.path, content_hash=upload.sha256)
+            return {'index': index, 'filename': filename, 'output_path': output_path, **metadata}
+        except Exception as e:
+            print(f"Error converting {filename}: {e}")
+            return {'index': index, 'filename': filename, 'error': str(e)}
+
+async def _start_batch(
     files: List[UploadFile],
-    max_files: int = 10
-) -> List[tuple[str, dict]]:
-    """Convert multiple files to stickers."""
+    max_files: int,
+    concurrency: Optional[int]
+) -> List[asyncio.Task]:
     if len(files) > max_files:
         raise ValueError(f'Maximum {max_files} files allowed')
     
+    # Save every upload up front so conversions never touch the request body
+    inputs = []
+    try:
+        for file in files:
+            inputs.append((file.filename, await save_upload(file)))
+    except BaseException:
+        # One upload was rejected, drop the ones already saved
+        for _, upload in inputs:
+            artifacts.discard(upload.path)
+        raise
+    semaphore = asyncio.Semaphore(concurrency or BATCH_CONCURRENCY)
+    return [
+        asyncio.create_task(_convert_item(index, filename, upload, semaphore))
+        for index, (filename, upload) in enumerate(inputs)
+    ]
+
+async def batch_convert_files(
+    files: List[UploadFile],
+    max_files: int = 10,
+    concurrency: Optional[int] = None
+) -> List[tuple[str, dict]]:
+    """Convert multiple files to stickers concurrently, keeping input order."""
+    items = await asyncio.gather(*await _start_batch(files, max_files, concurrency))
+    
     results = []
-    for file in files:
-        try:
-            output_path, metadata = await convert_file(file)
-            results.append((output_path, metadata))
-        except Exception as e:
-            print(f"Error converting {file.filename}: {e}")
+    for item in items:
+        if 'error' in item:
             # Continue with other files
             continue
-    
+        metadata = {k: v for k, v in item.items() if k not in ('index', 'filename', 'output_path')}
+        results.append((item['output_path'], metadata))
     return results
 
+async def iter_batch_convert(
+    files: List[UploadFile],
+    max_files: int = 10,
+    concurrency: Optional[int] = None
+) -> AsyncIterator[dict]:
+    """
+    Start converting a batch and return an iterator over per-item results in
+    completion order. Uploads are saved before this returns, so the iterator
+    can outlive the request body.
+    """
+    tasks = await _start_batch(files, max_files, concurrency)
+    
+    async def results() -> AsyncIterator[dict]:
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            # Client went away: don't leave conversions running for nobody
+            for task in tasks:
+                task.cancel()
+    
+    return results()
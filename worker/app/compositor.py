@@ -0,0 +1,125 @@
+"""
+NumPy Frame Compositor
+Composites premultiplied-alpha layers into reused float32 frame buffers,
+blending only inside each layer's bounding box.
+"""
+import numpy as np
+from PIL import Image, ImageDraw
+from typing import Optional, Tuple
+
+
+class Layer:
+    """Premultiplied RGBA float32 pixels trimmed to their alpha bounding box."""
+    def __init__(self, pixels: np.ndarray, dx: int = 0, dy: int = 0):
+        self.pixels = pixels  # (h, w, 4) float32, RGB already multiplied by alpha
+        self.dx = dx          # Offset of the trimmed pixels inside the source image
+        self.dy = dy
+
+    @property
+    def width(self) -> int:
+        return self.pixels.shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.pixels.shape[0]
+
+
+def premultiply(img: Image.Image) -> Layer:
+    """Convert a PIL image to a premultiplied Layer, trimmed to its visible pixels."""
+    img = img.convert('RGBA') if img.mode != 'RGBA' else img
+    bbox = img.getchannel('A').getbbox()
+    if bbox is None:
+        return Layer(np.zeros((0, 0, 4), dtype=np.float32))
+    left, top, right, bottom = bbox
+    pixels = np.asarray(img.crop(bbox), dtype=np.float32) / 255.0
+    pixels[..., :3] *= pixels[..., 3:4]
+    return Layer(pixels, left, top)
+
+
+def solid_disc(radius: int, color: Tuple[int, int, int]) -> Layer:
+    """Opaque disc of the given color, rasterized like ImageDraw.ellipse."""
+    size = 2 * radius + 1
+    mask = Image.new('L', (size, size), 0)
+    ImageDraw.Draw(mask).ellipse([0, 0, size - 1, size - 1], fill=255)
+    alpha = np.asarray(mask, dtype=np.float32)[..., None] / 255.0
+    rgb = np.array(color, dtype=np.float32) / 255.0
+    return Layer(np.concatenate([rgb * alpha, alpha], axis=2).astype(np.float32))
+
+
+class FrameCompositor:
+    """
+    Reusable frame buffer: clear(), composite layers with over(), then
+    to_rgba8() for the straight-alpha uint8 frame the encoder expects.
+    Only the region touched since the last clear() is cleared and converted.
+    """
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self.buffer = np.zeros((height, width, 4), dtype=np.float32)
+        self._out = np.zeros((height, width, 4), dtype=np.uint8)
+        self._inv = np.zeros((height, width), dtype=np.float32)
+        self._dirty: Optional[Tuple[int, int, int, int]] = None  # (left, top, right, bottom)
+
+    def _touch(self, left: int, top: int, right: int, bottom: int):
+        if self._dirty is None:
+            self._dirty = (left, top, right, bottom)
+        else:
+            l, t, r, b = self._dirty
+            self._dirty = (min(l, left), min(t, top), max(r, right), max(b, bottom))
+
+    def clear(self):
+        if self._dirty is not None:
+            left, top, right, bottom = self._dirty
+            self.buffer[top:bottom, left:right] = 0.0
+            self._out[top:bottom, left:right] = 0
+            self._dirty = None
+
+    def over(self, layer: Layer, x: int, y: int, opacity: float = 1.0):
+        """Composite layer over the frame with its source image's top-left at (x, y)."""
+        x += layer.dx
+        y += layer.dy
+        left, top = max(x, 0), max(y, 0)
+        right = min(x + layer.width, self.width)
+        bottom = min(y + layer.height, self.height)
+        if right <= left or bottom <= top or opacity <= 0:
+            return
+
+        src = layer.pixels[top - y:bottom - y, left - x:right - x]
+        if opacity < 1.0:
+            src = src * np.float32(opacity)
+        dst = self.buffer[top:bottom, left:right]
+        if self._dirty is None:
+            # Nothing under the layer yet, blending reduces to a copy
+            dst[...] = src
+        else:
+            dst *= 1.0 - src[..., 3:4]
+            dst += src
+        self._touch(left, top, right, bottom)
+
+    def overlay(self, color: Tuple[int, int, int], alpha: float):
+        """Composite a uniform color over the whole frame."""
+        premultiplied = np.array([c / 255.0 * alpha for c in color] + [alpha], dtype=np.float32)
+        self.buffer *= np.float32(1.0 - alpha)
+        self.buffer += premultiplied
+        self._touch(0, 0, self.width, self.height)
+
+    def to_rgba8(self) -> np.ndarray:
+        """
+        Un-premultiply into a reused uint8 (h, w, 4) array.
+        The array is overwritten by the next call, consume or copy it first.
+        """
+        if self._dirty is None:
+            return self._out
+        left, top, right, bottom = self._dirty
+        src = self.buffer[top:bottom, left:right]
+        alpha = src[..., 3]
+        inv = self._inv[top:bottom, left:right]
+        inv.fill(0.0)
+        np.divide(255.0, alpha, out=inv, where=alpha > 0)
+        out = self._out[top:bottom, left:right]
+        rgb = src[..., :3] * inv[..., None]
+        rgb += 0.5
+        np.minimum(rgb, 255.0, out=rgb)
+        out[..., :3] = rgb
+        out[..., 3] = alpha * 255.0 + 0.5
+        return self._out
@@ -1,38 +1,77 @@
 import os
-import shutil
-import tempfile
-import time
-import secrets
+import asyncio
+from typing import Optional
 from fastapi import UploadFile
 from .sizefit import fit_to_limits
+from .executor import run_stage, run_releasing
+from .scheduler import estimate_cost_mb
+from .result_cache import RESULT_CACHE_ENABLED, result_cache, hash_file, cache_key, cached_output_path, link_or_copy
+from .singleflight import COALESCE_ENABLED, single_flight
+from .uploads import save_upload
+from .artifacts import artifacts
 
-async def convert_file(
-    file: UploadFile,
+def fork_output(result: tuple[str, dict]) -> tuple[str, dict]:
+    """Give a coalesced request its own copy of the leader's output."""
+    output_path, metadata = result
+    forked_path = cached_output_path('sticker')
+    link_or_copy(output_path, forked_path)
+    return forked_path, {**metadata, 'coalesced': True}
+
+async def convert_path(
+    temp_input: str,
     prefer_seconds: float = 2.8,
-    pad_mode: str = 'transparent'
+    pad_mode: str = 'transparent',
+    content_hash: Optional[str] = None
 ) -> tuple[str, dict]:
-    """Convert uploaded file to sticker format."""
-    # Save uploaded file temporarily
-    temp_input = None
+    """
+    Convert a saved input to sticker format, removing the input afterwards
+    (once the encode reading it has finished, even if this caller goes away).
+    content_hash: sha256 of the input if already known (computed while uploading)
+    """
+    def release():
+        artifacts.discard(temp_input)
+    
+    handed_off = False
     try:
-        # Create temp file in shared volume with unique name
-        suffix = os.path.splitext(file.filename or 'input')[1] or '.tmp'
-        temp_dir = '/tmp/packputer'
-        os.makedirs(temp_dir, exist_ok=True)
-        # Use 8 bytes (16 hex chars) + timestamp for better uniqueness
-        temp_input = os.path.join(temp_dir, f'input_{int(time.time() * 1000)}_{secrets.token_hex(8)}{suffix}')
-        with open(temp_input, 'wb') as tmp:
-            shutil.copyfileobj(file.file, tmp)
+        key = None
+        if RESULT_CACHE_ENABLED or COALESCE_ENABLED:
+            if content_hash is None:
+                content_hash = await asyncio.to_thread(hash_file, temp_input)
+            key = cache_key('convert', content_hash, {'prefer_seconds': prefer_seconds, 'pad_mode': pad_mode})
+        
+        if key and RESULT_CACHE_ENABLED:
+            output_path = cached_output_path('sticker')
+            metadata = result_cache.get(key, output_path)
+            if metadata is not None:
+                artifacts.hand_off(output_path)
+                return output_path, {**metadata, 'cached': True}
         
-        # Convert
-        output_path, metadata = fit_to_limits(temp_input, prefer_seconds, pad_mode)
+        async def convert():
+            cost_mb = await asyncio.to_thread(estimate_cost_mb, 'convert', temp_input, prefer_seconds)
+            output_path, metadata = await run_stage('convert', fit_to_limits, temp_input, prefer_seconds, pad_mode,
+                                                    cost_mb=cost_mb)
+            if key and RESULT_CACHE_ENABLED:
+                result_cache.put(key, output_path, metadata)
+            return output_path, metadata
         
+        # From here the input is released by whoever runs the encode
+        handed_off = True
+        if key and COALESCE_ENABLED:
+            output_path, metadata = await single_flight.run(key, convert, fork_output, release)
+        else:
+            output_path, metadata = await run_releasing(convert, release)
+        artifacts.hand_off(output_path)
         return output_path, metadata
     finally:
-        # Cleanup input
-        if temp_input and os.path.exists(temp_input):
-            try:
-                os.unlink(temp_input)
-            except:
-                pass
+        # Cleanup input (cache hit or failure before the encode started)
+        if not handed_off:
+            release()
 
+async def convert_file(
+    file: UploadFile,
+    prefer_seconds: float = 2.8,
+    pad_mode: str = 'transparent'
+) -> tuple[str, dict]:
+    """Convert uploaded file to sticker format."""
+    upload = await save_upload(file)
+    return await convert_path(upload.path, prefer_seconds, pad_mode, upload.sha256)
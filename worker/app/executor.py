@@ -0,0 +1,181 @@
+"""
+Execution layer for blocking pipeline stages.
+Runs ffmpeg/PIL-heavy stages off the event loop on a shared thread or process
+pool, admitted by the scheduler (memory budget, priority, per-stage concurrency
+limit), with queue-depth reporting.
+"""
+import os
+import time
+import asyncio
+import contextvars
+import functools
+import logging
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from .scheduler import DEFAULT_PRIORITY, scheduler, current_scope, estimate_cost_mb
+
+logger = logging.getLogger(__name__)
+
+# 'thread' keeps the process-wide ffmpeg cap and caches shared, 'process' sidesteps the GIL
+WORKER_EXECUTOR = os.getenv('WORKER_EXECUTOR', 'thread')
+WORKER_POOL_SIZE = int(os.getenv('WORKER_POOL_SIZE', str(os.cpu_count() or 2)))
+
+# Default per-stage concurrency, override with STAGE_LIMIT_<STAGE> (e.g. STAGE_LIMIT_RENDER=2)
+DEFAULT_STAGE_LIMITS = {
+    'convert': WORKER_POOL_SIZE,
+    'render': WORKER_POOL_SIZE,
+    'prepare_asset': WORKER_POOL_SIZE,
+    'animate': max(1, WORKER_POOL_SIZE // 2),
+}
+
+
+class StageStats:
+    """Counters for one pipeline stage."""
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_sec_total = 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        started = self.completed + self.failed + self.running
+        return {
+            'limit': self.limit,
+            'queued': self.queued,
+            'running': self.running,
+            'completed': self.completed,
+            'failed': self.failed,
+            'avg_wait_ms': int(self.wait_sec_total * 1000 / started) if started else 0,
+        }
+
+
+_pool: Optional[Executor] = None
+_stats: Dict[str, StageStats] = {}
+# Pool futures started under run_releasing, which may outlive their cancelled caller
+_tracked_work: contextvars.ContextVar[Optional[List[asyncio.Future]]] = contextvars.ContextVar('tracked_work', default=None)
+
+
+def _get_pool() -> Executor:
+    global _pool
+    if _pool is None:
+        if WORKER_EXECUTOR == 'process':
+            _pool = ProcessPoolExecutor(max_workers=WORKER_POOL_SIZE)
+        else:
+            _pool = ThreadPoolExecutor(max_workers=WORKER_POOL_SIZE, thread_name_prefix='stage')
+        logger.info(f"Started {WORKER_EXECUTOR} pool with {WORKER_POOL_SIZE} workers")
+    return _pool
+
+
+def _stage_limit(stage: str) -> int:
+    default = DEFAULT_STAGE_LIMITS.get(stage, WORKER_POOL_SIZE)
+    return max(1, int(os.getenv(f'STAGE_LIMIT_{stage.upper()}', str(default))))
+
+
+def _get_stage(stage: str) -> StageStats:
+    if stage not in _stats:
+        limit = _stage_limit(stage)
+        _stats[stage] = StageStats(limit)
+        scheduler.set_stage_limit(stage, limit)
+    return _stats[stage]
+
+
+async def run_stage(
+    stage: str,
+    fn: Callable[..., Any],
+    *args,
+    cost_mb: Optional[float] = None,
+    **kwargs
+) -> Any:
+    """
+    Run a blocking stage function on the pool without blocking the event loop.
+    Waits in the scheduler (by the request's priority) until the memory budget
+    has room for cost_mb and the stage is under its concurrency limit.
+    """
+    stats = _get_stage(stage)
+    scope = current_scope()
+    if cost_mb is None:
+        cost_mb = estimate_cost_mb(stage)
+    stats.queued += 1
+    try:
+        wait_sec = await scheduler.acquire(stage, cost_mb, scope.priority if scope else DEFAULT_PRIORITY)
+    finally:
+        stats.queued -= 1
+    stats.wait_sec_total += wait_sec
+    if scope:
+        scope.queue_wait += wait_sec
+
+    stats.running += 1
+    start_time = time.monotonic()
+    loop = asyncio.get_running_loop()
+    call = functools.partial(fn, *args, **kwargs)
+    if WORKER_EXECUTOR != 'process':
+        # Carry context (e.g. the job's progress callback) into the pool thread
+        call = functools.partial(contextvars.copy_context().run, call)
+    try:
+        future = loop.run_in_executor(_get_pool(), call)
+    except BaseException:
+        stats.running -= 1
+        scheduler.release(stage, cost_mb, 0.0)
+        raise
+
+    def finished(done: asyncio.Future):
+        # The budget is held until the pool actually finishes, even if the
+        # caller was cancelled while the work kept running
+        stats.running -= 1
+        if done.cancelled() or done.exception() is not None:
+            stats.failed += 1
+        else:
+            stats.completed += 1
+        scheduler.release(stage, cost_mb, time.monotonic() - start_time)
+
+    future.add_done_callback(finished)
+    tracked = _tracked_work.get()
+    if tracked is not None:
+        tracked.append(future)
+    return await asyncio.shield(future)
+
+
+async def run_releasing(job: Callable[[], Awaitable[Any]], release: Callable[[], None]) -> Any:
+    """
+    Await job() and call release (e.g. delete its input) once the job and any
+    pool work it started have finished. Pool threads keep running after a
+    cancellation, so release waits for them rather than for the job's caller.
+    """
+    work: List[asyncio.Future] = []
+    token = _tracked_work.set(work)
+    try:
+        return await job()
+    finally:
+        _tracked_work.reset(token)
+        pending = [f for f in work if not f.done()]
+        if not pending:
+            release()
+        else:
+            remaining = [len(pending)]
+
+            def one_done(_):
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    release()
+
+            for f in pending:
+                f.add_done_callback(one_done)
+
+
+def get_stats() -> Dict[str, Any]:
+    """Queue depth and counters per stage."""
+    return {
+        'executor': WORKER_EXECUTOR,
+        'pool_size': WORKER_POOL_SIZE,
+        'stages': {stage: stats.to_dict() for stage, stats in _stats.items()},
+        'scheduler': scheduler.stats(),
+    }
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
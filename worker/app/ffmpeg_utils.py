@@ -1,10 +1,108 @@
 import subprocess
 import json
+import mmap
 import os
-from typing import Tuple, Optional
+import secrets
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Tuple, Optional, List, Union
 
-def probe_media(path: str) -> Tuple[float, int, int, float, Optional[str], bool]:
-    """Probe media file and return (duration, width, height, fps, pix_fmt, has_audio)."""
+# Process-wide cap on concurrently running ffmpeg processes, so parallel requests
+# and speculative encodes can't oversubscribe the CPU
+FFMPEG_MAX_CONCURRENCY = int(os.getenv('FFMPEG_MAX_CONCURRENCY', str(os.cpu_count() or 2)))
+_ffmpeg_slots = threading.BoundedSemaphore(FFMPEG_MAX_CONCURRENCY)
+
+# Bytes per pixel of the planar formats we keep as raw intermediates
+RAW_BYTES_PER_PIXEL = {
+    'yuva420p': 2.5,
+    'rgba': 4,
+}
+
+
+class RawVideo:
+    """
+    Decoded frames kept as a lossless rawvideo file (no container, fixed size and rate).
+    Lives under /tmp/packputer so it stays in the page cache across encode attempts.
+    """
+    def __init__(self, path: str, width: int, height: int, fps: int, pix_fmt: str = 'yuva420p'):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.pix_fmt = pix_fmt
+    
+    @property
+    def frame_size(self) -> int:
+        return int(self.width * self.height * RAW_BYTES_PER_PIXEL[self.pix_fmt])
+    
+    @property
+    def frame_count(self) -> int:
+        try:
+            return os.path.getsize(self.path) // self.frame_size
+        except OSError:
+            return 0
+    
+    @property
+    def duration(self) -> float:
+        return self.frame_count / self.fps if self.fps else 0.0
+    
+    def input_args(self) -> List[str]:
+        """FFmpeg input arguments to read this raw file."""
+        return [
+            '-f', 'rawvideo',
+            '-pix_fmt', self.pix_fmt,
+            '-s', f'{self.width}x{self.height}',
+            '-framerate', str(self.fps),
+            '-i', self.path,
+        ]
+    
+    def cleanup(self):
+        if os.path.exists(self.path):
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+class FFmpegCancelled(Exception):
+    """Raised when an ffmpeg run is cancelled through its cancel event."""
+    pass
+
+def run_ffmpeg(
+    cmd: List[str],
+    cancel_event: Optional[threading.Event] = None
+) -> subprocess.CompletedProcess:
+    """
+    Run ffmpeg under the global concurrency cap.
+    If cancel_event is set while waiting for a slot or while running, the process
+    is killed and FFmpegCancelled is raised. Raises CalledProcessError on failure.
+    """
+    while not _ffmpeg_slots.acquire(timeout=0.2):
+        if cancel_event and cancel_event.is_set():
+            raise FFmpegCancelled()
+    try:
+        if cancel_event and cancel_event.is_set():
+            raise FFmpegCancelled()
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        while True:
+            try:
+                stdout, stderr = proc.communicate(timeout=0.2)
+                break
+            except subprocess.TimeoutExpired:
+                if cancel_event and cancel_event.is_set():
+                    proc.kill()
+                    proc.communicate()
+                    raise FFmpegCancelled()
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd, stdout, stderr)
+        return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+    finally:
+        _ffmpeg_slots.release()
+
+def _ffprobe_media(path: str) -> Optional[Tuple[float, int, int, float, Optional[str], bool]]:
+    """Probe media file with ffprobe. Returns None if probing fails."""
     try:
         cmd = [
             'ffprobe',
@@ -45,27 +143,406 @@ def probe_media(path: str) -> Tuple[float, int, int, float, Optional[str], bool]
         return duration, width, height, fps, pix_fmt, has_audio
     except Exception as e:
         print(f"Error probing media: {e}")
-        return 3.0, 512, 512, 30.0, None, False
+        return None
 
-def encode_webm(
+
+# Matroska element IDs needed to read our own WEBM outputs
+EBML_HEADER = 0x1A45DFA3
+EBML_DOCTYPE = 0x4282
+MKV_SEGMENT = 0x18538067
+MKV_INFO = 0x1549A966
+MKV_TIMECODE_SCALE = 0x2AD7B1
+MKV_DURATION = 0x4489
+MKV_TRACKS = 0x1654AE6B
+MKV_TRACK_ENTRY = 0xAE
+MKV_TRACK_TYPE = 0x83
+MKV_CODEC_ID = 0x86
+MKV_DEFAULT_DURATION = 0x23E383
+MKV_VIDEO = 0xE0
+MKV_PIXEL_WIDTH = 0xB0
+MKV_PIXEL_HEIGHT = 0xBA
+MKV_ALPHA_MODE = 0x53C0
+MKV_CLUSTER = 0x1F43B675
+
+# Only the first bytes are read, Info and Tracks precede the first Cluster
+EBML_READ_BYTES = 64 * 1024
+
+
+def _read_vint(data: bytes, pos: int, strip_marker: bool) -> Tuple[int, int]:
+    """Read an EBML variable-length integer, returns (value, new_pos). Unknown sizes return -1."""
+    first = data[pos]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not (first & mask):
+        mask >>= 1
+        length += 1
+    if length > 8 or pos + length > len(data):
+        raise ValueError('Invalid EBML varint')
+    value = first & (mask - 1) if strip_marker else first
+    for byte in data[pos + 1:pos + length]:
+        value = (value << 8) | byte
+    if strip_marker and value == (1 << (7 * length)) - 1:
+        value = -1
+    return value, pos + length
+
+
+def _iter_elements(data: bytes, start: int, end: int):
+    """Yield (id, payload_start, payload_end) for the elements in data[start:end]."""
+    pos = start
+    while pos < end:
+        element_id, pos = _read_vint(data, pos, strip_marker=False)
+        size, pos = _read_vint(data, pos, strip_marker=True)
+        payload_end = end if size < 0 else min(pos + size, end)
+        yield element_id, pos, payload_end
+        pos = payload_end
+
+
+def _read_uint(data: bytes, start: int, end: int) -> int:
+    return int.from_bytes(data[start:end], 'big')
+
+
+def _read_float(data: bytes, start: int, end: int) -> float:
+    if end - start == 4:
+        return struct.unpack('>f', data[start:end])[0]
+    if end - start == 8:
+        return struct.unpack('>d', data[start:end])[0]
+    return 0.0
+
+
+def read_webm_header(path: str) -> Optional[Tuple[float, int, int, float, Optional[str], bool]]:
+    """
+    Read (duration, width, height, fps, pix_fmt, has_audio) from a WEBM's Matroska
+    header without spawning ffprobe. Returns None for anything that isn't a
+    VP8/VP9 WEBM with duration, dimensions and frame duration in its header.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read(EBML_READ_BYTES)
+
+        doc_type = None
+        segment = None
+        for element_id, start, end in _iter_elements(data, 0, len(data)):
+            if element_id == EBML_HEADER:
+                for child_id, c_start, c_end in _iter_elements(data, start, end):
+                    if child_id == EBML_DOCTYPE:
+                        doc_type = data[c_start:c_end].rstrip(b'\x00').decode('ascii', 'replace')
+            elif element_id == MKV_SEGMENT:
+                segment = (start, end)
+                break
+        if doc_type != 'webm' or segment is None:
+            return None
+
+        timecode_scale = 1000000
+        duration_ticks = None
+        video = None
+        has_audio = False
+        for element_id, start, end in _iter_elements(data, *segment):
+            if element_id == MKV_INFO:
+                for child_id, c_start, c_end in _iter_elements(data, start, end):
+                    if child_id == MKV_TIMECODE_SCALE:
+                        timecode_scale = _read_uint(data, c_start, c_end)
+                    elif child_id == MKV_DURATION:
+                        duration_ticks = _read_float(data, c_start, c_end)
+            elif element_id == MKV_TRACKS:
+                for entry_id, e_start, e_end in _iter_elements(data, start, end):
+                    if entry_id != MKV_TRACK_ENTRY:
+                        continue
+                    track = {}
+                    for child_id, c_start, c_end in _iter_elements(data, e_start, e_end):
+                        if child_id == MKV_TRACK_TYPE:
+                            track['type'] = _read_uint(data, c_start, c_end)
+                        elif child_id == MKV_CODEC_ID:
+                            track['codec'] = data[c_start:c_end].decode('ascii', 'replace')
+                        elif child_id == MKV_DEFAULT_DURATION:
+                            track['frame_ns'] = _read_uint(data, c_start, c_end)
+                        elif child_id == MKV_VIDEO:
+                            for video_id, v_start, v_end in _iter_elements(data, c_start, c_end):
+                                if video_id == MKV_PIXEL_WIDTH:
+                                    track['width'] = _read_uint(data, v_start, v_end)
+                                elif video_id == MKV_PIXEL_HEIGHT:
+                                    track['height'] = _read_uint(data, v_start, v_end)
+                                elif video_id == MKV_ALPHA_MODE:
+                                    track['alpha'] = _read_uint(data, v_start, v_end)
+                    if track.get('type') == 1 and video is None:
+                        video = track
+                    elif track.get('type') == 2:
+                        has_audio = True
+            elif element_id == MKV_CLUSTER:
+                break
+
+        if (video is None or video.get('codec') not in ('V_VP8', 'V_VP9') or duration_ticks is None
+                or not video.get('width') or not video.get('height') or not video.get('frame_ns')):
+            return None
+
+        duration = duration_ticks * timecode_scale / 1e9
+        fps = round(1e9 / video['frame_ns'], 3)
+        pix_fmt = 'yuva420p' if video.get('alpha') else 'yuv420p'
+        return duration, video['width'], video['height'], fps, pix_fmt, has_audio
+    except (OSError, ValueError, IndexError, struct.error):
+        return None
+
+
+# Probe results keyed by (path, size, mtime), so rewritten files are re-probed
+PROBE_CACHE_SIZE = int(os.getenv('PROBE_CACHE_SIZE', '512'))
+_probe_cache: "OrderedDict[Tuple[str, int, int], Tuple[float, int, int, float, Optional[str], bool]]" = OrderedDict()
+_probe_lock = threading.Lock()
+_probe_stats = {'hits': 0, 'header_reads': 0, 'ffprobe_runs': 0}
+
+
+def probe_media(path: str) -> Tuple[float, int, int, float, Optional[str], bool]:
+    """Probe media file and return (duration, width, height, fps, pix_fmt, has_audio)."""
+    try:
+        st = os.stat(path)
+        key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    except OSError:
+        key = None
+
+    if key is not None:
+        with _probe_lock:
+            cached = _probe_cache.get(key)
+            if cached is not None:
+                _probe_cache.move_to_end(key)
+                _probe_stats['hits'] += 1
+                return cached
+
+    result = read_webm_header(path) if path.lower().endswith('.webm') else None
+    if result is not None:
+        counter = 'header_reads'
+    else:
+        counter = 'ffprobe_runs'
+        result = _ffprobe_media(path)
+
+    with _probe_lock:
+        _probe_stats[counter] += 1
+        if result is None:
+            return 3.0, 512, 512, 30.0, None, False
+        if key is not None and PROBE_CACHE_SIZE > 0:
+            _probe_cache[key] = result
+            while len(_probe_cache) > PROBE_CACHE_SIZE:
+                _probe_cache.popitem(last=False)
+    return result
+
+
+def get_probe_stats() -> dict:
+    """Probe cache counters for /stats."""
+    with _probe_lock:
+        return dict(_probe_stats, cached=len(_probe_cache))
+
+class RawFrameSink:
+    """
+    Streams RGBA frames into a long-lived ffmpeg process over stdin as they are
+    produced, while keeping a copy in a memory-mapped rawvideo file so later
+    encodes can replay the frames without rendering them again.
+    Without output_args the frames are only collected into the raw file.
+    """
+    def __init__(
+        self,
+        width: int,
+        height: int,
+        fps: int,
+        frame_count: int,
+        output_args: Optional[List[str]] = None,
+        temp_dir: str = '/tmp/packputer'
+    ):
+        os.makedirs(temp_dir, exist_ok=True)
+        raw_path = os.path.join(
+            temp_dir,
+            f'frames_{int(time.time() * 1000)}_{secrets.token_hex(8)}.rgba'
+        )
+        self.raw = RawVideo(raw_path, width, height, fps, pix_fmt='rgba')
+        self.frame_count = frame_count
+        self.frames_written = 0
+        
+        # Preallocate the replay buffer and map it
+        self._file = open(raw_path, 'w+b')
+        self._file.truncate(self.raw.frame_size * frame_count)
+        self._buffer = mmap.mmap(self._file.fileno(), self.raw.frame_size * frame_count)
+        
+        self._proc = None
+        self._holds_slot = False
+        self._broken_pipe = False
+        if output_args is None:
+            return
+        
+        self.cmd = [
+            'ffmpeg',
+            '-y',
+            '-f', 'rawvideo',
+            '-pix_fmt', 'rgba',
+            '-s', f'{width}x{height}',
+            '-framerate', str(fps),
+            '-i', '-',
+            *output_args
+        ]
+        # stderr goes to a file so a chatty ffmpeg can't block on a full pipe
+        self._stderr = tempfile.TemporaryFile(mode='w+')
+        _ffmpeg_slots.acquire()
+        self._holds_slot = True
+        try:
+            self._proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self._stderr)
+        except Exception:
+            self._release_slot()
+            raise
+    
+    def _release_slot(self):
+        if self._holds_slot:
+            self._holds_slot = False
+            _ffmpeg_slots.release()
+    
+    def write(self, frame: bytes):
+        """Append one RGBA frame (width * height * 4 bytes)."""
+        if self.frames_written >= self.frame_count:
+            raise ValueError(f'RawFrameSink is full ({self.frame_count} frames)')
+        offset = self.frames_written * self.raw.frame_size
+        self._buffer[offset:offset + self.raw.frame_size] = frame
+        self.frames_written += 1
+        if self._proc is None or self._broken_pipe:
+            return
+        try:
+            self._proc.stdin.write(frame)
+        except BrokenPipeError:
+            # ffmpeg exited early: keep collecting frames, close() reports its error
+            self._broken_pipe = True
+    
+    def repeat(self, index: int):
+        """Append a copy of an already written frame."""
+        if index >= self.frames_written:
+            raise ValueError(f'Frame {index} has not been written yet')
+        offset = index * self.raw.frame_size
+        self.write(self._buffer[offset:offset + self.raw.frame_size])
+    
+    def close(self) -> Optional[subprocess.CompletedProcess]:
+        """
+        Finish the stream and wait for ffmpeg (if any).
+        The replay buffer stays on disk (self.raw) until discard().
+        Raises CalledProcessError if ffmpeg failed.
+        """
+        try:
+            self._buffer.flush()
+            self._buffer.close()
+            self._file.truncate(self.raw.frame_size * self.frames_written)
+            self._file.close()
+            if self._proc is None:
+                return None
+            try:
+                self._proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            returncode = self._proc.wait()
+            self._stderr.seek(0)
+            stderr = self._stderr.read()
+            self._stderr.close()
+        finally:
+            self._release_slot()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, self.cmd, None, stderr)
+        return subprocess.CompletedProcess(self.cmd, returncode, None, stderr)
+    
+    def discard(self):
+        """Kill ffmpeg if it is still running and delete the replay buffer."""
+        if self._proc is not None and self._proc.poll() is None:
+            self._proc.kill()
+            self._proc.wait()
+        self._release_slot()
+        if not self._buffer.closed:
+            self._buffer.close()
+        if not self._file.closed:
+            self._file.close()
+        self.raw.cleanup()
+
+def decode_to_raw(
     input_path: str,
+    side: int,
+    fps: int,
+    duration: Optional[float] = None,
+    temp_dir: str = '/tmp/packputer'
+) -> Optional[RawVideo]:
+    """
+    Decode, trim, resample to a constant frame rate and scale/pad to side x side once,
+    keeping the result as a lossless yuva420p rawvideo file.
+    Returns None if decoding fails (callers fall back to the original input).
+    """
+    os.makedirs(temp_dir, exist_ok=True)
+    raw_path = os.path.join(
+        temp_dir,
+        f'raw_{int(time.time() * 1000)}_{secrets.token_hex(8)}_{side}_{fps}.yuva'
+    )
+    scale_filter = f"scale='if(gt(iw,ih),{side},-1)':'if(gt(iw,ih),-1,{side})'"
+    pad_filter = f"pad={side}:{side}:(ow-iw)/2:(oh-ih)/2:color=0x00000000@0"
+    cmd = [
+        'ffmpeg',
+        '-i', input_path,
+        '-vf', f"fps={fps},format=yuva420p,{scale_filter},{pad_filter}",
+        '-an',
+        '-f', 'rawvideo',
+        '-pix_fmt', 'yuva420p',
+    ]
+    if duration:
+        cmd += ['-t', str(duration)]
+    cmd += ['-y', raw_path]
+    
+    try:
+        run_ffmpeg(cmd)
+    except subprocess.CalledProcessError as e:
+        print(f"FFmpeg decode error: {e.stderr[-1000:] if e.stderr else e}")
+        if os.path.exists(raw_path):
+            os.unlink(raw_path)
+        return None
+    
+    raw = RawVideo(raw_path, side, side, fps)
+    if raw.frame_count == 0:
+        raw.cleanup()
+        return None
+    return raw
+
+def vp9_output_args(
     out_path: str,
     fps: int,
     crf: int,
-    side: int,
     duration: Optional[float] = None,
     preserve_alpha: bool = True
+) -> List[str]:
+    """FFmpeg output arguments for a constant-quality VP9 sticker encode."""
+    args = [
+        '-c:v', 'libvpx-vp9',
+        '-pix_fmt', 'yuva420p' if preserve_alpha else 'yuv420p',
+        '-auto-alt-ref', '0',
+        '-crf', str(crf),
+        '-b:v', '0',
+        '-an',
+        '-r', str(fps),
+    ]
+    if duration:
+        args += ['-t', str(duration)]
+    return args + ['-y', out_path]
+
+def encode_webm(
+    input_path: Union[str, RawVideo],
+    out_path: str,
+    fps: int,
+    crf: int,
+    side: int,
+    duration: Optional[float] = None,
+    preserve_alpha: bool = True,
+    cancel_event: Optional[threading.Event] = None
 ) -> bool:
     """
     Encode video to WEBM VP9 with specified parameters.
     
     Args:
+        input_path: Media file, or a RawVideo intermediate from decode_to_raw
         preserve_alpha: If True, ensures output has alpha channel (yuva420p)
+        cancel_event: If set while encoding, ffmpeg is killed and False is returned
     """
     try:
         # Check input format
-        _, _, _, _, input_pix_fmt, _ = probe_media(input_path)
-        has_input_alpha = input_pix_fmt and 'yuva' in input_pix_fmt.lower()
+        if isinstance(input_path, RawVideo):
+            input_args = input_path.input_args()
+            has_input_alpha = input_path.pix_fmt in ('yuva420p', 'rgba')
+        else:
+            input_args = ['-i', input_path]
+            _, _, _, _, input_pix_fmt, _ = probe_media(input_path)
+            has_input_alpha = input_pix_fmt and 'yuva' in input_pix_fmt.lower()
         
         # Build filter chain
         scale_filter = f"scale='if(gt(iw,ih),{side},-1)':'if(gt(iw,ih),-1,{side})'"
@@ -88,32 +565,14 @@ def encode_webm(
         # VP9 encoding
         cmd = [
             'ffmpeg',
-            '-i', input_path,
+            *input_args,
             '-vf', vf_chain,
-            '-c:v', 'libvpx-vp9',
-            '-pix_fmt', 'yuva420p' if preserve_alpha else 'yuv420p',
-            '-auto-alt-ref', '0',
-            '-crf', str(crf),
-            '-b:v', '0',
-            '-an',
-            '-r', str(fps),
-            '-y',
-            out_path
+            *vp9_output_args(out_path, fps, crf, duration, preserve_alpha)
         ]
         
-        if duration:
-            # Insert duration before output file
-            cmd.insert(-1, '-t')
-            cmd.insert(-1, str(duration))
-        
         print(f"[encode_webm] FFmpeg command: {' '.join(cmd)}", flush=True)
         
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            check=True
-        )
+        result = run_ffmpeg(cmd, cancel_event)
         
         # Verify output file exists and has correct format
         if not os.path.exists(out_path):
@@ -132,6 +591,11 @@ def encode_webm(
             return False
         
         return True
+    except FFmpegCancelled:
+        print(f"[encode_webm] Cancelled (CRF={crf}, FPS={fps}, Side={side})", flush=True)
+        if os.path.exists(out_path):
+            os.unlink(out_path)
+        return False
     except subprocess.CalledProcessError as e:
         print(f"FFmpeg encode error (CRF={crf}, FPS={fps}, Side={side}):")
         print(f"  Command: {' '.join(cmd)}")
@@ -0,0 +1,193 @@
+"""
+Asynchronous Job Queue
+POST /jobs returns a job id right away; the job runs on an in-process queue
+with a bounded number of workers, and GET /jobs/{id} reports its stage
+(decode, matte, encode attempt k of n, validate) and result.
+"""
+import os
+import time
+import asyncio
+import secrets
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from .executor import WORKER_POOL_SIZE
+from .scheduler import DEFAULT_PRIORITY, current_scope, enter_scope
+from . import progress
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', str(WORKER_POOL_SIZE)))
+JOB_QUEUE_MAX = int(os.getenv('JOB_QUEUE_MAX', '100'))
+# Finished jobs (and their results) stay queryable this long
+JOB_RETENTION_SEC = float(os.getenv('JOB_RETENTION_SEC', '600'))
+
+JobFactory = Callable[[], Awaitable[Dict[str, Any]]]
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, kind: str, factory: JobFactory):
+        self.id = secrets.token_hex(8)
+        self.kind = kind
+        self.factory = factory
+        # Priority of the submitting request, its stage runs are scheduled with it
+        scope = current_scope()
+        self.priority = scope.priority if scope else DEFAULT_PRIORITY
+        self.queue_wait = 0.0
+        self.status = 'queued'  # queued -> running -> done | failed
+        self.stage: Optional[str] = None
+        self.step: Optional[int] = None
+        self.total: Optional[int] = None
+        self.detail: Dict[str, Any] = {}
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        # Bumped on every change, long-poll and SSE clients wait for a newer version
+        self.version = 0
+        self._changed = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ('done', 'failed')
+
+    def _touch(self):
+        self.version += 1
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def set_progress(self, stage: str, step: Optional[int], total: Optional[int], detail: Dict[str, Any]):
+        if self.finished:
+            # Late report from a pool thread
+            return
+        self.stage = stage
+        self.step = step
+        self.total = total
+        self.detail = detail
+        self._touch()
+
+    async def wait_for_change(self, since: int, timeout: float) -> bool:
+        """Wait until version > since (or the job finished). Returns False on timeout."""
+        if self.version > since or self.finished:
+            return True
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {
+            'job_id': self.id,
+            'kind': self.kind,
+            'priority': self.priority,
+            'status': self.status,
+            'version': self.version,
+            'stage': self.stage,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'queue_wait_ms': int(self.queue_wait * 1000),
+        }
+        if self.step is not None:
+            data['step'] = self.step
+        if self.total is not None:
+            data['total'] = self.total
+        if self.detail:
+            data['detail'] = self.detail
+        if self.result is not None:
+            data['result'] = self.result
+        if self.error is not None:
+            data['error'] = self.error
+        return data
+
+
+class JobQueue:
+    def __init__(self, workers: int = JOB_WORKERS, max_queued: int = JOB_QUEUE_MAX):
+        self.workers = max(1, workers)
+        self.max_queued = max_queued
+        self._jobs: Dict[str, Job] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"Started job queue with {self.workers} workers")
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def submit(self, kind: str, factory: JobFactory) -> Job:
+        """Queue a job. Its inputs must already be saved, the request body is gone by the time it runs."""
+        self.start()
+        self._purge()
+        if self._queue.qsize() >= self.max_queued:
+            raise QueueFull(f'Job queue full ({self.max_queued} queued)')
+        job = Job(kind, factory)
+        self._jobs[job.id] = job
+        self._queue.put_nowait(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self._purge()
+        return self._jobs.get(job_id)
+
+    def _purge(self):
+        cutoff = time.time() - JOB_RETENTION_SEC
+        for job_id in [j.id for j in self._jobs.values() if j.finished and j.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            job.status = 'running'
+            job.started_at = time.time()
+            job._touch()
+
+            # Stage code reports from pool threads, hop back onto the loop to update the job
+            def on_progress(stage, step, total, detail, job=job):
+                loop.call_soon_threadsafe(job.set_progress, stage, step, total, detail)
+
+            token = progress.set_callback(on_progress)
+            scope = enter_scope(job.priority)
+            try:
+                job.result = await job.factory()
+                job.status = 'done'
+            except asyncio.CancelledError:
+                job.status = 'failed'
+                job.error = 'Cancelled'
+                raise
+            except Exception as e:
+                logger.error(f"Job {job.id} ({job.kind}) failed: {e}")
+                job.status = 'failed'
+                job.error = str(e)
+            finally:
+                progress.reset_callback(token)
+                job.queue_wait = scope.queue_wait
+                job.finished_at = time.time()
+                job.factory = None
+                job._touch()
+                self._queue.task_done()
+
+    def stats(self) -> Dict[str, Any]:
+        counts: Dict[str, int] = {}
+        for job in self._jobs.values():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            'workers': self.workers,
+            'queued': self._queue.qsize() if self._queue else 0,
+            'jobs': counts,
+        }
+
+
+job_queue = JobQueue()
@@ -1,21 +1,132 @@
 import os
+import json
+import asyncio
 import secrets
 import time
 import logging
-from fastapi import FastAPI, UploadFile, File, Form
-from fastapi.responses import JSONResponse
-from typing import List, Optional
-from .convert import convert_file
-from .batch import batch_convert_files
-from .render import render_animation
+from fastapi import FastAPI, UploadFile, File, Form, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from typing import Callable, List, Optional
+from .convert import convert_file, convert_path, fork_output
+from .batch import BATCH_CONCURRENCY, batch_convert_files, iter_batch_convert
+from .render import RenderSubject, render_animation
 from .sticker_asset import prepareStickerAsset, validate_sticker_asset
 from .quality_gates import validate_image_sticker, validate_video_sticker
 from .animate import animate_from_asset
+from .executor import run_stage, run_releasing, get_stats, shutdown as shutdown_executor
+from .ffmpeg_utils import get_probe_stats
+from .segmentation import get_segmentation_stats
+from .result_cache import RESULT_CACHE_ENABLED, result_cache, cache_key, canonical_json, link_or_copy
+from .singleflight import COALESCE_ENABLED, single_flight
+from .uploads import RequestBodyLimit, SavedUpload, UploadTooLarge, save_upload, get_upload_stats
+from .artifacts import artifacts, run_sweeper
+from .jobs import QueueFull, job_queue
+from .scheduler import DEFAULT_PRIORITY, Overloaded, scheduler, enter_scope, estimate_cost_mb
 
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="PackPuter Worker")
 
+# Longest a single GET /jobs/{id} long-poll may block
+JOB_MAX_WAIT_SEC = 60
+# Most base images in one /sticker/prepare-assets request (largest AI pack)
+ASSET_BATCH_MAX = int(os.getenv('ASSET_BATCH_MAX', '24'))
+# Most blueprints in one /ai/render_pack request, and how many of them render at once
+RENDER_PACK_MAX = int(os.getenv('RENDER_PACK_MAX', '24'))
+RENDER_PACK_CONCURRENCY = int(os.getenv('RENDER_PACK_CONCURRENCY', str(os.cpu_count() or 2)))
+
+# Requests that start stage work go through admission control
+SCHEDULED_PATHS = {
+    '/convert': DEFAULT_PRIORITY,
+    '/batch_convert': 'batch',
+    '/batch_convert/stream': 'batch',
+    '/ai/render': DEFAULT_PRIORITY,
+    '/ai/render_pack': 'batch',
+    '/sticker/prepare-asset': DEFAULT_PRIORITY,
+    '/sticker/prepare-assets': 'batch',
+    '/ai/animate': DEFAULT_PRIORITY,
+    '/jobs': DEFAULT_PRIORITY,
+}
+
+# Most files one request to each upload path may carry, for its body size limit
+REQUEST_MAX_FILES = {
+    **{path: 1 for path in SCHEDULED_PATHS},
+    '/batch_convert': 10,
+    '/batch_convert/stream': 10,
+    '/sticker/prepare-assets': ASSET_BATCH_MAX,
+    '/ai/animate': 2,
+    '/jobs': 2,
+}
+
+# Added before the admission middleware so it runs inside it: requests
+# turned away with 429 never wait for upload budget
+app.add_middleware(RequestBodyLimit, max_files=REQUEST_MAX_FILES)
+
+_sweeper_task: Optional[asyncio.Task] = None
+
+def overloaded_response(e: Overloaded) -> JSONResponse:
+    return JSONResponse(
+        {"error": str(e), "retry_after": e.retry_after},
+        status_code=429,
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+@app.middleware("http")
+async def admission_middleware(request: Request, call_next):
+    """
+    Turn requests away with 429 before reading their body when their priority's
+    queue is full, and report the time they spent queued (X-Queue-Wait-Ms).
+    Priority comes from X-Priority (interactive|batch), defaulting per endpoint.
+    """
+    default_priority = SCHEDULED_PATHS.get(request.url.path)
+    if request.method != 'POST' or default_priority is None:
+        return await call_next(request)
+    
+    scope = enter_scope(request.headers.get('x-priority', default_priority))
+    try:
+        scheduler.check_admission(scope.priority)
+    except Overloaded as e:
+        return overloaded_response(e)
+    
+    response = await call_next(request)
+    response.headers['X-Queue-Wait-Ms'] = str(int(scope.queue_wait * 1000))
+    return response
+
+@app.on_event("startup")
+async def on_startup():
+    global _sweeper_task
+    _sweeper_task = asyncio.create_task(run_sweeper())
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    if _sweeper_task:
+        _sweeper_task.cancel()
+    job_queue.stop()
+    shutdown_executor()
+
+def prepare_and_validate_asset(input_path: str) -> dict:
+    """Prepare a sticker asset and run its quality gate (blocking, runs on the stage pool)."""
+    output_path = prepareStickerAsset(input_path)
+    
+    # Quality gate: Validate prepared asset
+    try:
+        from PIL import Image
+        img = Image.open(output_path)
+        validate_sticker_asset(img)
+        is_valid = True
+        violations = []
+    except Exception as e:
+        is_valid = False
+        violations = [str(e)]
+        logger.warning(f"Asset validation failed: {e}")
+    
+    return {
+        "output_path": output_path,
+        "status": "success" if is_valid else "warning",
+        "validated": is_valid,
+        "violations": violations if not is_valid else []
+    }
+
 @app.post("/convert")
 async def convert_endpoint(
     file: UploadFile = File(...),
@@ -30,6 +141,11 @@ async def convert_endpoint(
             "output_path": output_path,
             **metadata
         })
+    except UploadTooLarge as e:
+        return JSONResponse(
+            {"error": str(e)},
+            status_code=413
+        )
     except Exception as e:
         return JSONResponse(
             {"error": str(e)},
@@ -60,11 +176,285 @@ async def batch_convert_endpoint(
         return JSONResponse({
             "items": items
         })
+    except UploadTooLarge as e:
+        return JSONResponse(
+            {"error": str(e)},
+            status_code=413
+        )
+    except Exception as e:
+        return JSONResponse(
+            {"error": str(e)},
+            status_code=500
+        )
+
+@app.post("/batch_convert/stream")
+async def batch_convert_stream_endpoint(
+    files: List[UploadFile] = File(...)
+):
+    """
+    Convert multiple files to stickers, streaming each result as NDJSON
+    as soon as it is done (completion order, with its input index).
+    """
+    if len(files) > 10:
+        return JSONResponse(
+            {"error": "Maximum 10 files allowed"},
+            status_code=400
+        )
+    
+    try:
+        results = await iter_batch_convert(files, max_files=10)
+    except UploadTooLarge as e:
+        return JSONResponse(
+            {"error": str(e)},
+            status_code=413
+        )
     except Exception as e:
         return JSONResponse(
             {"error": str(e)},
             status_code=500
         )
+    
+    async def ndjson():
+        count = 0
+        async for item in results:
+            count += 1
+            yield json.dumps(item) + "\n"
+        yield json.dumps({"done": True, "count": count}) + "\n"
+    
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+def render_cost_mb(blueprint_json: str) -> float:
+    """Scheduler cost of a render, from the blueprint's duration and fps."""
+    try:
+        blueprint = json.loads(blueprint_json)
+        return estimate_cost_mb('render', duration=float(blueprint.get('duration_sec', 3.0)),
+                                fps=float(blueprint.get('fps', 30)))
+    except (TypeError, ValueError, AttributeError):
+        return estimate_cost_mb('render', duration=3.0, fps=30)
+
+async def render_upload(upload: SavedUpload, blueprint_json: str) -> dict:
+    """Render a saved base image, removing it once nothing reads it any more."""
+    return await render_saved(upload, blueprint_json, release=lambda: artifacts.discard(upload.path))
+
+async def render_saved(
+    upload: SavedUpload,
+    blueprint_json: str,
+    subject: Optional[RenderSubject] = None,
+    release: Optional[Callable[[], None]] = None
+) -> dict:
+    """
+    Render a saved base image (cached and coalesced). release, if given, is
+    called once the render reading the upload has finished, even if this caller
+    goes away first; otherwise the input is left in place.
+    """
+    release = release or (lambda: None)
+    handed_off = False
+    try:
+        # Create output path in shared volume with unique name
+        temp_dir = '/tmp/packputer'
+        os.makedirs(temp_dir, exist_ok=True)
+        timestamp = int(time.time() * 1000)
+        temp_output = os.path.join(temp_dir, f'ai_output_{timestamp}_{secrets.token_hex(8)}.webm')
+        
+        # Same image + blueprint renders the same sticker
+        key = None
+        if RESULT_CACHE_ENABLED or COALESCE_ENABLED:
+            key = cache_key('render', upload.sha256, {'blueprint': canonical_json(blueprint_json)})
+        
+        if key and RESULT_CACHE_ENABLED:
+            metadata = result_cache.get(key, temp_output)
+            if metadata is not None:
+                artifacts.hand_off(temp_output)
+                return {
+                    "output_path": temp_output,
+                    **metadata,
+                    "cached": True
+                }
+        
+        # Render
+        async def render():
+            metadata = await run_stage('render', render_animation, upload.path, blueprint_json, temp_output,
+                                       subject=subject, cost_mb=render_cost_mb(blueprint_json))
+            if key and RESULT_CACHE_ENABLED:
+                result_cache.put(key, temp_output, metadata)
+            return temp_output, metadata
+        
+        # From here the input is released by whoever runs the render
+        handed_off = True
+        if key and COALESCE_ENABLED:
+            temp_output, metadata = await single_flight.run(key, render, fork_output, release)
+        else:
+            temp_output, metadata = await run_releasing(render, release)
+        artifacts.hand_off(temp_output)
+        
+        return {
+            "output_path": temp_output,
+            **metadata
+        }
+    finally:
+        # Cleanup input (cache hit or failure before the render started)
+        if not handed_off:
+            release()
+
+def parse_pack_blueprints(blueprints_json: str) -> List[str]:
+    """Blueprint JSON strings from a JSON list of blueprint objects (or strings)."""
+    blueprints = json.loads(blueprints_json)
+    if not isinstance(blueprints, list) or not blueprints:
+        raise ValueError('blueprints_json must be a non-empty JSON list')
+    if len(blueprints) > RENDER_PACK_MAX:
+        raise ValueError(f'Maximum {RENDER_PACK_MAX} blueprints allowed')
+    return [b if isinstance(b, str) else json.dumps(b) for b in blueprints]
+
+async def iter_render_pack(upload: SavedUpload, subject: RenderSubject, blueprints: List[str]):
+    """
+    Render every blueprint of a pack against one base image, yielding
+    {index, output_path, ...} or {index, error} as each sticker finishes.
+    All renders share the loaded subject and its transformed layers.
+    The upload is removed once every render is done.
+    """
+    semaphore = asyncio.Semaphore(max(1, RENDER_PACK_CONCURRENCY))
+    
+    async def render(index: int, blueprint_json: str) -> dict:
+        async with semaphore:
+            try:
+                return {"index": index, **await render_saved(upload, blueprint_json, subject)}
+            except Exception as e:
+                logger.error(f"Error rendering pack sticker {index}: {e}")
+                return {"index": index, "error": str(e)}
+    
+    tasks = [asyncio.create_task(render(i, b)) for i, b in enumerate(blueprints)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # Client went away: stop renders that haven't finished
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        artifacts.discard(upload.path)
+
+async def prepare_asset_upload(upload: SavedUpload) -> dict:
+    """Prepare and validate a saved base image, removing it afterwards."""
+    try:
+        cost_mb = await asyncio.to_thread(estimate_cost_mb, 'prepare_asset', upload.path)
+        result = await run_stage('prepare_asset', prepare_and_validate_asset, upload.path, cost_mb=cost_mb)
+    finally:
+        artifacts.discard(upload.path)
+    artifacts.hand_off(result['output_path'])
+    return result
+
+async def prepare_asset_batch(files: List[UploadFile]) -> dict:
+    """
+    Prepare a pack's base images in one request. Byte-identical uploads are prepared
+    once; every item still gets its own output file. Returns a manifest in upload order.
+    """
+    if len(files) > ASSET_BATCH_MAX:
+        raise ValueError(f'Maximum {ASSET_BATCH_MAX} files allowed')
+    
+    uploads = []
+    try:
+        for file in files:
+            uploads.append(await save_upload(file, prefix='asset_input', default_suffix='.png'))
+    except BaseException:
+        for upload in uploads:
+            artifacts.discard(upload.path)
+        raise
+    
+    # First upload of each hash is prepared, duplicates are dropped right away
+    unique = {}
+    for upload in uploads:
+        if upload.sha256 in unique:
+            artifacts.discard(upload.path)
+        else:
+            unique[upload.sha256] = upload
+    
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    
+    async def prepare(upload: SavedUpload) -> dict:
+        async with semaphore:
+            try:
+                return await prepare_asset_upload(upload)
+            except Exception as e:
+                logger.error(f"Error preparing sticker asset {upload.sha256[:12]}: {e}")
+                return {"error": str(e)}
+    
+    prepared = dict(zip(unique, await asyncio.gather(*(prepare(u) for u in unique.values()))))
+    
+    items = []
+    served = set()
+    for index, (file, upload) in enumerate(zip(files, uploads)):
+        result = prepared[upload.sha256]
+        item = {"index": index, "filename": file.filename, "sha256": upload.sha256}
+        if "error" in result:
+            items.append({**item, "error": result["error"]})
+            continue
+        output_path = result["output_path"]
+        deduplicated = upload.sha256 in served
+        if deduplicated:
+            # The bot may delete each asset after use, so duplicates get their own file
+            output_path = os.path.join('/tmp/packputer', f'asset_{int(time.time() * 1000)}_{secrets.token_hex(8)}.png')
+            link_or_copy(result["output_path"], output_path)
+            artifacts.hand_off(output_path)
+        served.add(upload.sha256)
+        items.append({**item, **result, "output_path": output_path, "deduplicated": deduplicated})
+    
+    return {
+        "items": items,
+        "count": len(items),
+        "prepared": len(unique),
+        "failed": sum(1 for item in items if "error" in item),
+    }
+
+async def save_animate_uploads(prepared_asset: UploadFile, raw_video: UploadFile) -> tuple[str, str, str]:
+    """Save the prepared asset and raw i2v video, returns (asset_path, video_path, output_path)."""
+    temp_dir = '/tmp/packputer'
+    os.makedirs(temp_dir, exist_ok=True)
+    
+    timestamp = int(time.time() * 1000)
+    unique_id = secrets.token_hex(8)
+    asset_path = os.path.join(temp_dir, f'asset_{timestamp}_{unique_id}.png')
+    video_path = os.path.join(temp_dir, f'raw_video_{timestamp}_{unique_id}.mp4')
+    output_path = os.path.join(temp_dir, f'animated_{timestamp}_{unique_id}.webm')
+    try:
+        await save_upload(prepared_asset, path=asset_path)
+        await save_upload(raw_video, path=video_path)
+    except BaseException:
+        artifacts.discard(asset_path)
+        raise
+    return asset_path, video_path, output_path
+
+async def animate_uploads(
+    asset_path: str,
+    video_path: str,
+    output_path: str,
+    template_id: str,
+    duration_sec: float,
+    fps: int
+) -> dict:
+    """Animate saved uploads into a sticker, removing them afterwards."""
+    try:
+        # Process animation
+        cost_mb = await asyncio.to_thread(estimate_cost_mb, 'animate', video_path, duration_sec, fps)
+        metadata = await run_stage(
+            'animate',
+            animate_from_asset,
+            asset_path,
+            video_path,
+            template_id,
+            output_path,
+            duration_sec,
+            fps,
+            cost_mb=cost_mb
+        )
+    finally:
+        artifacts.discard(asset_path)
+        artifacts.discard(video_path)
+    artifacts.hand_off(output_path)
+    
+    return {
+        "output_path": output_path,
+        **metadata
+    }
 
 @app.post("/ai/render")
 async def ai_render_endpoint(
@@ -73,45 +463,67 @@ async def ai_render_endpoint(
 ):
     """Render animated sticker from base image and blueprint."""
     try:
-        # Save base image temporarily
-        temp_input = None
-        temp_output = None
-        try:
-            # Use shared volume for bot access
-            temp_dir = '/tmp/packputer'
-            os.makedirs(temp_dir, exist_ok=True)
-            
-            suffix = os.path.splitext(base_image.filename or 'input')[1] or '.png'
-            # Use timestamp + 8 bytes (16 hex chars) for better uniqueness
-            timestamp = int(time.time() * 1000)
-            temp_input = os.path.join(temp_dir, f'ai_input_{timestamp}_{secrets.token_hex(8)}{suffix}')
-            with open(temp_input, 'wb') as tmp:
-                await base_image.seek(0)
-                content = await base_image.read()
-                tmp.write(content)
-            
-            # Create output path in shared volume with unique name
-            temp_output = os.path.join(temp_dir, f'ai_output_{timestamp}_{secrets.token_hex(8)}.webm')
-            
-            # Render
-            metadata = render_animation(temp_input, blueprint_json, temp_output)
-            
-            return JSONResponse({
-                "output_path": temp_output,
-                **metadata
-            })
-        finally:
-            # Cleanup input
-            if temp_input and os.path.exists(temp_input):
-                try:
-                    os.unlink(temp_input)
-                except:
-                    pass
+        upload = await save_upload(base_image, prefix='ai_input', default_suffix='.png')
+        return JSONResponse(await render_upload(upload, blueprint_json))
+    except UploadTooLarge as e:
+        return JSONResponse(
+            {"error": str(e)},
+            status_code=413
+        )
+    except Exception as e:
+        return JSONResponse(
+            {"error": str(e)},
+            status_code=500
+        )
+
+@app.post("/ai/render_pack")
+async def ai_render_pack_endpoint(
+    base_image: UploadFile = File(...),
+    blueprints_json: str = Form(...)
+):
+    """
+    Render a pack's stickers from one base image and a JSON list of blueprints.
+    Streams NDJSON: one line per sticker as it finishes, then {"done": true, "count": n}.
+    """
+    try:
+        blueprints = parse_pack_blueprints(blueprints_json)
+    except ValueError as e:
+        return JSONResponse(
+            {"error": str(e)},
+            status_code=400
+        )
+    
+    try:
+        upload = await save_upload(base_image, prefix='ai_input', default_suffix='.png')
+    except UploadTooLarge as e:
+        return JSONResponse(
+            {"error": str(e)},
+            status_code=413
+        )
     except Exception as e:
         return JSONResponse(
             {"error": str(e)},
             status_code=500
         )
+    
+    # Loaded once for the whole pack
+    try:
+        subject = await asyncio.to_thread(RenderSubject.load, upload.path)
+    except Exception as e:
+        artifacts.discard(upload.path)
+        return JSONResponse(
+            {"error": f"Invalid base image: {e}"},
+            status_code=400
+        )
+    
+    async def ndjson():
+        count = 0
+        async for item in iter_render_pack(upload, subject, blueprints):
+            count += 1
+            yield json.dumps(item) + "\n"
+        yield json.dumps({"done": True, "count": count}) + "\n"
+    
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
 
 @app.post("/sticker/prepare-asset")
 async def prepare_asset_endpoint(
@@ -120,39 +532,15 @@ async def prepare_asset_endpoint(
     """Prepare a base image into a Telegram-ready sticker asset."""
     try:
         # Save uploaded file temporarily
-        temp_dir = '/tmp/packputer'
-        os.makedirs(temp_dir, exist_ok=True)
+        upload = await save_upload(base_image, prefix='asset_input', default_suffix='.png')
         
-        suffix = os.path.splitext(base_image.filename or 'input')[1] or '.png'
-        timestamp = int(time.time() * 1000)
-        temp_input = os.path.join(temp_dir, f'asset_input_{timestamp}_{secrets.token_hex(8)}{suffix}')
-        
-        with open(temp_input, 'wb') as tmp:
-            await base_image.seek(0)
-            content = await base_image.read()
-            tmp.write(content)
-        
-        # Prepare asset
-        output_path = prepareStickerAsset(temp_input)
-        
-        # Quality gate: Validate prepared asset
-        try:
-            from PIL import Image
-            img = Image.open(output_path)
-            validate_sticker_asset(img)
-            is_valid = True
-            violations = []
-        except Exception as e:
-            is_valid = False
-            violations = [str(e)]
-            logger.warning(f"Asset validation failed: {e}")
-        
-        return JSONResponse({
-            "output_path": output_path,
-            "status": "success" if is_valid else "warning",
-            "validated": is_valid,
-            "violations": violations if not is_valid else []
-        })
+        # Prepare asset and validate it
+        return JSONResponse(await prepare_asset_upload(upload))
+    except UploadTooLarge as e:
+        return JSONResponse(
+            {"error": str(e)},
+            status_code=413
+        )
     except Exception as e:
         logger.error(f"Error preparing sticker asset: {e}")
         return JSONResponse(
@@ -160,6 +548,31 @@ async def prepare_asset_endpoint(
             status_code=500
         )
 
+@app.post("/sticker/prepare-assets")
+async def prepare_assets_endpoint(
+    base_images: List[UploadFile] = File(...)
+):
+    """Prepare several base images (e.g. a whole AI pack) into sticker assets."""
+    try:
+        if len(base_images) > ASSET_BATCH_MAX:
+            return JSONResponse(
+                {"error": f"Maximum {ASSET_BATCH_MAX} files allowed"},
+                status_code=400
+            )
+        
+        return JSONResponse(await prepare_asset_batch(base_images))
+    except UploadTooLarge as e:
+        return JSONResponse(
+            {"error": str(e)},
+            status_code=413
+        )
+    except Exception as e:
+        logger.error(f"Error preparing sticker assets: {e}")
+        return JSONResponse(
+            {"error": str(e)},
+            status_code=500
+        )
+
 @app.post("/ai/animate")
 async def ai_animate_endpoint(
     prepared_asset: UploadFile = File(...),
@@ -173,41 +586,13 @@ async def ai_animate_endpoint(
     Applies matting, encoding, and quality gates.
     """
     try:
-        temp_dir = '/tmp/packputer'
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        timestamp = int(time.time() * 1000)
-        unique_id = secrets.token_hex(8)
-        
-        # Save uploaded files
-        asset_path = os.path.join(temp_dir, f'asset_{timestamp}_{unique_id}.png')
-        video_path = os.path.join(temp_dir, f'raw_video_{timestamp}_{unique_id}.mp4')
-        output_path = os.path.join(temp_dir, f'animated_{timestamp}_{unique_id}.webm')
-        
-        with open(asset_path, 'wb') as f:
-            await prepared_asset.seek(0)
-            content = await prepared_asset.read()
-            f.write(content)
-        
-        with open(video_path, 'wb') as f:
-            await raw_video.seek(0)
-            content = await raw_video.read()
-            f.write(content)
-        
-        # Process animation
-        metadata = animate_from_asset(
-            asset_path,
-            video_path,
-            template_id,
-            output_path,
-            duration_sec,
-            fps
+        paths = await save_animate_uploads(prepared_asset, raw_video)
+        return JSONResponse(await animate_uploads(*paths, template_id, duration_sec, fps))
+    except UploadTooLarge as e:
+        return JSONResponse(
+            {"error": str(e)},
+            status_code=413
         )
-        
-        return JSONResponse({
-            "output_path": output_path,
-            **metadata
-        })
     except Exception as e:
         logger.error(f"Error in ai_animate: {e}", exc_info=True)
         return JSONResponse(
@@ -215,8 +600,125 @@ async def ai_animate_endpoint(
             status_code=500
         )
 
+@app.post("/jobs")
+async def submit_job_endpoint(
+    kind: str = Form(...),
+    file: Optional[UploadFile] = File(None),
+    prefer_seconds: float = Form(2.8),
+    pad_mode: str = Form("transparent"),
+    base_image: Optional[UploadFile] = File(None),
+    blueprint_json: Optional[str] = Form(None),
+    prepared_asset: Optional[UploadFile] = File(None),
+    raw_video: Optional[UploadFile] = File(None),
+    template_id: Optional[str] = Form(None),
+    duration_sec: float = Form(2.6),
+    fps: int = Form(24)
+):
+    """
+    Queue a convert, render, prepare_asset or animate job and return its id
+    right away. Takes the same fields as the synchronous endpoint of that kind.
+    """
+    saved: List[str] = []
+    submitted = False
+    try:
+        if kind == 'convert' and file:
+            upload = await save_upload(file)
+            saved = [upload.path]
+            async def run():
+                output_path, metadata = await convert_path(upload.path, prefer_seconds, pad_mode, upload.sha256)
+                return {"output_path": output_path, **metadata}
+        elif kind == 'render' and base_image and blueprint_json:
+            upload = await save_upload(base_image, prefix='ai_input', default_suffix='.png')
+            saved = [upload.path]
+            async def run():
+                return await render_upload(upload, blueprint_json)
+        elif kind == 'prepare_asset' and base_image:
+            upload = await save_upload(base_image, prefix='asset_input', default_suffix='.png')
+            saved = [upload.path]
+            async def run():
+                return await prepare_asset_upload(upload)
+        elif kind == 'animate' and prepared_asset and raw_video and template_id:
+            paths = await save_animate_uploads(prepared_asset, raw_video)
+            saved = list(paths[:2])
+            async def run():
+                return await animate_uploads(*paths, template_id, duration_sec, fps)
+        else:
+            return JSONResponse(
+                {"error": f"Unknown job kind or missing fields for '{kind}'"},
+                status_code=400
+            )
+        
+        job = job_queue.submit(kind, run)
+        submitted = True
+        return JSONResponse(job.to_dict(), status_code=202)
+    except UploadTooLarge as e:
+        return JSONResponse(
+            {"error": str(e)},
+            status_code=413
+        )
+    except QueueFull as e:
+        return overloaded_response(Overloaded(scheduler.retry_after()))
+    except Exception as e:
+        return JSONResponse(
+            {"error": str(e)},
+            status_code=500
+        )
+    finally:
+        # Uploads of a job that never got queued are nobody's to clean up
+        if not submitted:
+            for path in saved:
+                artifacts.discard(path)
+
+@app.get("/jobs/{job_id}")
+async def get_job_endpoint(job_id: str, wait: float = 0, since: int = -1):
+    """
+    Job status, stage and result. Long-poll with wait=<seconds>: returns as soon
+    as the job changes past version `since` (or finishes), or when wait runs out.
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return JSONResponse({"error": "Job not found"}, status_code=404)
+    if wait > 0:
+        await job.wait_for_change(since, min(wait, JOB_MAX_WAIT_SEC))
+    return JSONResponse(job.to_dict())
+
+@app.get("/jobs/{job_id}/events")
+async def job_events_endpoint(job_id: str):
+    """Server-sent events: one `data:` snapshot per job change, until it finishes."""
+    job = job_queue.get(job_id)
+    if job is None:
+        return JSONResponse({"error": "Job not found"}, status_code=404)
+    
+    async def events():
+        version = -1
+        while True:
+            if not await job.wait_for_change(version, 15):
+                # Keep idle proxies from closing the stream
+                yield ": keepalive\n\n"
+                continue
+            version = job.version
+            yield f"data: {json.dumps(job.to_dict())}\n\n"
+            if job.finished:
+                break
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
+
 @app.get("/health")
 async def health():
     """Health check endpoint."""
     return {"status": "ok"}
 
+@app.get("/stats")
+async def stats():
+    """Per-stage queue depth and counters."""
+    return {
+        **get_stats(),
+        'probe': get_probe_stats(),
+        'result_cache': result_cache.stats(),
+        'coalescing': single_flight.stats(),
+        'uploads': get_upload_stats(),
+        'artifacts': artifacts.stats(),
+        'jobs': job_queue.stats(),
+        'segmentation': get_segmentation_stats(),
+    }
+
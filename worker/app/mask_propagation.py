@@ -0,0 +1,140 @@
+"""
+Keyframe Mask Propagation
+i2v clips have a mostly static subject, so full segmentation only runs on
+keyframes: every MATTE_KEYFRAME_INTERVAL frames, or sooner when a frame stops
+matching its keyframe. Frames in between reuse the keyframe's mask, shifted by
+the global motion found with phase correlation on small grayscale thumbnails.
+Reusing one mask across a run of frames also removes alpha flicker.
+"""
+import os
+import numpy as np
+from PIL import Image
+from typing import List, NamedTuple, Optional, Tuple
+
+MATTE_KEYFRAMES = os.getenv('MATTE_KEYFRAMES', 'true').lower() == 'true'
+# Longest run of frames sharing one keyframe's mask
+MATTE_KEYFRAME_INTERVAL = int(os.getenv('MATTE_KEYFRAME_INTERVAL', '10'))
+# Mean absolute difference (0-1) between a frame and its motion-compensated
+# keyframe above which the frame is segmented itself
+MATTE_KEYFRAME_DIFF = float(os.getenv('MATTE_KEYFRAME_DIFF', '0.04'))
+# Phase correlation peak below which the motion estimate is not trusted
+MATTE_MIN_PEAK = float(os.getenv('MATTE_MIN_PEAK', '0.15'))
+
+THUMB_SIZE = 128
+
+
+class FramePlan(NamedTuple):
+    """Keyframe whose mask a frame uses, and the shift (in thumbnail pixels) to apply to it."""
+    index: int
+    keyframe: int
+    dy: float
+    dx: float
+
+    @property
+    def is_keyframe(self) -> bool:
+        return self.index == self.keyframe
+
+
+_window: Optional[np.ndarray] = None
+
+
+def thumbnail(frame: np.ndarray) -> np.ndarray:
+    """Grayscale THUMB_SIZE x THUMB_SIZE float thumbnail (0-1) of an RGB(A) frame."""
+    img = Image.fromarray(frame[:, :, :3]).convert('L').resize((THUMB_SIZE, THUMB_SIZE), Image.BILINEAR, reducing_gap=2.0)
+    return np.asarray(img, dtype=np.float32) / 255.0
+
+
+def _hann() -> np.ndarray:
+    global _window
+    if _window is None:
+        w = np.hanning(THUMB_SIZE).astype(np.float32)
+        _window = np.outer(w, w)
+    return _window
+
+
+def phase_correlate(reference: np.ndarray, frame: np.ndarray) -> Tuple[float, float, float]:
+    """(dy, dx, peak): shift that moves reference onto frame, and how sharp the correlation peak is (0-1)."""
+    window = _hann()
+    a = np.fft.rfft2((reference - reference.mean()) * window)
+    b = np.fft.rfft2((frame - frame.mean()) * window)
+    cross = b * np.conj(a)
+    cross /= np.maximum(np.abs(cross), 1e-9)
+    corr = np.fft.irfft2(cross, s=reference.shape)
+
+    peak_y, peak_x = np.unravel_index(int(np.argmax(corr)), corr.shape)
+    peak = float(corr[peak_y, peak_x])
+
+    def refine(c_minus: float, c0: float, c_plus: float) -> float:
+        # Parabola through the peak and its neighbours
+        denom = c_minus - 2 * c0 + c_plus
+        return 0.5 * (c_minus - c_plus) / denom if denom else 0.0
+
+    h, w = corr.shape
+    dy = peak_y + refine(corr[peak_y - 1, peak_x], peak, corr[(peak_y + 1) % h, peak_x])
+    dx = peak_x + refine(corr[peak_y, peak_x - 1], peak, corr[peak_y, (peak_x + 1) % w])
+    # Wrap to signed shifts
+    if dy > h / 2:
+        dy -= h
+    if dx > w / 2:
+        dx -= w
+    return float(dy), float(dx), peak
+
+
+def shift_image(img: np.ndarray, dy: int, dx: int) -> np.ndarray:
+    """Integer shift with zero fill (no wrap-around)."""
+    out = np.zeros_like(img)
+    h, w = img.shape[:2]
+    if abs(dy) >= h or abs(dx) >= w:
+        return out
+    src_y = slice(max(0, -dy), h - max(0, dy))
+    dst_y = slice(max(0, dy), h - max(0, -dy))
+    src_x = slice(max(0, -dx), w - max(0, dx))
+    dst_x = slice(max(0, dx), w - max(0, -dx))
+    out[dst_y, dst_x] = img[src_y, src_x]
+    return out
+
+
+class KeyframePlanner:
+    """Decides frame by frame whether to segment or to propagate the last keyframe's mask."""
+    def __init__(
+        self,
+        interval: int = MATTE_KEYFRAME_INTERVAL,
+        max_diff: float = MATTE_KEYFRAME_DIFF,
+        min_peak: float = MATTE_MIN_PEAK
+    ):
+        self.interval = max(1, interval)
+        self.max_diff = max_diff
+        self.min_peak = min_peak
+        self._key_index = -1
+        self._key_thumb: Optional[np.ndarray] = None
+        self.plan: List[FramePlan] = []
+
+    def add(self, thumb: np.ndarray) -> FramePlan:
+        index = len(self.plan)
+        entry = None
+        if self._key_thumb is not None and index - self._key_index < self.interval:
+            dy, dx, peak = phase_correlate(self._key_thumb, thumb)
+            if peak >= self.min_peak:
+                # Confidence check: the shifted keyframe has to actually match the frame
+                shifted = shift_image(self._key_thumb, int(round(dy)), int(round(dx)))
+                valid = shift_image(np.ones_like(thumb), int(round(dy)), int(round(dx))) > 0
+                if valid.any() and float(np.abs(shifted - thumb)[valid].mean()) <= self.max_diff:
+                    entry = FramePlan(index, self._key_index, dy, dx)
+        if entry is None:
+            self._key_index = index
+            self._key_thumb = thumb
+            entry = FramePlan(index, index, 0.0, 0.0)
+        self.plan.append(entry)
+        return entry
+
+    @property
+    def keyframes(self) -> List[int]:
+        return sorted({p.keyframe for p in self.plan})
+
+
+def propagate_mask(mask: np.ndarray, entry: FramePlan) -> np.ndarray:
+    """A keyframe mask moved by a plan entry's shift, scaled from thumbnail to frame size."""
+    if entry.is_keyframe:
+        return mask
+    h, w = mask.shape
+    return shift_image(mask, int(round(entry.dy * h / THUMB_SIZE)), int(round(entry.dx * w / THUMB_SIZE)))
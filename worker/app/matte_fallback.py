@@ -0,0 +1,104 @@
+"""
+NumPy Matting Fallback
+Used when no segmentation model is installed. i2v clips usually sit on a flat
+backdrop, so the key colour is sampled from the border of the first frames and
+a chroma keyer (luma keyer for white/grey/black backdrops) runs on whole frame
+stacks inside the streaming matte pass. Clips without a flat border get a
+static radial mask, built once per resolution.
+"""
+import os
+import logging
+import numpy as np
+from functools import lru_cache
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Colour distance (0-1) below which a pixel is fully keyed out, and the ramp above it
+KEY_SIMILARITY = float(os.getenv('KEY_SIMILARITY', '0.12'))
+KEY_BLEND = float(os.getenv('KEY_BLEND', '0.08'))
+# Share of border pixels that must match the sampled colour to trust the keyer
+KEY_MIN_BORDER_MATCH = float(os.getenv('KEY_MIN_BORDER_MATCH', '0.6'))
+# Key colours with less chroma than this (0-255 scale) are keyed on luma as well
+KEY_GRAY_CHROMA = 20.0
+KEY_BORDER = 4
+KEY_CHUNK = 8  # Frames converted to float at once
+
+
+@lru_cache(maxsize=8)
+def radial_alpha(h: int, w: int) -> np.ndarray:
+    """Distance-based alpha that fades towards the edges (cached per resolution, read-only)."""
+    center_y, center_x = h // 2, w // 2
+    y, x = np.ogrid[:h, :w]
+    dist_from_center = np.sqrt((x - center_x)**2 + (y - center_y)**2)
+    max_dist = np.sqrt(center_x**2 + center_y**2)
+    alpha_mask = (1 - dist_from_center / max_dist * 0.3).clip(0, 1)
+    alpha = (alpha_mask * 255).astype(np.uint8)
+    alpha.flags.writeable = False
+    return alpha
+
+
+def _ycbcr(rgb: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """BT.601 Y, Cb, Cr (Cb/Cr centred on 0) of uint8 RGB, as float32."""
+    r = rgb[..., 0].astype(np.float32)
+    g = rgb[..., 1].astype(np.float32)
+    b = rgb[..., 2].astype(np.float32)
+    y = 0.299 * r + 0.587 * g + 0.114 * b
+    cb = -0.168736 * r - 0.331264 * g + 0.5 * b
+    cr = 0.5 * r - 0.418688 * g - 0.081312 * b
+    return y, cb, cr
+
+
+def _border(stack: np.ndarray) -> np.ndarray:
+    """RGB pixels of a KEY_BORDER wide ring around every frame of a (N, H, W, C) stack."""
+    k = KEY_BORDER
+    return np.concatenate([
+        stack[:, :k, :, :3].reshape(-1, 3),
+        stack[:, -k:, :, :3].reshape(-1, 3),
+        stack[:, k:-k, :k, :3].reshape(-1, 3),
+        stack[:, k:-k, -k:, :3].reshape(-1, 3),
+    ])
+
+
+class ClipKeyer:
+    """Alpha for a clip's frames: chroma/luma key on a sampled colour, or the radial mask."""
+    def __init__(self, key: Optional[Tuple[int, int, int]]):
+        self.key = key
+        if key is not None:
+            y, cb, cr = _ycbcr(np.array(key, dtype=np.uint8))
+            self._y, self._cb, self._cr = float(y), float(cb), float(cr)
+            self.luma = (self._cb ** 2 + self._cr ** 2) ** 0.5 < KEY_GRAY_CHROMA
+
+    @classmethod
+    def sample(cls, stack: np.ndarray) -> 'ClipKeyer':
+        """Pick the key colour from the border of a (N, H, W, C) frame stack."""
+        if min(stack.shape[1:3]) <= 4 * KEY_BORDER:
+            return cls(None)
+        border = _border(stack)
+        key = tuple(int(v) for v in np.median(border, axis=0))
+        keyer = cls(key)
+        match = float((keyer._distance(border) <= KEY_SIMILARITY + KEY_BLEND).mean())
+        if match < KEY_MIN_BORDER_MATCH:
+            logger.info(f"Border is not a flat backdrop ({match:.0%} match), using radial mask")
+            return cls(None)
+        logger.info(f"Keying on sampled backdrop colour {key} ({'luma' if keyer.luma else 'chroma'}, {match:.0%} border match)")
+        return keyer
+
+    def _distance(self, rgb: np.ndarray) -> np.ndarray:
+        y, cb, cr = _ycbcr(rgb)
+        d = (cb - self._cb) ** 2 + (cr - self._cr) ** 2
+        if self.luma:
+            d += (y - self._y) ** 2
+        return np.sqrt(d) / 255.0
+
+    def alpha(self, stack: np.ndarray) -> np.ndarray:
+        """(N, H, W) uint8 alpha for a (N, H, W, C) stack."""
+        n, h, w = stack.shape[:3]
+        if self.key is None:
+            return np.broadcast_to(radial_alpha(h, w), (n, h, w))
+        out = np.empty((n, h, w), dtype=np.uint8)
+        for i in range(0, n, KEY_CHUNK):
+            ramp = (self._distance(stack[i:i + KEY_CHUNK]) - KEY_SIMILARITY) / KEY_BLEND
+            np.clip(ramp, 0.0, 1.0, out=ramp)
+            out[i:i + KEY_CHUNK] = (ramp * 255 + 0.5).astype(np.uint8)
+        return out
@@ -0,0 +1,34 @@
+"""
+Stage Progress Reporting
+Pipeline code reports what it is doing (decode, matte, encode attempt k of n,
+validate) through report(); whoever runs the job installs a callback. With no
+callback installed (plain synchronous requests) reporting is a no-op.
+"""
+import contextvars
+from typing import Any, Callable, Optional
+
+ProgressCallback = Callable[..., None]
+
+# Copied into stage pool threads by executor.run_stage
+_callback: contextvars.ContextVar[Optional[ProgressCallback]] = contextvars.ContextVar('progress_callback', default=None)
+
+
+def set_callback(callback: Optional[ProgressCallback]) -> contextvars.Token:
+    """Install a callback for the current context (the job's task)."""
+    return _callback.set(callback)
+
+
+def reset_callback(token: contextvars.Token):
+    _callback.reset(token)
+
+
+def report(stage: str, step: Optional[int] = None, total: Optional[int] = None, **detail: Any):
+    """Report the current stage, e.g. report('encode', step=2, total=5, crf=38)."""
+    callback = _callback.get()
+    if callback is None:
+        return
+    try:
+        callback(stage, step, total, detail)
+    except Exception:
+        # Progress must never break the pipeline
+        pass
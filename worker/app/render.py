@@ -1,26 +1,143 @@
 import os
+import math
 import json
 import time
 import secrets
 import shutil
 import subprocess
 import logging
-from PIL import Image, ImageDraw, ImageFont
+import threading
+from collections import OrderedDict
+from PIL import Image
 import numpy as np
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 from .blueprint import parse_blueprint, validate_blueprint, enhance_blueprint_with_sticker_grade_motion
-from .sizefit import fit_to_limits
+from .sizefit import fit_raw_to_limits, seed_output_args
 from .quality_gates import validate_video_sticker, auto_retry_tuning, ValidationViolation
+from .ffmpeg_utils import RawFrameSink, probe_media, run_ffmpeg
+from .text_layer import caption_layer, caption_origin_x
+from .compositor import FrameCompositor, Layer, premultiply, solid_disc
+from .progress import report
 
 logger = logging.getLogger(__name__)
 
+# Transformed subject layers kept per base image (each up to ~4MB at 512x512)
+SPRITE_CACHE_SIZE = int(os.getenv('SPRITE_CACHE_SIZE', '96'))
+
+def _period_to_frames(period_sec: float, fps: int) -> Optional[int]:
+    """Period in whole frames, or None if it doesn't land on a frame boundary."""
+    frames = period_sec * fps
+    rounded = int(round(frames))
+    if rounded <= 0 or abs(frames - rounded) > 1e-6:
+        return None
+    return rounded
+
+def loop_period_frames(
+    fps: int,
+    motion_type: str,
+    period: float,
+    squash_enabled: bool,
+    rotation_enabled: bool,
+    sparkles: bool,
+    blink_frames: Optional[int] = None
+) -> Optional[int]:
+    """
+    Smallest number of frames after which every periodic component of the
+    blueprint repeats exactly, or None if some component never lines up.
+    """
+    periods_sec = []
+    if motion_type == 'bounce':
+        periods_sec.append(period)
+    elif motion_type == 'shake':
+        periods_sec.append(period / 10)
+    if squash_enabled:
+        periods_sec.append(period)
+    if rotation_enabled:
+        periods_sec.append(period / 2)
+    if sparkles:
+        periods_sec.append(1.0)  # Sparkle position/alpha cycle
+    
+    loop = 1
+    for period_sec in periods_sec:
+        frames = _period_to_frames(period_sec, fps)
+        if frames is None:
+            return None
+        loop = math.lcm(loop, frames)
+    if blink_frames:
+        loop = math.lcm(loop, blink_frames)
+    return loop
+
+class RenderSubject:
+    """
+    Base image scaled onto the sticker canvas, as a premultiplied layer, plus an
+    LRU of its transformed (squashed/rotated) layers. One instance is shared by
+    every sticker of a pack, including renders running on other pool threads.
+    """
+    def __init__(self, base_img: Image.Image, target_size: int = 512):
+        base_img = base_img.convert('RGBA') if base_img.mode != 'RGBA' else base_img
+        base_width, base_height = base_img.size
+        
+        # If image is already 512x512 (prepared asset), use it directly
+        # Otherwise, scale to fit 512x512 (maintain aspect ratio)
+        if base_width == target_size and base_height == target_size:
+            logger.info("Using prepared asset (512x512)")
+        else:
+            scale = min(target_size / base_width, target_size / base_height)
+            base_img = base_img.resize((int(base_width * scale), int(base_height * scale)), Image.Resampling.LANCZOS)
+        
+        self.image = base_img
+        self.target_size = target_size
+        self.width, self.height = base_img.size
+        # Subject position on the canvas
+        self.x_offset = (target_size - self.width) // 2
+        self.y_offset = (target_size - self.height) // 2
+        self.layer = premultiply(base_img)
+        self._sprites: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def load(cls, base_image_path: str, target_size: int = 512) -> 'RenderSubject':
+        with Image.open(base_image_path) as img:
+            return cls(img.convert('RGBA'), target_size)
+    
+    def sprite(self, width: int, height: int, rotation: float) -> Layer:
+        """Subject resized to width x height and rotated, built once per key."""
+        key = (width, height, rotation)
+        with self._lock:
+            layer = self._sprites.get(key)
+            if layer is not None:
+                self._sprites.move_to_end(key)
+                return layer
+        transformed_img = self.image.resize((width, height), Image.Resampling.LANCZOS)
+        if rotation != 0:
+            transformed_img = transformed_img.rotate(rotation, expand=False, resample=Image.Resampling.BICUBIC)
+        layer = premultiply(transformed_img)
+        with self._lock:
+            self._sprites[key] = layer
+            while len(self._sprites) > SPRITE_CACHE_SIZE:
+                self._sprites.popitem(last=False)
+        return layer
+    
+    def __getstate__(self):
+        # Process pool workers get their own (empty) sprite cache
+        state = self.__dict__.copy()
+        state['_sprites'] = OrderedDict()
+        del state['_lock']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
 def render_animation(
     base_image_path: str,
     blueprint_json: str,
-    output_path: str
+    output_path: str,
+    subject: Optional[RenderSubject] = None
 ) -> Dict[str, Any]:
     """Render animated sticker from base image and blueprint.
     Enforces Sticker Style Contract with quality gates and auto-retry.
+    subject: the base image already loaded (render_pack shares one across stickers).
     """
     blueprint = parse_blueprint(blueprint_json)
     if not validate_blueprint(blueprint):
@@ -29,30 +146,13 @@ def render_animation(
     # Enhance blueprint with sticker-grade motion fields
     blueprint = enhance_blueprint_with_sticker_grade_motion(blueprint)
     
-    # Load base image (should already be prepared asset with outline/shadow)
-    base_img = Image.open(base_image_path).convert('RGBA')
-    base_width, base_height = base_img.size
-    
-    # If image is already 512x512 (prepared asset), use it directly
-    # Otherwise, scale to fit 512x512 (maintain aspect ratio)
-    target_size = 512
-    
-    if base_width == target_size and base_height == target_size:
-        # Already prepared asset at correct size
-        new_width, new_height = target_size, target_size
-        # Don't resize, but we may need to extract subject bounds
-        logger.info("Using prepared asset (512x512)")
-    else:
-        # Scale to fit 512x512 (maintain aspect ratio)
-        scale = min(target_size / base_width, target_size / base_height)
-        new_width = int(base_width * scale)
-        new_height = int(base_height * scale)
-        base_img = base_img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-    
-    # Create canvas
-    canvas = Image.new('RGBA', (target_size, target_size), (0, 0, 0, 0))
-    x_offset = (target_size - new_width) // 2
-    y_offset = (target_size - new_height) // 2
+    # Base image (should already be prepared asset with outline/shadow), loaded
+    # once per pack when the caller passes a shared subject
+    if subject is None:
+        subject = RenderSubject.load(base_image_path)
+    target_size = subject.target_size
+    new_width, new_height = subject.width, subject.height
+    x_offset, y_offset = subject.x_offset, subject.y_offset
     
     # Animation parameters - HARD CONSTRAINTS
     duration = min(blueprint.get('duration_sec', 2.6), 3.0)  # Force ≤3.0s
@@ -135,19 +235,46 @@ def render_animation(
     loop_ms = timing.get('loopMs', int(duration * 1000))
     outro_ms = timing.get('outroMs', 0)
     
-    # Create frames directory in shared volume with unique name
+    # Stream frames straight into ffmpeg as rawvideo, no PNG sequence on disk.
+    # The sink encodes the first size-fit candidate while frames are rendered and keeps
+    # an mmap'd raw copy, so the size-fit search and any fallback re-encode work from
+    # the source frames instead of a lossy intermediate video.
     unique_id = secrets.token_hex(8)  # 16 hex chars
     timestamp = int(time.time() * 1000)  # milliseconds for better precision
-    frames_dir = f'/tmp/packputer/frames_{timestamp}_{unique_id}'
-    os.makedirs(frames_dir, exist_ok=True)
-    frame_paths = []
+    seed_video = f'/tmp/packputer/sticker_{timestamp}_{unique_id}_seed.webm'
+    sink = RawFrameSink(target_size, target_size, fps, total_frames,
+                        seed_output_args(fps, duration, seed_video))
+    
+    # Blueprint motion is periodic: after the text entrance settles, frame i is
+    # identical to frame i - loop_frames, so only one loop is actually rendered
+    entrance_type = entrance_anim.get('type', 'none')
+    entrance_frames = int(entrance_anim.get('duration', 0.3) * fps)
+    text_static_from = entrance_frames if text_value and entrance_type != 'none' else 0
+    loop_frames = loop_period_frames(
+        fps, motion_type, period, squash_enabled, rotation_enabled, sparkles,
+        int(blink_interval * fps) if blink_enabled else None
+    )
+    frames_rendered = 0
+    frames_reused = 0
+    
+    # Frames are composited in a reused premultiplied float32 buffer
+    compositor = FrameCompositor(target_size, target_size)
+    sparkle_layer = solid_disc(5, (255, 255, 0))
     
     try:
         for frame_idx in range(total_frames):
             t = frame_idx / fps
+            if frame_idx % 10 == 0:
+                report('render', step=frame_idx, total=total_frames)
+            
+            if loop_frames and frame_idx - loop_frames >= text_static_from:
+                sink.repeat(frame_idx - loop_frames)
+                frames_reused += 1
+                continue
+            frames_rendered += 1
             
-            # Create frame
-            frame = canvas.copy()
+            # Start from a transparent frame
+            compositor.clear()
             
             # Calculate motion offset using enhanced transform
             y_motion = 0
@@ -182,41 +309,29 @@ def render_animation(
                     new_w = int(new_width * scale_factor)
                     new_h = int(new_height * scale_factor)
                 
-                transformed_img = base_img.resize((new_w, new_h), Image.Resampling.LANCZOS)
-                if rotation != 0:
-                    transformed_img = transformed_img.rotate(rotation, expand=False, resample=Image.Resampling.BICUBIC)
+                rotation = round(float(rotation), 2)
+                subject_layer = subject.sprite(new_w, new_h, rotation)
             else:
-                transformed_img = base_img
+                subject_layer = subject.layer
                 new_w, new_h = new_width, new_height
             
             # Calculate centered position with motion
             paste_x = x_offset + x_motion + (new_width - new_w) // 2
             paste_y = y_offset + y_motion + (new_height - new_h) // 2
             
-            # Paste base image with motion and transforms
-            frame.paste(transformed_img, (paste_x, paste_y), transformed_img)
+            # Composite base image with motion and transforms
+            compositor.over(subject_layer, paste_x, paste_y)
             
             # Blink effect (simple overlay)
             if blink_enabled:
                 blink_frame = int(blink_interval * fps)
                 if frame_idx % blink_frame < blink_frame // 4:
                     # Add semi-transparent overlay for blink
-                    overlay = Image.new('RGBA', frame.size, (0, 0, 0, 100))
-                    frame = Image.alpha_composite(frame, overlay)
-            
-            # Initialize draw object (needed for text and sparkles)
-            draw = ImageDraw.Draw(frame)
+                    compositor.overlay((0, 0, 0), 100 / 255)
             
             # Add text with entrance animation
             if text_value:
-                font = None
-                
-                # Entrance animation
-                entrance_type = entrance_anim.get('type', 'none')
-                entrance_duration = entrance_anim.get('duration', 0.3)
-                entrance_frames = int(entrance_duration * fps)
-                
-                # Calculate animation progress
+                # Calculate entrance animation progress
                 if frame_idx < entrance_frames and entrance_type != 'none':
                     anim_progress = frame_idx / entrance_frames
                 else:
@@ -229,22 +344,6 @@ def render_animation(
                 
                 # Use font size from textLayer or style
                 current_font_size = int(font_size * text_scale)
-                font_paths = [
-                    '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf',
-                    '/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf',
-                    '/System/Library/Fonts/Helvetica.ttc',
-                ]
-                for font_path in font_paths:
-                    try:
-                        font = ImageFont.truetype(font_path, current_font_size)
-                        break
-                    except:
-                        continue
-                if not font:
-                    try:
-                        font = ImageFont.load_default()
-                    except:
-                        pass
                 
                 # Calculate text position
                 if text_placement == 'top':
@@ -254,44 +353,16 @@ def render_animation(
                 else:
                     text_y = target_size // 2 + text_offset_y
                 
-                text_x = target_size // 2
-                
-                # Draw main text
-                if font:
-                    bbox = draw.textbbox((0, 0), text_value, font=font)
-                    text_width = bbox[2] - bbox[0]
-                    text_x = (target_size - text_width) // 2
-                
-                if text_stroke:
-                    # Draw stroke with proper width
-                    stroke_range = range(-stroke_width, stroke_width + 1)
-                    for adj in stroke_range:
-                        for adj2 in stroke_range:
-                            if abs(adj) + abs(adj2) <= stroke_width:
-                                draw.text((text_x + adj, text_y + adj2), text_value, 
-                                         font=font, fill=(0, 0, 0, text_alpha))
-                
-                # Draw text with entrance animation alpha
-                text_color_rgb = (255, 255, 255)  # White
-                draw.text((text_x, text_y), text_value, font=font, fill=(*text_color_rgb, text_alpha))
+                # Stroked caption is rasterized once per font size, then composited
+                caption_sprite = caption_layer(text_value, current_font_size, stroke_width if text_stroke else 0)
+                text_x = caption_origin_x(text_value, current_font_size, target_size)
+                compositor.over(caption_sprite, text_x, text_y, text_alpha / 255)
                 
                 # Draw subvalue if exists
                 if text_subvalue:
-                    sub_y = text_y + 40
-                    if font:
-                        bbox = draw.textbbox((0, 0), text_subvalue, font=font)
-                        sub_width = bbox[2] - bbox[0]
-                        sub_x = (target_size - sub_width) // 2
-                    else:
-                        sub_x = text_x
-                    
-                    if text_stroke:
-                        for adj in range(-2, 3):
-                            for adj2 in range(-2, 3):
-                                draw.text((sub_x + adj, sub_y + adj2), text_subvalue,
-                                         font=font, fill=(0, 0, 0, 255))
-                    
-                    draw.text((sub_x, sub_y), text_subvalue, font=font, fill=(255, 255, 255, 255))
+                    sub_layer = caption_layer(text_subvalue, current_font_size, 2 if text_stroke else 0)
+                    sub_x = caption_origin_x(text_subvalue, current_font_size, target_size)
+                    compositor.over(sub_layer, sub_x, text_y + 40)
             
             # Add sparkles (simple circles)
             if sparkles:
@@ -299,137 +370,44 @@ def render_animation(
                     sparkle_x = int((target_size // sparkle_count) * i + (target_size // sparkle_count) // 2)
                     sparkle_y = int(50 + 30 * np.sin(2 * np.pi * t + i))
                     sparkle_alpha = int(200 * (0.5 + 0.5 * np.sin(2 * np.pi * t * 2 + i)))
-                    draw.ellipse([sparkle_x - 5, sparkle_y - 5, sparkle_x + 5, sparkle_y + 5],
-                               fill=(255, 255, 0, sparkle_alpha))
+                    compositor.over(sparkle_layer, sparkle_x - 5, sparkle_y - 5, sparkle_alpha / 255)
             
-            # Save frame with alpha channel preserved
-            frame_path = os.path.join(frames_dir, f'frame_{frame_idx:05d}.png')
-            # Ensure frame is in RGBA mode before saving
-            if frame.mode != 'RGBA':
-                frame = frame.convert('RGBA')
-            frame.save(frame_path, 'PNG')  # Explicitly save as PNG to preserve alpha
-            frame_paths.append(frame_path)
+            # Stream frame with alpha channel preserved (straight RGBA)
+            sink.write(compositor.to_rgba8())
         
-        # Encode to WEBM using ffmpeg
-        # First create a temporary video from frames in shared volume with unique name
-        unique_id = secrets.token_hex(8)
-        timestamp = int(time.time() * 1000)
-        temp_video = f'/tmp/packputer/temp_video_{timestamp}_{unique_id}.webm'
-        
-        # Use ffmpeg to create video from frames with alpha channel
-        # CRITICAL: Must use yuva420p for transparency (not yuv420p)
-        # Ensure input is RGBA, then encode to VP9 with alpha
-        cmd = [
-            'ffmpeg',
-            '-y',
-            '-framerate', str(fps),
-            '-i', os.path.join(frames_dir, 'frame_%05d.png'),
-            '-vf', 'format=rgba',  # Ensure input is RGBA (preserves alpha from PNG)
-            '-c:v', 'libvpx-vp9',
-            '-pix_fmt', 'yuva420p',  # VP9 with alpha channel (CRITICAL for transparency)
-            '-auto-alt-ref', '0',    # Important for alpha in VP9
-            '-alpha_mode', '1',      # Explicitly enable alpha in VP9
-            '-crf', '32',
-            '-b:v', '0',
-            '-an',                   # No audio
-            temp_video
-        ]
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-        
-        # Log FFmpeg output for debugging
-        if result.stderr:
-            logger.warning(f"FFmpeg encoding stderr (first 1000 chars): {result.stderr[:1000]}")
-        if result.stdout:
-            logger.debug(f"FFmpeg encoding stdout: {result.stdout[:500]}")
-        
-        # Verify initial encoding has alpha
-        from .ffmpeg_utils import probe_media
-        initial_has_alpha = False
+        # Finish the first encode; the raw frames stay available for the size-fit search
         try:
-            _, _, _, _, temp_pix_fmt, _ = probe_media(temp_video)
-            if temp_pix_fmt and 'yuva' in temp_pix_fmt.lower():
-                initial_has_alpha = True
-                logger.info(f"Initial encoding has alpha: {temp_pix_fmt}")
-            else:
-                logger.error(f"Initial encoding failed to create alpha! pix_fmt={temp_pix_fmt}")
-                logger.warning("Will skip fit_to_limits and encode directly from frames with alpha")
-        except Exception as e:
-            logger.warning(f"Could not verify initial encoding alpha: {e}")
+            result = sink.close()
+            if result.stderr:
+                logger.debug(f"FFmpeg first encode stderr (last 1000 chars): {result.stderr[-1000:]}")
+        except subprocess.CalledProcessError as e:
+            logger.warning(f"First encode failed, size-fitting from frames only: {(e.stderr or '')[-1000:]}")
+            seed_video = None
+        frames = sink.raw
         
-        # If initial encoding has alpha, use fit_to_limits to optimize size
-        # Otherwise, encode directly from frames (skip fit_to_limits which can't restore alpha)
-        if initial_has_alpha:
-            # Now fit to limits (this will save to /tmp/packputer)
-            # fit_to_limits will preserve alpha via encode_webm(preserve_alpha=True)
-            final_path, metadata = fit_to_limits(temp_video, duration, 'transparent')
-        else:
-            # Initial encoding failed - encode directly from frames with explicit alpha
-            logger.warning("Encoding directly from frames to ensure alpha channel...")
-            final_path = f'/tmp/packputer/final_alpha_{timestamp}_{unique_id}.webm'
-            direct_cmd = [
-                'ffmpeg',
-                '-y',
-                '-framerate', str(fps),
-                '-i', os.path.join(frames_dir, 'frame_%05d.png'),
-                '-vf', 'format=rgba',  # Ensure input is RGBA (preserves alpha from PNG)
-                '-c:v', 'libvpx-vp9',
-                '-pix_fmt', 'yuva420p',
-                '-auto-alt-ref', '0',
-                '-alpha_mode', '1',      # Explicitly enable alpha in VP9
-                '-crf', '36',  # Higher compression to meet size limit
-                '-b:v', '0',
-                '-an',
-                '-t', str(min(duration, 3.0)),
-                final_path
-            ]
-            direct_result = subprocess.run(direct_cmd, check=True, capture_output=True, text=True)
-            if direct_result.stderr:
-                logger.warning(f"FFmpeg direct encoding stderr (first 1000 chars): {direct_result.stderr[:1000]}")
-            if direct_result.stdout:
-                logger.debug(f"FFmpeg direct encoding stdout: {direct_result.stdout[:500]}")
-            
-            # Probe for metadata
-            duration_probe, width_probe, height_probe, fps_probe, pix_fmt_probe, has_audio_probe = probe_media(final_path)
-            metadata = {
-                'duration': duration_probe,
-                'width': width_probe,
-                'height': height_probe,
-                'fps': fps_probe,
-                'pix_fmt': pix_fmt_probe,
-                'has_audio': has_audio_probe,
-                'kb': os.path.getsize(final_path) // 1024
-            }
-            
-            # Verify alpha was created
-            if not pix_fmt_probe or 'yuva' not in pix_fmt_probe.lower():
-                logger.error(f"Direct encoding from frames also failed to create alpha! pix_fmt={pix_fmt_probe}")
-                raise ValueError("Failed to create video with alpha channel - cannot proceed")
-            else:
-                logger.info(f"✅ Direct encoding from frames has alpha: {pix_fmt_probe}")
-                
-                # Now run fit_to_limits on the direct-encoded file to ensure size compliance
-                # Since it has alpha, fit_to_limits should preserve it
-                if metadata.get('kb', 0) > 256:
-                    logger.info(f"Direct encoded file is {metadata.get('kb')}KB, running fit_to_limits to optimize...")
-                    final_path, metadata = fit_to_limits(final_path, duration, 'transparent')
+        # Size-fit straight from the rendered frames: one generation of lossy encoding,
+        # no intermediate CRF 32 video to decode and re-encode
+        final_path, metadata = fit_raw_to_limits(frames, duration, seed_path=seed_video)
+        metadata['frames_rendered'] = frames_rendered
+        metadata['frames_reused'] = frames_reused
+        logger.info(f"Rendered {frames_rendered} frames, reused {frames_reused} (loop period: {loop_frames or 'none'})")
         
         # Quality gate: Validate video sticker
+        report('validate')
         is_valid, violations = validate_video_sticker(final_path, metadata)
         
         # CRITICAL: If alpha channel is missing, fail immediately and try to fix
         alpha_violations = [v for v in violations if v.field == 'pixel_format' or v.field == 'alpha_channel']
         if len(alpha_violations) > 0:
             logger.error(f"CRITICAL: Video missing alpha channel! {alpha_violations[0]}")
-            # Try to re-encode directly from frames (bypass fit_to_limits if it lost alpha)
+            # Try to re-encode directly from frames (bypass the size-fit encode if it lost alpha)
             logger.warning("Attempting to re-encode from frames with alpha preservation...")
             try:
                 retry_output = f'/tmp/packputer/retry_alpha_{timestamp}_{unique_id}.webm'
                 retry_cmd = [
                     'ffmpeg',
                     '-y',
-                    '-framerate', str(fps),
-                    '-i', os.path.join(frames_dir, 'frame_%05d.png'),
-                    '-vf', 'format=rgba',  # Ensure input is RGBA (preserves alpha from PNG)
+                    *frames.input_args(),  # Replay raw RGBA frames (alpha intact)
                     '-c:v', 'libvpx-vp9',
                     '-pix_fmt', 'yuva420p',
                     '-auto-alt-ref', '0',
@@ -440,7 +418,7 @@ def render_animation(
                     '-t', str(min(duration, 3.0)),
                     retry_output
                 ]
-                retry_result = subprocess.run(retry_cmd, check=True, capture_output=True, text=True)
+                retry_result = run_ffmpeg(retry_cmd)
                 if retry_result.stderr:
                     logger.warning(f"FFmpeg retry stderr (first 1000 chars): {retry_result.stderr[:1000]}")
                 if retry_result.stdout:
@@ -518,7 +496,6 @@ def render_animation(
         return metadata
         
     finally:
-        # Cleanup frames (but keep output file)
-        if os.path.exists(frames_dir):
-            shutil.rmtree(frames_dir, ignore_errors=True)
+        # Cleanup raw frames (but keep output file)
+        sink.discard()
 
@@ -0,0 +1,196 @@
+"""
+Content-Addressed Result Cache
+Keeps finished stickers under /tmp/packputer, keyed by the hash of the input
+bytes, the request parameters and the encoder version, so repeated inputs
+(the same forwarded GIF, the same image + blueprint) skip encoding entirely.
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+import secrets
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE_ENABLED', '1') == '1'
+# Separate from the bot's /tmp/packputer/cache, which it expires on its own
+RESULT_CACHE_DIR = os.getenv('RESULT_CACHE_DIR', '/tmp/packputer/results')
+RESULT_CACHE_MAX_MB = float(os.getenv('RESULT_CACHE_MAX_MB', '512'))
+# Bump when encoder settings change, so stale outputs are never served
+ENCODER_VERSION = os.getenv('ENCODER_VERSION', 'vp9-sizefit-2')
+
+HASH_CHUNK = 1024 * 1024
+
+
+def hash_file(path: str) -> str:
+    """sha256 of a file's bytes, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def canonical_json(value: str) -> str:
+    """Canonical form of a JSON document (sorted keys, no whitespace); unparsable input is kept as is."""
+    try:
+        return json.dumps(json.loads(value), sort_keys=True, separators=(',', ':'))
+    except (TypeError, ValueError):
+        return value
+
+
+def cache_key(kind: str, content_hash: str, params: Dict[str, Any]) -> str:
+    """Key for one result: request kind, input content hash, parameters and encoder version."""
+    payload = json.dumps({
+        'kind': kind,
+        'input': content_hash,
+        'params': params,
+        'encoder': ENCODER_VERSION,
+    }, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def link_or_copy(src: str, dst: str):
+    """Hardlink src to dst (instant, same volume), copying if linking isn't possible."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class ResultCache:
+    """
+    Size-bounded LRU of finished outputs. Each entry is <key>.webm plus a
+    <key>.json metadata sidecar, both written atomically (temp file + os.replace).
+    Hits are served as a fresh file, because the bot deletes outputs after upload.
+    """
+    def __init__(self, cache_dir: str = RESULT_CACHE_DIR, max_bytes: int = int(RESULT_CACHE_MAX_MB * 1024 * 1024)):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, int]" = OrderedDict()  # key -> bytes, oldest first
+        self._bytes = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        base = os.path.join(self.cache_dir, key)
+        return base + '.webm', base + '.json'
+
+    def _load(self):
+        """Rebuild the LRU order from the files left by a previous process (oldest access first)."""
+        if self._loaded:
+            return
+        self._loaded = True
+        os.makedirs(self.cache_dir, exist_ok=True)
+        found = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.webm'):
+                continue
+            key = name[:-len('.webm')]
+            video_path, meta_path = self._paths(key)
+            if not os.path.exists(meta_path):
+                continue
+            try:
+                st = os.stat(video_path)
+            except OSError:
+                continue
+            found.append((st.st_mtime, key, st.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._bytes += size
+
+    def get(self, key: str, output_path: str) -> Optional[dict]:
+        """Materialize a cached result at output_path and return its metadata, or None on a miss."""
+        with self._lock:
+            self._load()
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            video_path, meta_path = self._paths(key)
+            try:
+                with open(meta_path, 'r') as f:
+                    metadata = json.load(f)
+                link_or_copy(video_path, output_path)
+                # mtime doubles as the access time, so LRU order survives restarts
+                os.utime(video_path)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Dropping unreadable cache entry {key}: {e}")
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return metadata
+
+    def put(self, key: str, output_path: str, metadata: dict):
+        """Store a finished output (left in place for the caller) with its metadata."""
+        with self._lock:
+            self._load()
+            video_path, meta_path = self._paths(key)
+            tmp_suffix = f'.tmp_{secrets.token_hex(4)}'
+            try:
+                link_or_copy(output_path, video_path + tmp_suffix)
+                with open(meta_path + tmp_suffix, 'w') as f:
+                    json.dump(metadata, f)
+                # Metadata first, entries are only picked up when both files exist
+                os.replace(meta_path + tmp_suffix, meta_path)
+                os.replace(video_path + tmp_suffix, video_path)
+            except OSError as e:
+                logger.warning(f"Could not cache result {key}: {e}")
+                for path in (video_path + tmp_suffix, meta_path + tmp_suffix):
+                    if os.path.exists(path):
+                        os.unlink(path)
+                return
+
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)
+            size = os.path.getsize(video_path)
+            self._entries[key] = size
+            self._bytes += size
+            self.stores += 1
+
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key: str):
+        self._bytes -= self._entries.pop(key, 0)
+        for path in self._paths(key):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': RESULT_CACHE_ENABLED,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+            }
+
+
+result_cache = ResultCache()
+
+
+def cached_output_path(prefix: str) -> str:
+    """Fresh output path in the shared volume for serving a cache hit or a coalesced result."""
+    timestamp = int(time.time() * 1000)
+    return os.path.join('/tmp/packputer', f'{prefix}_{timestamp}_{secrets.token_hex(8)}.webm')
@@ -0,0 +1,252 @@
+"""
+Stage Scheduler
+Admission control in front of the blocking stages: each stage run gets a memory
+cost estimate (from the probed resolution x duration), waits in a weighted
+priority queue until the memory budget and its stage's concurrency limit have
+room, and requests are turned away with 429 once the queue is full.
+"""
+import os
+import math
+import time
+import asyncio
+import contextvars
+import logging
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Interactive requests (one sticker for a waiting user) are picked 4x as often as batch work
+PRIORITY_WEIGHTS = {
+    'interactive': int(os.getenv('SCHED_WEIGHT_INTERACTIVE', '4')),
+    'batch': int(os.getenv('SCHED_WEIGHT_BATCH', '1')),
+}
+DEFAULT_PRIORITY = 'interactive'
+# Stage runs allowed to wait per priority before new requests get 429
+SCHED_MAX_QUEUED = int(os.getenv('SCHED_MAX_QUEUED', '32'))
+# Times a queued run that doesn't fit may be overtaken by smaller ones before
+# it holds back further grants until it fits (so large runs aren't starved)
+SCHED_MAX_BYPASS = int(os.getenv('SCHED_MAX_BYPASS', '8'))
+
+
+def _default_memory_mb() -> float:
+    """75% of the container's cgroup memory limit, 2GB if there is none."""
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+            if value.isdigit() and int(value) < 1 << 50:
+                return int(value) / (1024 * 1024) * 0.75
+        except OSError:
+            continue
+    return 2048.0
+
+
+SCHED_MEMORY_MB = float(os.getenv('SCHED_MEMORY_MB', '0')) or _default_memory_mb()
+
+# Rough peak memory per stage run: fixed overhead (ffmpeg, PIL, models) plus
+# a per-frame term for the raw intermediates at 512x512
+STAGE_BASE_MB = {
+    'convert': 120,
+    'render': 150,
+    'prepare_asset': 250,
+    'animate': 600,
+}
+RAW_FRAME_MB = 512 * 512 * 4 / (1024 * 1024)
+# Decoded source pixels are held a few times over (decode, RGBA, working copies)
+SOURCE_COPIES = 4
+
+
+def estimate_cost_mb(
+    stage: str,
+    input_path: Optional[str] = None,
+    duration: Optional[float] = None,
+    fps: Optional[float] = None
+) -> float:
+    """Peak memory estimate for one run of a stage, from its input's resolution and duration."""
+    cost = STAGE_BASE_MB.get(stage, 150)
+    width = height = 512
+    if input_path:
+        try:
+            if os.path.splitext(input_path)[1].lower() in ('.png', '.jpg', '.jpeg', '.webp', '.bmp'):
+                # Header only, pixels aren't decoded
+                with Image.open(input_path) as img:
+                    width, height = img.size
+            else:
+                from .ffmpeg_utils import probe_media
+                probed_duration, width, height, probed_fps, _, _ = probe_media(input_path)
+                duration = duration or probed_duration
+                fps = fps or probed_fps
+        except Exception:
+            pass
+    cost += width * height * 4 * SOURCE_COPIES / (1024 * 1024)
+    if duration and fps:
+        # Raw 512x512 frames of at most 3s at 30fps
+        cost += RAW_FRAME_MB * min(duration, 3.0) * min(fps, 30)
+    return cost
+
+
+class Overloaded(Exception):
+    """Queue for this priority is full (reported as 429 with Retry-After)."""
+    def __init__(self, retry_after: int):
+        self.retry_after = retry_after
+        super().__init__(f'Worker busy, retry after {retry_after}s')
+
+
+class RequestScope:
+    """Per-request accounting: priority and time spent waiting for the scheduler."""
+    def __init__(self, priority: str = DEFAULT_PRIORITY):
+        self.priority = priority if priority in PRIORITY_WEIGHTS else DEFAULT_PRIORITY
+        self.queue_wait = 0.0
+
+
+_scope: contextvars.ContextVar[Optional[RequestScope]] = contextvars.ContextVar('request_scope', default=None)
+
+
+def enter_scope(priority: str = DEFAULT_PRIORITY) -> RequestScope:
+    """Start a request scope for the current context (a request or a job)."""
+    scope = RequestScope(priority)
+    _scope.set(scope)
+    return scope
+
+
+def current_scope() -> Optional[RequestScope]:
+    return _scope.get()
+
+
+class _Waiter:
+    def __init__(self, stage: str, cost_mb: float):
+        self.stage = stage
+        self.cost_mb = cost_mb
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.bypassed = 0
+
+
+class Scheduler:
+    def __init__(self, memory_mb: float = SCHED_MEMORY_MB):
+        self.memory_mb = memory_mb
+        self.in_use_mb = 0.0
+        self.running = 0
+        self._stage_running: Dict[str, int] = {}
+        self._stage_limits: Dict[str, int] = {}
+        self._queues: Dict[str, Deque[_Waiter]] = {p: deque() for p in PRIORITY_WEIGHTS}
+        # Smooth weighted round-robin state
+        self._current: Dict[str, int] = {p: 0 for p in PRIORITY_WEIGHTS}
+        self.rejected = 0
+        self._service_sec = 10.0  # Moving average of a stage run, for Retry-After
+
+    def set_stage_limit(self, stage: str, limit: int):
+        self._stage_limits[stage] = limit
+
+    def waiting(self, priority: Optional[str] = None) -> int:
+        if priority:
+            return len(self._queues[priority])
+        return sum(len(q) for q in self._queues.values())
+
+    def retry_after(self) -> int:
+        slots = max(1, sum(self._stage_limits.values()) or 1)
+        return max(1, math.ceil(self._service_sec * (self.waiting() + 1) / slots))
+
+    def check_admission(self, priority: str):
+        """Raise Overloaded if this priority's queue is full."""
+        if self.waiting(priority) >= SCHED_MAX_QUEUED:
+            self.rejected += 1
+            raise Overloaded(self.retry_after())
+
+    def _fits(self, waiter: _Waiter) -> bool:
+        if self._stage_running.get(waiter.stage, 0) >= self._stage_limits.get(waiter.stage, 1):
+            return False
+        # A run bigger than the whole budget still goes once the worker is idle
+        return self.running == 0 or self.in_use_mb + waiter.cost_mb <= self.memory_mb
+
+    def _grant(self, waiter: _Waiter):
+        self.in_use_mb += waiter.cost_mb
+        self.running += 1
+        self._stage_running[waiter.stage] = self._stage_running.get(waiter.stage, 0) + 1
+        waiter.future.set_result(time.monotonic() - waiter.enqueued_at)
+
+    def _pick_order(self, active):
+        """Priorities with waiters, the smooth weighted round-robin pick first (state unchanged)."""
+        return sorted(active, key=lambda p: (-(self._current[p] + PRIORITY_WEIGHTS[p]), -PRIORITY_WEIGHTS[p]))
+
+    def _charge(self, granted: str, active):
+        """Advance the round-robin state for a grant to `granted`."""
+        for p in active:
+            self._current[p] += PRIORITY_WEIGHTS[p]
+        self._current[granted] -= sum(PRIORITY_WEIGHTS[p] for p in active)
+
+    def _dispatch(self):
+        while True:
+            for queue in self._queues.values():
+                # Drop runs cancelled while waiting
+                if any(w.future.done() for w in queue):
+                    kept = [w for w in queue if not w.future.done()]
+                    queue.clear()
+                    queue.extend(kept)
+            active = [p for p, q in self._queues.items() if q]
+            if not active:
+                return
+
+            # A run overtaken too often holds everything back until it fits
+            starved = [q[0] for q in self._queues.values() if q and q[0].bypassed >= SCHED_MAX_BYPASS]
+            if starved:
+                oldest = min(starved, key=lambda w: w.enqueued_at)
+                if not self._fits(oldest):
+                    return
+                candidates = [(p, oldest) for p in active if self._queues[p][0] is oldest]
+            else:
+                # First run in each priority's queue that fits, looking past ones that don't
+                candidates = []
+                for priority in self._pick_order(active):
+                    waiter = next((w for w in self._queues[priority] if self._fits(w)), None)
+                    if waiter is not None:
+                        candidates.append((priority, waiter))
+                        break
+            if not candidates:
+                return
+
+            priority, waiter = candidates[0]
+            for p in active:
+                for ahead in self._queues[p]:
+                    if ahead is waiter or ahead.enqueued_at > waiter.enqueued_at:
+                        break
+                    ahead.bypassed += 1
+            self._queues[priority].remove(waiter)
+            self._charge(priority, active)
+            self._grant(waiter)
+
+    async def acquire(self, stage: str, cost_mb: float, priority: str) -> float:
+        """Wait for room to run a stage. Returns the time spent queued in seconds."""
+        waiter = _Waiter(stage, cost_mb)
+        self._queues[priority].append(waiter)
+        self._dispatch()
+        try:
+            return await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Granted just before the cancellation landed
+                self.release(stage, cost_mb, 0.0)
+            raise
+
+    def release(self, stage: str, cost_mb: float, service_sec: float):
+        self.in_use_mb -= cost_mb
+        self.running -= 1
+        self._stage_running[stage] -= 1
+        if service_sec:
+            self._service_sec = 0.8 * self._service_sec + 0.2 * service_sec
+        self._dispatch()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'memory_budget_mb': round(self.memory_mb),
+            'memory_in_use_mb': round(self.in_use_mb),
+            'running': self.running,
+            'waiting': {p: len(q) for p, q in self._queues.items()},
+            'rejected': self.rejected,
+            'avg_service_sec': round(self._service_sec, 2),
+        }
+
+
+scheduler = Scheduler()
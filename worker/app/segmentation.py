@@ -0,0 +1,156 @@
+"""
+Segmentation Model Session
+One process-wide background segmentation session (rembg / onnxruntime), loaded
+on first use and reused by every matting job. Frames are run through the model
+in batches at the model's (or a smaller) input resolution, and the masks are
+upsampled back to frame size.
+"""
+import os
+import time
+import logging
+import threading
+import numpy as np
+from PIL import Image
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+MATTE_MODEL = os.getenv('MATTE_MODEL', 'u2net')
+# Frames per inference call
+MATTE_BATCH = int(os.getenv('MATTE_BATCH', '8'))
+# CPU threads for one inference call; stage concurrency already spreads jobs over cores
+MATTE_THREADS = int(os.getenv('MATTE_THREADS', os.getenv('OMP_NUM_THREADS', str(os.cpu_count() or 2))))
+# Inference resolution, 0 = the model's native input size. Lower is faster,
+# the mask is upsampled to frame size either way.
+MATTE_INFER_SIZE = int(os.getenv('MATTE_INFER_SIZE', '0'))
+
+# Native input size and normalization (mean, std) per model, as rembg does it
+MODEL_INPUTS = {
+    'u2net': (320, (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+    'u2netp': (320, (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+    'u2net_human_seg': (320, (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+    'silueta': (320, (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+    'isnet-general-use': (1024, (0.5, 0.5, 0.5), (1.0, 1.0, 1.0)),
+    'isnet-anime': (1024, (0.5, 0.5, 0.5), (1.0, 1.0, 1.0)),
+}
+
+
+class SegmentationSession:
+    """Batched mask prediction on a loaded onnxruntime session."""
+    def __init__(self, model_name: str, ort_session):
+        self.model_name = model_name
+        self._session = ort_session
+        self._input_name = ort_session.get_inputs()[0].name
+        native, mean, std = MODEL_INPUTS.get(model_name, MODEL_INPUTS['u2net'])
+        self.native_size = native
+        self.size = MATTE_INFER_SIZE or native
+        self._mean = np.array(mean, dtype=np.float32)
+        self._std = np.array(std, dtype=np.float32)
+        # Cleared if the exported model has a fixed batch dimension
+        self.batching = True
+        self.frames = 0
+        self.seconds = 0.0
+
+    def _prepare(self, frame: np.ndarray, size: int) -> np.ndarray:
+        img = Image.fromarray(frame[:, :, :3]).resize((size, size), Image.BILINEAR, reducing_gap=2.0)
+        arr = np.asarray(img, dtype=np.float32)
+        arr /= max(float(arr.max()), 1e-6)
+        arr -= self._mean
+        arr /= self._std
+        return arr.transpose(2, 0, 1)
+
+    def _run(self, frames: List[np.ndarray], size: int) -> np.ndarray:
+        batch = np.stack([self._prepare(f, size) for f in frames])
+        if self.batching or len(frames) == 1:
+            outputs = [self._session.run(None, {self._input_name: batch})[0]]
+        else:
+            outputs = [self._session.run(None, {self._input_name: batch[i:i + 1]})[0] for i in range(len(frames))]
+        return np.concatenate(outputs)[:, 0]
+
+    def predict(self, frames: List[np.ndarray]) -> List[np.ndarray]:
+        """Alpha masks (uint8, frame size) for a list of RGB(A) frames."""
+        if not frames:
+            return []
+        start = time.monotonic()
+        try:
+            preds = self._run(frames, self.size)
+        except Exception as e:
+            if not self.batching and self.size == self.native_size:
+                raise
+            # Fixed-shape export: fall back to one frame at a time at native size
+            logger.warning(f"Batched inference at {self.size}px failed ({e}), using single frames at {self.native_size}px")
+            self.batching = False
+            self.size = self.native_size
+            preds = self._run(frames, self.size)
+
+        masks = []
+        for frame, pred in zip(frames, preds):
+            lo, hi = float(pred.min()), float(pred.max())
+            pred = (pred - lo) / max(hi - lo, 1e-6)
+            mask = Image.fromarray((pred * 255).astype(np.uint8), mode='L')
+            height, width = frame.shape[:2]
+            masks.append(np.asarray(mask.resize((width, height), Image.BILINEAR)))
+
+        self.frames += len(frames)
+        self.seconds += time.monotonic() - start
+        return masks
+
+
+_session: Optional[SegmentationSession] = None
+_session_lock = threading.Lock()
+_load_failed = False
+
+
+def _load(model_name: str) -> SegmentationSession:
+    # rembg reads the thread count when it builds its session options
+    os.environ.setdefault('OMP_NUM_THREADS', str(MATTE_THREADS))
+    from rembg import new_session
+    started = time.monotonic()
+    session = new_session(model_name)
+    ort_session = session.inner_session
+    logger.info(f"Loaded segmentation model {model_name} in {time.monotonic() - started:.1f}s "
+                f"({MATTE_THREADS} threads)")
+    return SegmentationSession(model_name, ort_session)
+
+
+def get_session() -> Optional[SegmentationSession]:
+    """The shared session, loaded on first call. None if rembg is not installed."""
+    global _session, _load_failed
+    if _session is not None or _load_failed:
+        return _session
+    with _session_lock:
+        if _session is None and not _load_failed:
+            try:
+                _session = _load(MATTE_MODEL)
+            except ImportError:
+                logger.warning("rembg not available, matting will use the simple fallback")
+                _load_failed = True
+            except Exception as e:
+                logger.error(f"Could not load segmentation model {MATTE_MODEL}: {e}")
+                _load_failed = True
+    return _session
+
+
+def predict_masks(frames: List[np.ndarray], batch_size: int = MATTE_BATCH) -> Optional[List[np.ndarray]]:
+    """Masks for frames in batches of batch_size, or None without a model."""
+    session = get_session()
+    if session is None:
+        return None
+    masks: List[np.ndarray] = []
+    for i in range(0, len(frames), max(1, batch_size)):
+        masks.extend(session.predict(frames[i:i + batch_size]))
+    return masks
+
+
+def get_segmentation_stats() -> dict:
+    if _session is None:
+        return {'model': MATTE_MODEL, 'loaded': False, 'available': not _load_failed}
+    return {
+        'model': _session.model_name,
+        'loaded': True,
+        'infer_size': _session.size,
+        'batching': _session.batching,
+        'threads': MATTE_THREADS,
+        'frames': _session.frames,
+        'avg_frame_ms': round(_session.seconds / _session.frames * 1000, 1) if _session.frames else None,
+    }
@@ -0,0 +1,122 @@
+"""
+Single-Flight Request Coalescing
+Concurrent requests for the same result key attach to the one job already
+running instead of starting their own encode search.
+"""
+import os
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from .executor import run_releasing
+
+logger = logging.getLogger(__name__)
+
+COALESCE_ENABLED = os.getenv('COALESCE_ENABLED', '1') == '1'
+
+
+class _Flight:
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.waiters = 0
+        # One result per caller, the original first, built when the job finishes
+        self.results: List[Any] = []
+
+
+class SingleFlight:
+    """
+    Runs at most one job per key at a time, as a task of its own so it outlives
+    any single caller. Every caller waiting when it finishes gets the result or
+    fork(result) of it, all made before any caller sees them, so each caller can
+    own (and delete) its own output file. The job is cancelled only when all of
+    its callers have gone away.
+    release hands the flight a caller's resources (e.g. its upload): the caller
+    that starts the job has them released once the job's work has finished, a
+    caller joining a running job has its duplicates released right away.
+    """
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def run(
+        self,
+        key: str,
+        job: Callable[[], Awaitable[Any]],
+        fork: Optional[Callable[[Any], Any]] = None,
+        release: Optional[Callable[[], None]] = None
+    ) -> Any:
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            logger.info(f"Coalesced request onto in-flight job {key[:12]} ({flight.waiters + 1} waiting)")
+            if release:
+                release()
+        else:
+            flight = self._start(key, job, fork, release)
+
+        flight.waiters += 1
+        try:
+            await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                logger.info(f"All callers of job {key[:12]} went away, cancelling it")
+                flight.task.cancel()
+            raise
+        if not flight.results:
+            # Joined after the results were handed out
+            result = flight.task.result()
+            return fork(result) if fork else result
+        result = flight.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def _start(
+        self,
+        key: str,
+        job: Callable[[], Awaitable[Any]],
+        fork: Optional[Callable[[Any], Any]],
+        release: Optional[Callable[[], None]]
+    ) -> _Flight:
+        flight = _Flight()
+        started = False
+
+        async def lead():
+            nonlocal started
+            started = True
+            result = await (run_releasing(job, release) if release else job())
+            results = [result]
+            for _ in range(flight.waiters - 1):
+                try:
+                    results.append(fork(result) if fork else result)
+                except Exception as e:
+                    results.append(e)
+            flight.results = results
+            return result
+
+        def finished(task: asyncio.Task):
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            if not task.cancelled():
+                task.exception()  # Retrieved here in case every caller has gone
+            elif release and not started:
+                release()  # Cancelled before it ever ran
+
+        flight.task = asyncio.create_task(lead())
+        flight.task.add_done_callback(finished)
+        self._flights[key] = flight
+        self.leaders += 1
+        return flight
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'enabled': COALESCE_ENABLED,
+            'in_flight': len(self._flights),
+            'waiting': sum(f.waiters for f in self._flights.values()),
+            'leaders': self.leaders,
+            'coalesced': self.coalesced,
+        }
+
+
+single_flight = SingleFlight()
@@ -1,20 +1,43 @@
 import os
+import math
 import tempfile
 import secrets
 import time
 import sys
-from typing import Tuple, Optional
-from .ffmpeg_utils import probe_media, encode_webm, get_file_size_kb
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Tuple, Optional, Union, List
+from .ffmpeg_utils import probe_media, encode_webm, get_file_size_kb, decode_to_raw, vp9_output_args, RawVideo
+from .progress import report
 
 MAX_STICKER_KB = int(os.getenv('MAX_STICKER_KB', '256'))
 MAX_SECONDS = float(os.getenv('MAX_SECONDS', '3.0'))
 MAX_FPS = int(os.getenv('MAX_FPS', '30'))
 TARGET_SIDE = int(os.getenv('TARGET_SIDE', '512'))
 
+# Search strategy: 'model' predicts the CRF/FPS/side from previous encodes,
+# 'grid' walks the full CRF x FPS x side grid in a fixed order.
+SIZEFIT_MODE = os.getenv('SIZEFIT_MODE', 'model')
+SIZEFIT_MAX_ENCODES = int(os.getenv('SIZEFIT_MAX_ENCODES', '5'))
+# Encode this many candidates speculatively per search round (1 = sequential)
+SIZEFIT_PARALLEL = max(1, int(os.getenv('SIZEFIT_PARALLEL', '1')))
+# Decode + scale/pad the source once into a raw intermediate shared by all encode attempts
+SIZEFIT_DECODE_ONCE = os.getenv('SIZEFIT_DECODE_ONCE', '1') == '1'
+
+# Size model for libvpx-vp9 in constant quality mode
+CRF_MIN = 32
+CRF_MAX = 48
+CRF_HALVING_STEP = 6.0  # Output size roughly halves every ~6 CRF steps
+FPS_EXPONENT = 0.7      # Size grows sub-linearly with frame rate (inter frames are cheap)
+SIZE_HEADROOM = 0.92    # Aim a bit below the limit so a small misprediction still fits
+ACCEPT_RATIO = 0.80     # A fit above 80% of the limit is close enough to stop searching
+
+
 def fit_to_limits(
     input_path: str,
     prefer_seconds: float = 2.8,
-    pad_mode: str = 'transparent'
+    pad_mode: str = 'transparent',
+    mode: Optional[str] = None
 ) -> Tuple[str, dict]:
     """
     Convert media to Telegram-compliant WEBM VP9 sticker.
@@ -26,6 +49,386 @@ def fit_to_limits(
     # Trim to max duration
     actual_duration = min(duration, MAX_SECONDS, prefer_seconds)
     
+    # Pay for decode + scale/pad once, every attempt below only pays for encoding
+    source: Union[str, RawVideo] = input_path
+    raw = None
+    if SIZEFIT_DECODE_ONCE:
+        start_time = time.time()
+        report('decode')
+        raw = decode_to_raw(input_path, TARGET_SIDE, max(1, min(int(round(fps)), MAX_FPS)), actual_duration)
+        if raw:
+            source = raw
+            print(f"[sizefit] Decoded {raw.frame_count} frames to raw intermediate in {time.time() - start_time:.1f}s", flush=True)
+        else:
+            print(f"[sizefit] ⚠️ Raw decode failed, encoding from original input", flush=True)
+    
+    try:
+        return _fit_source(source, actual_duration, fps, mode)
+    finally:
+        if raw:
+            raw.cleanup()
+
+
+def fit_raw_to_limits(
+    raw: RawVideo,
+    duration: float,
+    mode: Optional[str] = None,
+    seed_path: Optional[str] = None
+) -> Tuple[str, dict]:
+    """
+    Size-fit frames the caller already holds as a lossless raw intermediate,
+    skipping the probe/decode of fit_to_limits (and any lossy intermediate encode).
+    seed_path is an optional encode made with seed_output_args() while the frames
+    were produced; it counts as the first model-search attempt.
+    Returns (output_path, metadata).
+    """
+    actual_duration = min(duration, MAX_SECONDS)
+    return _fit_source(raw, actual_duration, raw.fps, mode, seed_path)
+
+
+def seed_output_args(fps: int, duration: float, output_path: str) -> List[str]:
+    """FFmpeg output args of the first model-search attempt (best quality, full size)."""
+    return vp9_output_args(output_path, min(int(fps), MAX_FPS), CRF_MIN, min(duration, MAX_SECONDS))
+
+
+def _fit_source(
+    source: Union[str, RawVideo],
+    actual_duration: float,
+    fps: float,
+    mode: Optional[str] = None,
+    seed_path: Optional[str] = None
+) -> Tuple[str, dict]:
+    mode = mode or SIZEFIT_MODE
+    if mode == 'grid':
+        _discard(seed_path)
+        return _fit_grid(source, actual_duration, fps)
+    if seed_path and not os.path.exists(seed_path):
+        seed_path = None
+    return _fit_model(source, actual_duration, fps, seed_path)
+
+
+class _SizeModel:
+    """
+    Log-linear model of encoded size: kb = ref_kb * exp(-k * dCRF) * dFPS^a * dSide^2.
+    Re-anchored on every real encode, slope calibrated from pairs of encodes.
+    """
+    def __init__(self, crf: int, fps: int, side: int, kb: float):
+        self.k = math.log(2) / CRF_HALVING_STEP
+        self.anchor(crf, fps, side, kb)
+    
+    def anchor(self, crf: int, fps: int, side: int, kb: float):
+        self.ref = (crf, fps, side, max(kb, 1.0))
+    
+    def calibrate(self, crf_a: int, kb_a: float, crf_b: int, kb_b: float):
+        """Refit the CRF slope from two encodes at the same FPS/side."""
+        if crf_a == crf_b or kb_a <= 0 or kb_b <= 0:
+            return
+        k = math.log(kb_a / kb_b) / (crf_b - crf_a)
+        # Keep the slope in a sane range, VP9 noise can make single pairs misleading
+        self.k = min(max(k, 0.03), 0.30)
+    
+    def predict(self, crf: float, fps: int, side: int) -> float:
+        ref_crf, ref_fps, ref_side, ref_kb = self.ref
+        return (ref_kb
+                * math.exp(-self.k * (crf - ref_crf))
+                * (fps / ref_fps) ** FPS_EXPONENT
+                * (side / ref_side) ** 2)
+    
+    def crf_for(self, target_kb: float, fps: int, side: int) -> float:
+        """CRF predicted to land exactly on target_kb at the given FPS/side."""
+        at_ref_crf = self.predict(self.ref[0], fps, side)
+        return self.ref[0] + math.log(at_ref_crf / target_kb) / self.k
+
+
+def _encode_attempt(
+    input_path: Union[str, RawVideo],
+    temp_dir: str,
+    actual_duration: float,
+    crf_val: int,
+    fps_val: int,
+    side: int,
+    cancel_event: Optional[threading.Event] = None
+) -> Tuple[Optional[str], float]:
+    """Run a single encode. Returns (output_path, size_kb) or (None, 0) on failure/cancel."""
+    unique_id = secrets.token_hex(8)
+    timestamp = int(time.time() * 1000)
+    output_path = os.path.join(
+        temp_dir,
+        f'sticker_{timestamp}_{unique_id}_{side}_{fps_val}_{crf_val}.webm'
+    )
+    print(f"[sizefit] Attempting encode: CRF={crf_val}, FPS={fps_val}, Side={side}, Duration={actual_duration}", flush=True)
+    start_time = time.time()
+    if encode_webm(input_path, output_path, fps_val, crf_val, side, actual_duration,
+                   preserve_alpha=True, cancel_event=cancel_event):
+        size_kb = os.path.getsize(output_path) / 1024
+        print(f"[sizefit] ✅ Encode successful: {size_kb:.1f}KB (CRF={crf_val}, FPS={fps_val}, Side={side}) in {time.time() - start_time:.1f}s", flush=True)
+        return output_path, size_kb
+    
+    if not (cancel_event and cancel_event.is_set()):
+        print(f"[sizefit] ❌ Encode failed: CRF={crf_val}, FPS={fps_val}, Side={side} (took {time.time() - start_time:.1f}s)", flush=True)
+    _discard(output_path)
+    return None, 0
+
+
+def _discard(path: Optional[str]):
+    if path and os.path.exists(path):
+        try:
+            os.unlink(path)
+        except:
+            pass
+
+
+def _encode_speculative(
+    input_path: Union[str, RawVideo],
+    temp_dir: str,
+    actual_duration: float,
+    tiers: List[Tuple[int, int]],
+    candidates: List[Tuple[int, int]]
+) -> List[Tuple[int, int, Optional[str], float, bool]]:
+    """
+    Encode several (crf, tier_idx) candidates at once.
+    Size is monotonic in quality, so as soon as one candidate fits, every worse
+    candidate is killed, and as soon as one is too large, every better one is killed.
+    Returns (crf, tier_idx, path, kb, cancelled) for every candidate.
+    """
+    events = {c: threading.Event() for c in candidates}
+    results = []
+    with ThreadPoolExecutor(max_workers=len(candidates), thread_name_prefix='sizefit') as pool:
+        futures = {
+            pool.submit(_encode_attempt, input_path, temp_dir, actual_duration,
+                        c[0], tiers[c[1]][0], tiers[c[1]][1], events[c]): c
+            for c in candidates
+        }
+        for future in as_completed(futures):
+            crf_val, tier_idx = futures[future]
+            path, kb = future.result()
+            cancelled = events[(crf_val, tier_idx)].is_set()
+            results.append((crf_val, tier_idx, path, kb, cancelled))
+            if path is None:
+                continue
+            # Quality order: lower tier first, then lower CRF
+            fits = kb <= MAX_STICKER_KB
+            for other, event in events.items():
+                if other == (crf_val, tier_idx) or event.is_set():
+                    continue
+                worse = (other[1], other[0]) > (tier_idx, crf_val)
+                same_tier = other[1] == tier_idx
+                if (fits and worse) or (not fits and same_tier and not worse):
+                    event.set()
+    
+    cancelled_count = sum(1 for r in results if r[4])
+    if cancelled_count:
+        print(f"[sizefit] Cancelled {cancelled_count} speculative encodes", flush=True)
+    return results
+
+
+def _fit_model(
+    input_path: Union[str, RawVideo],
+    actual_duration: float,
+    fps: float,
+    seed_path: Optional[str] = None
+) -> Tuple[str, dict]:
+    """
+    Model-driven search: encode once at best quality, use the resulting size to
+    predict the CRF/FPS/side that lands under MAX_STICKER_KB, then bisect on CRF.
+    With SIZEFIT_PARALLEL > 1 each round encodes several candidates speculatively.
+    Returns (output_path, metadata).
+    """
+    temp_dir = '/tmp/packputer'
+    os.makedirs(temp_dir, exist_ok=True)
+    
+    max_fps = min(int(fps), MAX_FPS)
+    fps_options = [max_fps] + [f for f in (24, 20, 15) if f < max_fps]
+    # Degradation tiers: keep 512px as long as possible, drop FPS before size
+    tiers = [(f, TARGET_SIDE) for f in fps_options]
+    tiers += [(fps_options[-1], s) for s in (480, 448) if s < TARGET_SIDE]
+    target_kb = MAX_STICKER_KB * SIZE_HEADROOM
+    # Speculative rounds launch several encodes, leave room for at least two rounds
+    max_encodes = max(SIZEFIT_MAX_ENCODES, 2 * SIZEFIT_PARALLEL)
+    
+    model = None
+    too_big = {}   # tier -> highest CRF known to be over the limit
+    tried = set()  # (crf, tier) already encoded
+    failed_tiers = set()
+    fit = None       # (path, kb, crf, tier_idx) best compliant encode
+    fallback = None  # (path, kb, crf, tier_idx) smallest oversize encode
+    last = None      # (crf, tier, kb) previous successful encode
+    encodes_attempted = 0
+    encodes_cancelled = 0
+    
+    print(f"[sizefit] Starting model search: CRF={CRF_MIN}, FPS={max_fps}, Side={TARGET_SIDE}, budget={max_encodes} encodes, parallel={SIZEFIT_PARALLEL}", flush=True)
+    
+    if seed_path:
+        # The caller already encoded the first candidate while producing the frames
+        tried.add((CRF_MIN, 0))
+        encodes_attempted += 1
+        pending = [(CRF_MIN, 0, seed_path, os.path.getsize(seed_path) / 1024, False)]
+        candidates = []
+    else:
+        pending = None
+        candidates = _next_candidates(model, tiers, target_kb, fit, too_big, tried, failed_tiers, SIZEFIT_PARALLEL)
+    
+    while pending or (candidates and encodes_attempted < max_encodes):
+        if pending:
+            results, pending = pending, None
+        else:
+            candidates = candidates[:max_encodes - encodes_attempted]
+            tried.update(candidates)
+            encodes_attempted += len(candidates)
+            report('encode', step=encodes_attempted, total=max_encodes, candidates=len(candidates))
+            if len(candidates) == 1:
+                crf_val, tier_idx = candidates[0]
+                path, kb = _encode_attempt(input_path, temp_dir, actual_duration, crf_val, *tiers[tier_idx])
+                results = [(crf_val, tier_idx, path, kb, False)]
+            else:
+                results = _encode_speculative(input_path, temp_dir, actual_duration, tiers, candidates)
+        
+        # Record in quality order so consecutive encodes of a tier calibrate the model
+        for crf_val, tier_idx, path, kb, cancelled in sorted(results, key=lambda r: (r[1], r[0])):
+            if cancelled:
+                encodes_cancelled += 1
+                _discard(path)
+                continue
+            if path is None:
+                failed_tiers.add(tier_idx)
+                continue
+            fps_val, side = tiers[tier_idx]
+            if kb <= MAX_STICKER_KB:
+                # Lower tier index wins (more FPS/size), then lower CRF (better quality)
+                if fit is None or (tier_idx, crf_val) < (fit[3], fit[2]):
+                    _discard(fit[0] if fit else None)
+                    fit = (path, kb, crf_val, tier_idx)
+                else:
+                    _discard(path)
+            else:
+                too_big[tier_idx] = max(too_big.get(tier_idx, 0), crf_val)
+                if fallback is None or kb < fallback[1]:
+                    _discard(fallback[0] if fallback else None)
+                    fallback = (path, kb, crf_val, tier_idx)
+                else:
+                    _discard(path)
+                print(f"[sizefit] ⚠️ Size too large: {kb:.1f}KB > {MAX_STICKER_KB}KB", flush=True)
+            
+            if model is None:
+                model = _SizeModel(crf_val, fps_val, side, kb)
+            else:
+                if last and last[1] == tier_idx:
+                    model.calibrate(last[0], last[2], crf_val, kb)
+                model.anchor(crf_val, fps_val, side, kb)
+            last = (crf_val, tier_idx, kb)
+        
+        candidates = _next_candidates(model, tiers, target_kb, fit, too_big, tried, failed_tiers, SIZEFIT_PARALLEL)
+    
+    if fit:
+        _discard(fallback[0] if fallback else None)
+        best_path, best_kb, best_crf, best_tier = fit
+        print(f"[sizefit] ✅ Found valid sticker: {best_kb:.1f}KB (CRF={best_crf}, FPS={tiers[best_tier][0]}, Side={tiers[best_tier][1]}) after {encodes_attempted} encodes", flush=True)
+    elif fallback:
+        best_path, best_kb, best_crf, best_tier = fallback
+        print(f"[sizefit] ⚠️ No compliant encode within {encodes_attempted} encodes, returning smallest: {best_kb:.1f}KB", flush=True)
+    else:
+        raise ValueError('Failed to create compliant sticker')
+    
+    fps_val, side = tiers[best_tier]
+    _, _, _, _, output_pix_fmt, _ = probe_media(best_path)
+    metadata = {
+        'duration': actual_duration,
+        'kb': int(best_kb),
+        'width': side,
+        'height': side,
+        'fps': fps_val,
+        'pix_fmt': output_pix_fmt or 'yuva420p',
+        'encodes_attempted': encodes_attempted
+    }
+    if encodes_cancelled:
+        metadata['encodes_cancelled'] = encodes_cancelled
+    return best_path, metadata
+
+
+def _next_candidates(model, tiers, target_kb, fit, too_big, tried, failed_tiers, count) -> List[Tuple[int, int]]:
+    """
+    Pick the next (crf, tier_idx) candidates to encode, best guess first.
+    With count > 1 the best guess is surrounded by a spread of CRFs on the same tier.
+    """
+    if model is None and not failed_tiers and count > 1:
+        # Nothing measured yet: spread the first round across the CRF range
+        step = (CRF_MAX - CRF_MIN) / count
+        crfs = sorted({int(CRF_MIN + i * step) for i in range(count)})
+        return [(crf_val, 0) for crf_val in crfs]
+    
+    primary = _next_candidate(model, tiers, target_kb, fit, too_big, tried, failed_tiers)
+    if primary is None or count <= 1 or model is None:
+        return [primary] if primary else []
+    
+    crf_val, tier_idx = primary
+    if fit and fit[3] == tier_idx:
+        # Bisecting: fill the open interval between too-big and the fit
+        lo, hi = too_big.get(tier_idx, CRF_MIN - 1), fit[2]
+    else:
+        lo, hi = too_big.get(tier_idx, CRF_MIN - 1), CRF_MAX + 1
+    
+    picked = [primary]
+    for offset in (3, -3, 6, -6, 1, -1, 2, -2):
+        if len(picked) >= count:
+            break
+        other = (crf_val + offset, tier_idx)
+        if lo < other[0] < hi and other not in tried and other not in picked:
+            picked.append(other)
+    return picked
+
+
+def _next_candidate(model, tiers, target_kb, fit, too_big, tried, failed_tiers) -> Optional[Tuple[int, int]]:
+    """Pick the next (crf, tier_idx) to encode, or None when the search is done."""
+    if model is None:
+        # First encode failed outright: retry on the next tier at best quality
+        for tier_idx in range(len(tiers)):
+            if tier_idx not in failed_tiers and (CRF_MIN, tier_idx) not in tried:
+                return CRF_MIN, tier_idx
+        return None
+    
+    if fit:
+        # Bisect towards better quality between the last too-big CRF and the fit
+        _, fit_kb, fit_crf, tier_idx = fit
+        if fit_kb >= MAX_STICKER_KB * ACCEPT_RATIO:
+            return None
+        lo = too_big.get(tier_idx, CRF_MIN - 1)
+        if fit_crf - lo <= 1:
+            return None
+        fps_val, side = tiers[tier_idx]
+        crf_val = int(math.ceil(model.crf_for(target_kb, fps_val, side)))
+        crf_val = min(max(crf_val, lo + 1), fit_crf - 1)
+        if (crf_val, tier_idx) in tried:
+            crf_val = (lo + fit_crf) // 2
+        if crf_val <= lo or (crf_val, tier_idx) in tried:
+            return None
+        return crf_val, tier_idx
+    
+    for tier_idx, (fps_val, side) in enumerate(tiers):
+        if tier_idx in failed_tiers:
+            continue
+        crf_val = int(math.ceil(model.crf_for(target_kb, fps_val, side)))
+        crf_val = max(crf_val, CRF_MIN, too_big.get(tier_idx, 0) + 1)
+        if crf_val > CRF_MAX:
+            # Even the worst allowed quality is predicted too large here
+            continue
+        if (crf_val, tier_idx) not in tried:
+            return crf_val, tier_idx
+    
+    # Model says nothing fits: last resort is the most degraded setting
+    last_tier = len(tiers) - 1
+    if (CRF_MAX, last_tier) not in tried and last_tier not in failed_tiers:
+        return CRF_MAX, last_tier
+    return None
+
+def _fit_grid(
+    input_path: Union[str, RawVideo],
+    actual_duration: float,
+    fps: float
+) -> Tuple[str, dict]:
+    """
+    Legacy exhaustive search over CRF x FPS x side.
+    Returns (output_path, metadata).
+    """
     # Start with best quality first, only degrade if needed
     # This is MUCH faster than trying all combinations
     current_fps = min(int(fps), MAX_FPS)
@@ -41,6 +444,7 @@ def fit_to_limits(
     best_path = None
     best_size = float('inf')
     best_metadata = {}
+    encodes_attempted = 0
     
     # Use shared volume for bot access
     temp_dir = '/tmp/packputer'
@@ -68,6 +472,8 @@ def fit_to_limits(
                 # Try encoding (preserve alpha for transparent stickers)
                 print(f"[sizefit] Attempting encode: CRF={crf_val}, FPS={fps_val}, Side={side}, Duration={actual_duration}", flush=True)
                 start_time = time.time()
+                encodes_attempted += 1
+                report('encode', step=encodes_attempted, crf=crf_val, fps=fps_val, side=side)
                 if encode_webm(input_path, output_path, fps_val, crf_val, side, actual_duration, preserve_alpha=True):
                     encode_time = time.time() - start_time
                     size_kb = get_file_size_kb(output_path)
@@ -172,5 +578,6 @@ def fit_to_limits(
     if not best_path or not os.path.exists(best_path):
         raise ValueError('Failed to create compliant sticker')
     
+    best_metadata['encodes_attempted'] = encodes_attempted
     return best_path, best_metadata
 
@@ -0,0 +1,78 @@
+"""
+Text Layer Sprites
+Rasterizes stroked captions once per font size into cached sprites, instead of
+loading fonts and drawing stroke passes for every frame.
+"""
+import logging
+from functools import lru_cache
+from typing import Tuple
+from PIL import Image, ImageDraw, ImageFont
+from .compositor import Layer, premultiply
+
+logger = logging.getLogger(__name__)
+
+FONT_PATHS = [
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf',
+    '/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf',
+    '/System/Library/Fonts/Helvetica.ttc',
+]
+
+TEXT_FILL = (255, 255, 255, 255)  # White text
+STROKE_FILL = (0, 0, 0, 255)      # Black stroke
+
+
+@lru_cache(maxsize=64)
+def load_font(size: int) -> ImageFont.ImageFont:
+    """Load the bold sticker font at the given size (cached process-wide)."""
+    for font_path in FONT_PATHS:
+        try:
+            return ImageFont.truetype(font_path, size)
+        except Exception:
+            continue
+    logger.warning("No TrueType font found, using PIL default font")
+    return ImageFont.load_default()
+
+
+@lru_cache(maxsize=256)
+def render_caption(text: str, font_size: int, stroke_width: int) -> Tuple[Image.Image, int, int]:
+    """
+    Rasterize a stroked caption once (cached process-wide).
+    Returns (sprite, dx, dy): the sprite belongs at (text_x + dx, text_y + dy)
+    where (text_x, text_y) is the draw.text origin.
+    Cached sprites are shared, callers must not modify them.
+    """
+    font = load_font(font_size)
+    probe = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+    try:
+        left, top, right, bottom = probe.textbbox((0, 0), text, font=font, stroke_width=stroke_width)
+    except (TypeError, ValueError):
+        # Bitmap fallback fonts can't be stroked
+        stroke_width = 0
+        left, top, right, bottom = probe.textbbox((0, 0), text, font=font)
+
+    sprite = Image.new('RGBA', (max(1, right - left), max(1, bottom - top)), (0, 0, 0, 0))
+    ImageDraw.Draw(sprite).text(
+        (-left, -top), text, font=font, fill=TEXT_FILL,
+        stroke_width=stroke_width, stroke_fill=STROKE_FILL
+    )
+    return sprite, left, top
+
+
+@lru_cache(maxsize=256)
+def text_width(text: str, font_size: int) -> int:
+    """Width of the unstroked caption, as used for centering."""
+    bbox = ImageDraw.Draw(Image.new('RGBA', (1, 1))).textbbox((0, 0), text, font=load_font(font_size))
+    return bbox[2] - bbox[0]
+
+
+@lru_cache(maxsize=256)
+def caption_layer(text: str, font_size: int, stroke_width: int) -> Layer:
+    """Premultiplied caption sprite (cached process-wide), positioned relative to the draw.text origin."""
+    sprite, dx, dy = render_caption(text, font_size, stroke_width)
+    layer = premultiply(sprite)
+    return Layer(layer.pixels, layer.dx + dx, layer.dy + dy)
+
+
+def caption_origin_x(text: str, font_size: int, canvas_width: int) -> int:
+    """draw.text x origin that centers the caption horizontally."""
+    return (canvas_width - text_width(text, font_size)) // 2
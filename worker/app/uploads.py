@@ -0,0 +1,235 @@
+"""
+Streaming Upload Storage
+Writes uploads into the shared volume in chunks, hashing them on the fly,
+instead of reading whole files into memory. Request bodies are size-checked
+and held in the in-flight budget while they are received, since Starlette
+spools multipart bodies to disk before the handler runs.
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import secrets
+import logging
+from typing import Dict, Optional
+from fastapi import UploadFile
+from .artifacts import artifacts
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = '/tmp/packputer'
+UPLOAD_CHUNK = 1024 * 1024
+# Largest single upload accepted, enforced while streaming
+UPLOAD_MAX_MB = float(os.getenv('UPLOAD_MAX_MB', '64'))
+# Total bytes of uploads being written at once (e.g. several large i2v videos)
+UPLOAD_INFLIGHT_MB = float(os.getenv('UPLOAD_INFLIGHT_MB', '256'))
+# Multipart framing and form fields on top of the files in a request body
+UPLOAD_FORM_OVERHEAD = 1024 * 1024
+
+
+class UploadTooLarge(Exception):
+    """Upload exceeds UPLOAD_MAX_MB (reported as 413)."""
+    def __init__(self, limit_bytes: int, what: str = 'Upload'):
+        self.limit_bytes = limit_bytes
+        super().__init__(f'{what} exceeds the {limit_bytes // (1024 * 1024)}MB limit')
+
+
+class SavedUpload:
+    """An upload written to the shared volume."""
+    def __init__(self, path: str, sha256: str, size: int):
+        self.path = path
+        self.sha256 = sha256
+        self.size = size
+
+
+class _ByteBudget:
+    """
+    Async byte semaphore. Reservations are all-or-nothing so concurrent
+    uploads can't deadlock holding partial budgets; a single upload larger
+    than the budget is admitted once nothing else is in flight.
+    """
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        self.waiting = 0
+        self._condition: Optional[asyncio.Condition] = None
+
+    def _get_condition(self) -> asyncio.Condition:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def acquire(self, n: int):
+        condition = self._get_condition()
+        async with condition:
+            self.waiting += 1
+            try:
+                await condition.wait_for(lambda: self.in_use == 0 or self.in_use + n <= self.limit)
+            finally:
+                self.waiting -= 1
+            self.in_use += n
+
+    async def release(self, n: int):
+        condition = self._get_condition()
+        async with condition:
+            self.in_use -= n
+            condition.notify_all()
+
+
+_budget = _ByteBudget(int(UPLOAD_INFLIGHT_MB * 1024 * 1024))
+
+
+def request_body_limit(max_files: int) -> int:
+    """Largest request body for an endpoint taking up to max_files uploads."""
+    return int(UPLOAD_MAX_MB * 1024 * 1024) * max(1, max_files) + UPLOAD_FORM_OVERHEAD
+
+
+class _BodyOverLimit(Exception):
+    pass
+
+
+class RequestBodyLimit:
+    """
+    ASGI middleware for upload endpoints (path -> most files per request).
+    Rejects a body whose Content-Length is over the limit with 413 before any
+    of it is read, holds its length in the in-flight budget until the last
+    chunk has arrived, and cuts off bodies without a Content-Length (chunked)
+    once they pass the limit.
+    """
+    def __init__(self, app, max_files: Dict[str, int]):
+        self.app = app
+        self.max_files = max_files
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'POST' or scope['path'] not in self.max_files:
+            await self.app(scope, receive, send)
+            return
+
+        limit = request_body_limit(self.max_files[scope['path']])
+        length = None
+        for name, value in scope['headers']:
+            if name == b'content-length':
+                try:
+                    length = int(value)
+                except ValueError:
+                    pass
+        if length is not None and length > limit:
+            await _reject(send, limit)
+            return
+
+        reserved = min(length or 0, limit)
+        if reserved:
+            await _budget.acquire(reserved)
+        received = 0
+        over_limit = False
+        started = False
+
+        async def release():
+            nonlocal reserved
+            if reserved:
+                held, reserved = reserved, 0
+                await _budget.release(held)
+
+        async def limited_receive():
+            nonlocal received, over_limit
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > limit:
+                    over_limit = True
+                    raise _BodyOverLimit()
+                if not message.get('more_body', False):
+                    await release()
+            elif message['type'] == 'http.disconnect':
+                await release()
+            return message
+
+        async def tracked_send(message):
+            nonlocal started
+            if over_limit:
+                # The form parser reports the cut-off body as its own error, answer 413 instead
+                if message['type'] == 'http.response.start' and not started:
+                    started = True
+                    await _reject(send, limit)
+                return
+            if message['type'] == 'http.response.start':
+                started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracked_send)
+        except _BodyOverLimit:
+            if not started:
+                started = True
+                await _reject(send, limit)
+        finally:
+            await release()
+            if over_limit:
+                logger.warning(f"Request body to {scope['path']} passed the {limit // (1024 * 1024)}MB limit, rejected")
+
+
+async def _reject(send, limit: int):
+    body = json.dumps({"error": str(UploadTooLarge(limit, 'Request body'))}).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': 413,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def save_upload(
+    file: UploadFile,
+    prefix: str = 'input',
+    default_suffix: str = '.tmp',
+    path: Optional[str] = None
+) -> SavedUpload:
+    """
+    Stream an upload into the shared volume, hashing it as it is written.
+    Raises UploadTooLarge (after removing the partial file) past UPLOAD_MAX_MB.
+    """
+    max_bytes = int(UPLOAD_MAX_MB * 1024 * 1024)
+    if file.size is not None and file.size > max_bytes:
+        raise UploadTooLarge(max_bytes)
+
+    if path is None:
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        suffix = os.path.splitext(file.filename or 'input')[1] or default_suffix
+        # Use timestamp + 8 bytes (16 hex chars) for better uniqueness
+        path = os.path.join(UPLOAD_DIR, f'{prefix}_{int(time.time() * 1000)}_{secrets.token_hex(8)}{suffix}')
+
+    reserved = min(file.size if file.size is not None else max_bytes, max_bytes)
+    await _budget.acquire(reserved)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        await file.seek(0)
+        with open(path, 'wb') as out:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(max_bytes)
+                digest.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        if os.path.exists(path):
+            os.unlink(path)
+        raise
+    finally:
+        await _budget.release(reserved)
+
+    artifacts.register(path, 'input')
+    return SavedUpload(path, digest.hexdigest(), size)
+
+
+def get_upload_stats() -> dict:
+    return {
+        'max_bytes': int(UPLOAD_MAX_MB * 1024 * 1024),
+        'inflight_limit_bytes': _budget.limit,
+        'inflight_bytes': _budget.in_use,
+        'waiting': _budget.waiting,
+    }
@@ -1,16 +1,25 @@
 """
 Video Matting for Background Removal
 Removes background from video frames to create transparent alpha channel.
-Uses Robust Video Matting (RVM) or fallback to frame-by-frame segmentation.
+Uses Robust Video Matting (RVM) or fallback to segmentation.
+
+Frames are streamed: ffmpeg decodes to a rawvideo pipe, masks are applied in
+numpy a few frames at a time, and the matted RGBA frames go straight into a
+RawFrameSink (lossless raw copy plus an optional first encode), so no frame
+is ever written as an image file.
 """
 import os
+import math
+import tempfile
 import subprocess
 import logging
 import numpy as np
-from PIL import Image
-from typing import List, Tuple, Optional
-import tempfile
-import shutil
+from typing import Dict, Iterator, List, Tuple, Optional
+from .ffmpeg_utils import RawFrameSink, RawVideo, probe_media, vp9_output_args
+from .segmentation import MATTE_BATCH, predict_masks
+from .matte_fallback import ClipKeyer
+from .mask_propagation import MATTE_KEYFRAMES, FramePlan, KeyframePlanner, thumbnail, propagate_mask
+from .progress import report
 
 logger = logging.getLogger(__name__)
 
@@ -23,11 +32,18 @@ except ImportError:
     RVM_AVAILABLE = False
     logger.warning("RVM not found. Will use frame-by-frame segmentation fallback.")
 
+# Most decoded frames held at once while their keyframes are segmented
+MATTE_PENDING_FRAMES = int(os.getenv('MATTE_PENDING_FRAMES', '24'))
+
+MattedFrames = Tuple[Optional[RawVideo], bool]
+
 
 def matte_video(
     input_video_path: str,
     output_video_path: str,
-    reference_image_path: Optional[str] = None
+    reference_image_path: Optional[str] = None,
+    side: int = 512,
+    fps: int = 30
 ) -> bool:
     """
     Remove background from video using matting.
@@ -41,18 +57,46 @@ def matte_video(
         True if successful, False otherwise
     """
     logger.info(f"Matting video: {input_video_path} -> {output_video_path}")
+    duration = probe_media(input_video_path)[0]
+    frames, encoded = matte_video_to_raw(
+        input_video_path, side, fps, duration,
+        vp9_output_args(output_video_path, fps, 32),
+        reference_image_path
+    )
+    if frames:
+        frames.cleanup()
+    return encoded
+
+
+def matte_video_to_raw(
+    input_video_path: str,
+    side: int,
+    fps: int,
+    duration: float,
+    output_args: Optional[List[str]] = None,
+    reference_image_path: Optional[str] = None
+) -> MattedFrames:
+    """
+    Matte a video into side x side RGBA frames at a constant fps, kept as a raw
+    intermediate for the size-fit search. With output_args the frames are also
+    encoded while they are produced (e.g. the first size-fit attempt).
     
+    Returns:
+        (raw frames or None on failure, whether the output_args encode succeeded)
+    """
     if RVM_AVAILABLE and reference_image_path:
-        return matte_with_rvm(input_video_path, output_video_path, reference_image_path)
-    else:
-        return matte_with_segmentation(input_video_path, output_video_path)
+        return matte_with_rvm(input_video_path, side, fps, duration, output_args, reference_image_path)
+    return matte_with_segmentation(input_video_path, side, fps, duration, output_args)
 
 
 def matte_with_rvm(
     input_video_path: str,
-    output_video_path: str,
+    side: int,
+    fps: int,
+    duration: float,
+    output_args: Optional[List[str]],
     reference_image_path: str
-) -> bool:
+) -> MattedFrames:
     """
     Use Robust Video Matting (RVM) for high-quality video matting.
     This requires RVM model files and PyTorch.
@@ -61,107 +105,149 @@ def matte_with_rvm(
         # RVM implementation would go here
         # For now, fall back to segmentation
         logger.warning("RVM not fully implemented, using segmentation fallback")
-        return matte_with_segmentation(input_video_path, output_video_path)
+        return matte_with_segmentation(input_video_path, side, fps, duration, output_args)
     except Exception as e:
         logger.error(f"RVM matting failed: {e}")
-        return matte_with_segmentation(input_video_path, output_video_path)
+        return matte_with_segmentation(input_video_path, side, fps, duration, output_args)
+
+
+def _has_alpha(pix_fmt: Optional[str]) -> bool:
+    if not pix_fmt:
+        return False
+    return pix_fmt.startswith(('yuva', 'rgba', 'bgra', 'argb', 'abgr', 'gbrap', 'ya'))
+
+
+def decode_rgba_frames(input_path: str, side: int, fps: int, duration: float) -> Iterator[np.ndarray]:
+    """
+    Decode a video into side x side RGBA frames (scaled to fit, transparent padding)
+    over a rawvideo pipe, one frame in memory at a time.
+    """
+    scale_filter = f"scale='if(gt(iw,ih),{side},-1)':'if(gt(iw,ih),-1,{side})'"
+    pad_filter = f"pad={side}:{side}:(ow-iw)/2:(oh-ih)/2:color=0x00000000@0"
+    cmd = [
+        'ffmpeg',
+        '-i', input_path,
+        '-vf', f"fps={fps},format=rgba,{scale_filter},{pad_filter}",
+        '-an',
+        '-t', str(duration),
+        '-f', 'rawvideo',
+        '-pix_fmt', 'rgba',
+        '-'
+    ]
+    frame_size = side * side * 4
+    frames = 0
+    # Decoding a few seconds is cheap next to matting and the encode that consumes
+    # the frames already holds an ffmpeg slot, so the decoder runs outside the cap
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            while True:
+                data = proc.stdout.read(frame_size)
+                if len(data) < frame_size:
+                    break
+                frames += 1
+                yield np.frombuffer(data, dtype=np.uint8).reshape(side, side, 4).copy()
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            proc.stdout.close()
+            returncode = proc.wait()
+        if frames == 0 and returncode != 0:
+            stderr.seek(0)
+            raise subprocess.CalledProcessError(returncode, cmd, None, stderr.read().decode(errors='replace'))
 
 
 def matte_with_segmentation(
     input_video_path: str,
-    output_video_path: str
-) -> bool:
+    side: int,
+    fps: int,
+    duration: float,
+    output_args: Optional[List[str]] = None
+) -> MattedFrames:
     """
-    Frame-by-frame background removal using segmentation.
-    Extracts frames, processes each, then re-encodes with alpha.
+    Background removal using segmentation.
+    Segments keyframes and propagates their masks to the frames in between,
+    streaming the matted frames into a RawFrameSink.
     """
-    temp_dir = tempfile.mkdtemp(prefix='matte_')
+    _, _, _, _, pix_fmt, _ = probe_media(input_video_path)
+    # Sources with their own alpha keep it, only the scale/pad is applied
+    source_alpha = _has_alpha(pix_fmt)
+    frame_count = max(1, int(math.ceil(duration * fps)))
+    sink = RawFrameSink(side, side, fps, frame_count, output_args)
+    
+    planner = KeyframePlanner() if MATTE_KEYFRAMES else None
+    pending: List[Tuple[np.ndarray, FramePlan]] = []
+    key_masks: Dict[int, np.ndarray] = {}
+    content: Optional[Tuple[slice, slice]] = None  # Unpadded area of the frame
+    keyframes = 0
+    keyer: Optional[ClipKeyer] = None
+    
+    def flush():
+        nonlocal keyer
+        # Segment the pending keyframes in one batch, then write frames in order
+        keys = [(arr, entry) for arr, entry in pending if entry.is_keyframe]
+        masks = predict_masks([arr[content] for arr, _ in keys])
+        if masks is None:
+            # No model: key every pending frame, the backdrop colour is sampled once per clip
+            stack = np.stack([arr[content] for arr, _ in pending])
+            if keyer is None:
+                keyer = ClipKeyer.sample(stack)
+            for (arr, _), alpha in zip(pending, keyer.alpha(stack)):
+                np.minimum(arr[content][:, :, 3], alpha, out=arr[content][:, :, 3])
+                sink.write(arr.tobytes())
+            pending.clear()
+            report('matte', step=sink.frames_written, total=frame_count)
+            return
+        for k, (arr, entry) in enumerate(keys):
+            mask = np.zeros(arr.shape[:2], dtype=np.uint8)
+            mask[content] = masks[k]
+            key_masks[entry.index] = mask
+        for arr, entry in pending:
+            # Padding stays transparent
+            np.minimum(arr[:, :, 3], propagate_mask(key_masks[entry.keyframe], entry), out=arr[:, :, 3])
+            sink.write(arr.tobytes())
+        # Later frames can only refer to the latest keyframe
+        latest = pending[-1][1].keyframe
+        for index in [i for i in key_masks if i != latest]:
+            del key_masks[index]
+        pending.clear()
+        report('matte', step=sink.frames_written, total=frame_count, keyframes=keyframes)
     
     try:
-        # Extract frames
-        frames_dir = os.path.join(temp_dir, 'frames')
-        alpha_dir = os.path.join(temp_dir, 'alpha')
-        os.makedirs(frames_dir, exist_ok=True)
-        os.makedirs(alpha_dir, exist_ok=True)
-        
-        logger.info("Extracting frames from video...")
-        extract_cmd = [
-            'ffmpeg',
-            '-i', input_video_path,
-            '-vf', 'fps=30',
-            os.path.join(frames_dir, 'frame_%05d.png')
-        ]
-        subprocess.run(extract_cmd, check=True, capture_output=True)
-        
-        # Process each frame
-        frame_files = sorted([f for f in os.listdir(frames_dir) if f.endswith('.png')])
-        logger.info(f"Processing {len(frame_files)} frames...")
-        
-        for i, frame_file in enumerate(frame_files):
-            frame_path = os.path.join(frames_dir, frame_file)
-            frame = Image.open(frame_path).convert('RGBA')
-            
-            # Simple background removal: assume edges are background
-            # For production, use rembg or similar per frame
-            arr = np.array(frame)
-            alpha = arr[:, :, 3]
-            
-            # If frame already has transparency, use it
-            if np.any(alpha < 255):
-                # Frame already has alpha, keep it
-                pass
-            else:
-                # Simple chroma key: remove green/blue backgrounds
-                # Or use rembg for each frame
-                try:
-                    from rembg import remove
-                    frame_rgba = remove(frame)
-                    arr = np.array(frame_rgba)
-                except ImportError:
-                    logger.warning("rembg not available, using simple edge-based removal")
-                    # Fallback: assume center is subject, edges are background
-                    h, w = arr.shape[:2]
-                    center_y, center_x = h // 2, w // 2
-                    
-                    # Create distance-based alpha (fade edges)
-                    y, x = np.ogrid[:h, :w]
-                    dist_from_center = np.sqrt((x - center_x)**2 + (y - center_y)**2)
-                    max_dist = np.sqrt(center_x**2 + center_y**2)
-                    alpha_mask = (1 - dist_from_center / max_dist * 0.3).clip(0, 1)
-                    arr[:, :, 3] = (alpha_mask * 255).astype(np.uint8)
-            
-            # Save processed frame
-            processed_frame = Image.fromarray(arr, mode='RGBA')
-            processed_frame.save(frame_path)
-            
-            if (i + 1) % 10 == 0:
-                logger.info(f"Processed {i + 1}/{len(frame_files)} frames")
-        
-        # Re-encode with alpha
-        logger.info("Re-encoding video with alpha channel...")
-        encode_cmd = [
-            'ffmpeg',
-            '-y',
-            '-framerate', '30',
-            '-i', os.path.join(frames_dir, 'frame_%05d.png'),
-            '-c:v', 'libvpx-vp9',
-            '-pix_fmt', 'yuva420p',  # VP9 with alpha
-            '-auto-alt-ref', '0',
-            '-crf', '32',
-            '-b:v', '0',
-            '-an',  # No audio
-            output_video_path
-        ]
-        subprocess.run(encode_cmd, check=True, capture_output=True)
-        
-        logger.info(f"✅ Video matting complete: {output_video_path}")
-        return True
-        
+        for index, arr in enumerate(decode_rgba_frames(input_video_path, side, fps, duration)):
+            if index >= frame_count:
+                break
+            if source_alpha:
+                sink.write(arr.tobytes())
+                continue
+            if content is None:
+                ys, xs = np.nonzero(arr[:, :, 3])
+                if len(ys) == 0:
+                    raise ValueError("Decoded frame is empty")
+                content = (slice(ys.min(), ys.max() + 1), slice(xs.min(), xs.max() + 1))
+            entry = planner.add(thumbnail(arr)) if planner else FramePlan(index, index, 0.0, 0.0)
+            keyframes += entry.is_keyframe
+            pending.append((arr, entry))
+            if len(pending) >= MATTE_PENDING_FRAMES or sum(e.is_keyframe for _, e in pending) >= MATTE_BATCH:
+                flush()
+        if pending:
+            flush()
+        if sink.frames_written == 0:
+            raise ValueError("No frames decoded")
     except Exception as e:
         logger.error(f"Video matting failed: {e}", exc_info=True)
-        return False
-    finally:
-        # Cleanup temp directory
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir, ignore_errors=True)
-
+        sink.discard()
+        return None, False
+    
+    encoded = output_args is not None
+    try:
+        sink.close()
+    except subprocess.CalledProcessError as e:
+        logger.warning(f"Encode during matting failed: {(e.stderr or '')[-1000:]}")
+        encoded = False
+    
+    if source_alpha or keyer is not None:
+        logger.info(f"✅ Matted {sink.frames_written} frames")
+    else:
+        logger.info(f"✅ Matted {sink.frames_written} frames ({sink.frames_written - keyframes} propagated)")
+    return sink.raw, encoded
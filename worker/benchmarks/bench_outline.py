@@ -0,0 +1,94 @@
+"""
+Outline benchmark: previous dilation-based add_outline (square SciPy
+binary_dilation, or PIL MaxFilter without SciPy) against the distance
+transform outline, at every outline width and a few canvas sizes.
+
+Run from worker/:  python benchmarks/bench_outline.py [--repeat N]
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import sticker_asset  # noqa: E402
+from app.sticker_asset import (  # noqa: E402
+    OUTLINE_WIDTH_MIN, OUTLINE_WIDTH_MAX, subject_distance, outline_alpha, composite_behind
+)
+
+
+def legacy_outline(img: Image.Image, outline_width: int, use_scipy: bool) -> Image.Image:
+    """add_outline before the distance transform change."""
+    arr = np.array(img)
+    alpha_channel = img.split()[3]
+    alpha_array = np.array(alpha_channel)
+    mask = alpha_array > 128
+    if use_scipy:
+        from scipy.ndimage import binary_dilation
+        structure = np.ones((outline_width * 2 + 1, outline_width * 2 + 1))
+        outline_mask = binary_dilation(mask, structure=structure, iterations=1) & ~mask
+    else:
+        alpha_expanded = np.array(alpha_channel.filter(ImageFilter.MaxFilter(size=outline_width * 2 + 1)))
+        outline_mask = (alpha_expanded > 128) & (alpha_array <= 128)
+    outline_arr = np.zeros_like(arr)
+    outline_arr[outline_mask] = 255
+    return Image.alpha_composite(Image.fromarray(outline_arr, mode='RGBA'), img)
+
+
+def edt_outline(img: Image.Image, outline_width: int) -> np.ndarray:
+    """Current outline: distance field, threshold, composite behind the subject."""
+    canvas = np.array(img)
+    outline = outline_alpha(subject_distance(canvas[:, :, 3]), outline_width)
+    return composite_behind(canvas, outline, np.zeros_like(outline))
+
+
+def subject(size: int) -> Image.Image:
+    img = Image.new('RGBA', (size, size), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    draw.ellipse((size * 0.2, size * 0.1, size * 0.8, size * 0.6), fill=(220, 40, 40, 255))
+    draw.rectangle((size * 0.3, size * 0.5, size * 0.7, size * 0.9), fill=(40, 40, 220, 255))
+    return img
+
+
+def best_of(fn, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--sizes', default='512,1024')
+    args = parser.parse_args()
+
+    has_scipy = sticker_asset.HAS_SCIPY
+    print(f"scipy: {'yes' if has_scipy else 'no'}")
+    print(f"{'size':>5} {'width':>5} {'legacy scipy':>13} {'legacy PIL':>11} {'EDT scipy':>10} {'EDT numpy':>10}   (ms, best of {args.repeat})")
+    for size in (int(s) for s in args.sizes.split(',')):
+        img = subject(size)
+        for width in (OUTLINE_WIDTH_MIN, (OUTLINE_WIDTH_MIN + OUTLINE_WIDTH_MAX) // 2, OUTLINE_WIDTH_MAX):
+            row = []
+            row.append(best_of(lambda: legacy_outline(img, width, True), args.repeat) if has_scipy else None)
+            row.append(best_of(lambda: legacy_outline(img, width, False), args.repeat))
+            sticker_asset.HAS_SCIPY = has_scipy
+            row.append(best_of(lambda: edt_outline(img, width), args.repeat) if has_scipy else None)
+            sticker_asset.HAS_SCIPY = False
+            row.append(best_of(lambda: edt_outline(img, width), args.repeat))
+            sticker_asset.HAS_SCIPY = has_scipy
+            cells = ' '.join(f"{v:>{n}.1f}" if v is not None else f"{'-':>{n}}" for v, n in zip(row, (13, 11, 10, 10)))
+            print(f"{size:>5} {width:>5} {cells}")
+
+        # The shadow step reuses the field instead of blurring the alpha again
+        alpha = np.asarray(img.getchannel('A'))
+        print(f"{size:>5}  distance field alone: {best_of(lambda: subject_distance(alpha), args.repeat):.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+A coalesced job owns its leader's input: cancelling the leader must not delete
+the file while the shared encode/render is still queued or reading it.
+"""
+import os
+import time
+import asyncio
+import hashlib
+import secrets
+import pytest
+
+from app import convert, main
+from app.result_cache import cached_output_path
+from app.uploads import SavedUpload
+
+
+@pytest.fixture(autouse=True)
+def no_result_cache(monkeypatch):
+    # Every run must reach the (fake) encode instead of a cached result
+    monkeypatch.setattr(convert, 'RESULT_CACHE_ENABLED', False)
+    monkeypatch.setattr(main, 'RESULT_CACHE_ENABLED', False)
+
+
+def _write_input(content: bytes, prefix: str) -> str:
+    os.makedirs('/tmp/packputer', exist_ok=True)
+    path = os.path.join('/tmp/packputer', f'{prefix}_{int(time.time() * 1000)}_{secrets.token_hex(8)}.png')
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+
+def _slow_copy(input_path: str, output_path: str) -> bytes:
+    # Stands in for the encode: still reading the input well after the leader is gone
+    time.sleep(0.3)
+    with open(input_path, 'rb') as f:
+        data = f.read()
+    with open(output_path, 'wb') as f:
+        f.write(data)
+    return data
+
+
+def test_cancelled_convert_leader_keeps_input_for_follower(monkeypatch):
+    def fake_fit(input_path, prefer_seconds, pad_mode):
+        output_path = cached_output_path('sticker')
+        _slow_copy(input_path, output_path)
+        return output_path, {'kb': 1}
+
+    monkeypatch.setattr(convert, 'fit_to_limits', fake_fit)
+
+    async def scenario():
+        content = secrets.token_bytes(256)
+        content_hash = hashlib.sha256(content).hexdigest()
+        leader_input = _write_input(content, 'input')
+        follower_input = _write_input(content, 'input')
+
+        leader = asyncio.create_task(convert.convert_path(leader_input, content_hash=content_hash))
+        await asyncio.sleep(0.05)
+        follower = asyncio.create_task(convert.convert_path(follower_input, content_hash=content_hash))
+        await asyncio.sleep(0.05)
+        # The follower's duplicate upload is released as soon as it joins
+        assert not os.path.exists(follower_input)
+
+        leader.cancel()
+        await asyncio.sleep(0)
+        assert os.path.exists(leader_input)
+
+        output_path, _ = await follower
+        with open(output_path, 'rb') as f:
+            assert f.read() == content
+        # Released by the flight once the encode finished
+        assert not os.path.exists(leader_input)
+        os.unlink(output_path)
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_render_leader_keeps_input_for_follower(monkeypatch):
+    def fake_render(base_image_path, blueprint_json, output_path, subject=None):
+        _slow_copy(base_image_path, output_path)
+        return {'kb': 1}
+
+    monkeypatch.setattr(main, 'render_animation', fake_render)
+
+    async def scenario():
+        content = secrets.token_bytes(256)
+        content_hash = hashlib.sha256(content).hexdigest()
+        blueprint_json = '{"duration_sec": 1, "fps": 10, "loop": true}'
+        leader_upload = SavedUpload(_write_input(content, 'ai_input'), content_hash, len(content))
+        follower_upload = SavedUpload(_write_input(content, 'ai_input'), content_hash, len(content))
+
+        leader = asyncio.create_task(main.render_upload(leader_upload, blueprint_json))
+        await asyncio.sleep(0.05)
+        follower = asyncio.create_task(main.render_upload(follower_upload, blueprint_json))
+        await asyncio.sleep(0.05)
+        assert not os.path.exists(follower_upload.path)
+
+        leader.cancel()
+        await asyncio.sleep(0)
+        assert os.path.exists(leader_upload.path)
+
+        result = await follower
+        with open(result['output_path'], 'rb') as f:
+            assert f.read() == content
+        assert not os.path.exists(leader_upload.path)
+        os.unlink(result['output_path'])
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_sole_caller_releases_input_after_pool_work(monkeypatch):
+    finished = []
+
+    def fake_fit(input_path, prefer_seconds, pad_mode):
+        output_path = cached_output_path('sticker')
+        _slow_copy(input_path, output_path)
+        finished.append(output_path)
+        return output_path, {'kb': 1}
+
+    monkeypatch.setattr(convert, 'fit_to_limits', fake_fit)
+
+    async def scenario():
+        content = secrets.token_bytes(256)
+        path = _write_input(content, 'input')
+        task = asyncio.create_task(convert.convert_path(path, content_hash=hashlib.sha256(content).hexdigest()))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        await asyncio.sleep(0)
+        # The pool thread is still reading it
+        assert os.path.exists(path)
+        await asyncio.sleep(0.5)
+        assert finished
+        assert not os.path.exists(path)
+        os.unlink(finished[0])
+
+    asyncio.run(scenario())